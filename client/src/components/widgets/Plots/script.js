@@ -8,7 +8,13 @@ import { PlotType } from "../../../utils/constants";
 import { PlotFetcher } from "../../../utils/plotFetcher";
 
 import plot from "../../../store/plot";
-import { extractRange } from "../../../utils/helpers";
+import { decodeTypedArrays, extractRange } from "../../../utils/helpers";
+
+// Plotly data with the values sent as typed arrays rather than JSON
+const PLOTLY_MSGPACK = "application/vnd.plotly.v1+msgpack";
+
+// Mesh geometry shared by all of the plots, keyed by geometry hash
+const geometries = new Map();
 
 // // Number of timesteps to prefetch data for.
 // const TIMESTEPS_TO_PREFETCH = 3;
@@ -103,8 +109,13 @@ export default {
               this.callFastEndpoint(`variables/${itemId}/timesteps/meta`),
             (itemId, timestep, asImage) =>
               this.callFastEndpoint(
-                `variables/${itemId}/timesteps/${timestep}/plot?as_image=${asImage}`,
-                { responseType: "blob" },
+                `variables/${itemId}/timesteps/${timestep}/plot?as_image=${asImage}&geometry=false`,
+                {
+                  responseType: "blob",
+                  headers: {
+                    Accept: `${PLOTLY_MSGPACK}, application/vnd.plotly.v1+json;q=0.9, */*;q=0.8`,
+                  },
+                },
               ),
             (response, timeStep) =>
               this.resolveTimeStepData(response, timeStep),
@@ -209,6 +220,25 @@ export default {
       );
       return data;
     },
+    /**
+     * Add the nodes and connectivity to a mesh that was sent without them.
+     * The geometry is only fetched when it hasn't been seen before.
+     */
+    addGeometry: async function (data, timeStep) {
+      if (!data.geometryHash || data.nodes) {
+        return data;
+      }
+      if (!geometries.has(data.geometryHash)) {
+        const geometry = this.callFastEndpoint(
+          `variables/${this.itemId}/timesteps/${timeStep}/geometry`,
+          { responseType: "arraybuffer" },
+        ).then((response) => decode(response));
+        geometries.set(data.geometryHash, geometry);
+        geometry.catch(() => geometries.delete(data.geometryHash));
+      }
+      const { nodes, connectivity } = await geometries.get(data.geometryHash);
+      return { ...data, nodes, connectivity };
+    },
     /**
      * Fetch the data for give timestep. The data is added to loadedTimeStepData
      */
@@ -220,6 +250,9 @@ export default {
       } else if (response.type === "application/msgpack") {
         reader.readAsArrayBuffer(response);
         this.plotType = PlotType.VTK;
+      } else if (response.type === PLOTLY_MSGPACK) {
+        reader.readAsArrayBuffer(response);
+        this.plotType = PlotType.Plotly;
       } else {
         reader.readAsText(response);
         this.plotType = PlotType.Plotly;
@@ -229,8 +262,11 @@ export default {
           return;
         }
 
-        reader.onload = () => {
+        reader.onload = async () => {
           let img;
+          if (this.plotType === PlotType.VTK) {
+            img = await this.addGeometry(decode(reader.result), timeStep);
+          }
           const ltsd = this.loadedTimeStepData;
           if (this.plotType === PlotType.Image) {
             this.setLoadedTimeStepData([
@@ -242,7 +278,6 @@ export default {
               },
             ]);
           } else if (this.plotType === PlotType.VTK) {
-            img = decode(reader.result);
             this.$refs[`${this.row}-${this.col}`].addRenderer(img);
             if (!this.isTimeStepLoaded(timeStep)) {
               this.setLoadedTimeStepData([
@@ -255,7 +290,10 @@ export default {
               ]);
             }
           } else if (!this.isTimeStepLoaded(timeStep)) {
-            img = JSON.parse(reader.result);
+            img =
+              response.type === PLOTLY_MSGPACK
+                ? decodeTypedArrays(decode(reader.result))
+                : JSON.parse(reader.result);
             this.setLoadedTimeStepData([
               ...ltsd,
               {
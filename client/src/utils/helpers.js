@@ -22,3 +22,32 @@ export function nextAvailableTimeStep(requested, available) {
   }
   return timeStep;
 }
+
+const TYPED_ARRAYS = {
+  f4: Float32Array,
+  f8: Float64Array,
+  i1: Int8Array,
+  i2: Int16Array,
+  i4: Int32Array,
+  u1: Uint8Array,
+  u2: Uint16Array,
+  u4: Uint32Array,
+};
+
+// Replace the array indices in a plotly msgpack response with typed arrays
+export function decodeTypedArrays(plot) {
+  const arrays = plot.arrays.map(({ dtype, data }) => {
+    // Copy so the typed array is aligned to its element size
+    const buffer = data.buffer.slice(
+      data.byteOffset,
+      data.byteOffset + data.byteLength,
+    );
+    return new TYPED_ARRAYS[dtype.slice(1)](buffer);
+  });
+  const data = plot.data.map((trace) => ({
+    ...trace,
+    x: arrays[trace.x],
+    y: arrays[trace.y],
+  }));
+  return { data, layout: plot.layout };
+}
@@ -2,6 +2,8 @@ from app.api.api_v1.endpoints import health
 from app.api.api_v1.endpoints import images
 from app.api.api_v1.endpoints import movie
 from app.api.api_v1.endpoints import rawdata
+from app.api.api_v1.endpoints import stats
+from app.api.api_v1.endpoints import timeseries
 from app.api.api_v1.endpoints import variables
 
 from fastapi import APIRouter
@@ -13,3 +15,5 @@ api_router.include_router(movie.router, prefix="/variables", tags=["movie"])
 api_router.include_router(variables.router, prefix="/variables", tags=["variables"])
 api_router.include_router(images.router, prefix="/variables", tags=["images"])
 api_router.include_router(rawdata.router, prefix="/variables", tags=["rawdata"])
+api_router.include_router(stats.router, prefix="/variables", tags=["stats"])
+api_router.include_router(timeseries.router, prefix="/variables", tags=["timeseries"])
@@ -3,7 +3,7 @@ from typing import Dict
 from .utils import MsgpackResponse
 
 
-async def generate_colormap_data(plot_config: Dict, bp_file, variable: str):
+def generate_colormap_data(plot_config: Dict, bp_file, variable: str):
     x_variable = plot_config["x"]
     y_variable = plot_config["y"]
     color_variable = plot_config["color"]
@@ -11,9 +11,9 @@ async def generate_colormap_data(plot_config: Dict, bp_file, variable: str):
     y_label = plot_config["ylabel"]
     title = plot_config["title"]
 
-    x = bp_file.read(x_variable).data
-    y = bp_file.read(y_variable).data
-    color = bp_file.read(color_variable).data
+    x = bp_file.read(x_variable)
+    y = bp_file.read(y_variable)
+    color = bp_file.read(color_variable)
 
     return {
         "x": x,
@@ -27,6 +27,5 @@ async def generate_colormap_data(plot_config: Dict, bp_file, variable: str):
     }
 
 
-async def generate_colormap_response(plot_config: Dict, bp_file, variable: str):
-    mesh_json = await generate_colormap_data(plot_config, bp_file, variable)
-    return MsgpackResponse(content=mesh_json)
+def generate_colormap_response(colormap_json: Dict) -> MsgpackResponse:
+    return MsgpackResponse(content=colormap_json)
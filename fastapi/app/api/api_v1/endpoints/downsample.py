@@ -0,0 +1,53 @@
+from typing import List
+
+import numpy as np
+
+
+def minmax_indices(ys: List[np.ndarray], max_points: int) -> np.ndarray:
+    """
+    Indices of the minimum and maximum of each series in equally sized
+    buckets, along with the end points. The union is taken over all of the
+    series so that they can still share the same x values, each series
+    contributes at most `max_points`.
+    """
+    n = len(ys[0])
+    buckets = max(1, (max_points - 2) // 2)
+    if n <= max_points or n <= 2 * buckets:
+        return np.arange(n)
+
+    size = -(-n // buckets)
+    offsets = np.arange(buckets) * size
+    indices = [np.array([0, n - 1])]
+    for y in ys:
+        # Pad with the last value so the series reshapes into whole buckets
+        y = np.pad(np.asarray(y), (0, buckets * size - n), mode="edge")
+        y = y.reshape(buckets, size)
+        indices.append(offsets + np.argmin(y, axis=1))
+        indices.append(offsets + np.argmax(y, axis=1))
+
+    return np.unique(np.minimum(np.concatenate(indices), n - 1))
+
+
+def grid_indices(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Indices of one point per cell of a grid of roughly `max_points` cells
+    spanning the data, points that would be drawn on top of each other are
+    dropped.
+    """
+    if len(x) <= max_points:
+        return np.arange(len(x))
+
+    side = max(1, int(np.sqrt(max_points)))
+    (finite,) = np.nonzero(np.isfinite(x) & np.isfinite(y))
+    if not finite.size:
+        # Nothing that can be drawn
+        return finite
+
+    cells = np.zeros(len(finite), dtype=np.int64)
+    for values in [x[finite], y[finite]]:
+        lo, hi = values.min(), values.max()
+        scale = (side - 1) / (hi - lo) if hi > lo else 0
+        cells = cells * side + ((values - lo) * scale).astype(np.int64)
+    _, first = np.unique(cells, return_index=True)
+
+    return finite[np.sort(first)]
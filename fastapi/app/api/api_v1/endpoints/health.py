@@ -1,7 +1,17 @@
+from typing import Any
 from typing import Dict
 
+from app.core.assetstore import assetstore
+from app.core.cache import bp_cache
+from app.core.cache import image_cache
+from app.core.cache import plot_cache
+from app.core.executor import executor
+
 from fastapi import APIRouter
 
+from .images import render_pool
+from .movie import movie_jobs
+
 router = APIRouter()
 
 
@@ -11,3 +21,59 @@ router = APIRouter()
 )
 def health():
     return {"status": "OK"}
+
+
+@router.get(
+    "/cache",
+    response_model=Dict[str, int],
+)
+def cache():
+    return bp_cache.stats()
+
+
+@router.get(
+    "/cache/plots",
+    response_model=Dict[str, int],
+)
+def plot_cache_stats():
+    return plot_cache.stats()
+
+
+@router.get(
+    "/cache/images",
+    response_model=Dict[str, int],
+)
+def image_cache_stats():
+    return image_cache.stats()
+
+
+@router.get(
+    "/assetstore",
+    response_model=Dict[str, Any],
+)
+def assetstore_stats():
+    return assetstore.stats()
+
+
+@router.get(
+    "/executor",
+    response_model=Dict[str, Any],
+)
+def executor_stats():
+    return executor.stats()
+
+
+@router.get(
+    "/render",
+    response_model=Dict[str, Any],
+)
+def render_stats():
+    return render_pool.stats()
+
+
+@router.get(
+    "/movies",
+    response_model=Dict[str, Any],
+)
+def movie_stats():
+    return movie_jobs.stats()
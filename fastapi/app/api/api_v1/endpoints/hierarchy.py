@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+
+from app.core.config import settings
+
+from fastapi import HTTPException
+
+ARCHIVE_SUFFIX = ".bp.tgz"
+# Ingest can instead store the plots of a group in an uncompressed tarball,
+# with an index of where each plot's files are, so they can be read on their own.
+INDEXED_SUFFIX = ".bp.tar"
+INDEX_SUFFIX = ".bp.index.json"
+
+
+def is_indexed(bp_file: Dict) -> bool:
+    return bp_file["name"].endswith(INDEXED_SUFFIX)
+
+
+class HierarchyIndex:
+    """
+    Maps a variable item id to its group, run and timesteps folders along with
+    the per-timestep item and file ids, so a plot request doesn't have to walk
+    the Girder hierarchy every time.
+
+    Entries are keyed by the Girder token as well as the variable id, so a
+    cached lookup is only ever reused by a client that was allowed to make it.
+    """
+
+    def __init__(self, ttl: int, maxsize: int = 1000) -> None:
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    async def _list_timesteps(self, gc, entry: Dict) -> None:
+        for item in await gc.list_item(entry["timestepsFolderId"]):
+            if not item["name"].isdigit():
+                continue
+            entry["timesteps"].setdefault(int(item["name"]), {"item": item})
+
+    async def _load(self, gc, variable_id: str) -> Dict:
+        item = await gc.get_item(variable_id)
+        group_folder_task = asyncio.create_task(gc.get_folder(item["folderId"]))
+        # Ingest records the run folder, so we don't have to wait for the group
+        if run_folder_id := item["meta"].get("runFolderId"):
+            group_folder = None
+        else:
+            group_folder = await group_folder_task
+            run_folder_id = group_folder["parentId"]
+
+        timesteps_folder = await gc.list_folder(run_folder_id, name="timesteps")
+        group_folder = group_folder or await group_folder_task
+        if len(timesteps_folder) != 1:
+            raise HTTPException(status_code=404, detail="Timesteps folder not found.")
+
+        entry = {
+            "item": item,
+            "name": item["name"],
+            "groupFolderId": group_folder["_id"],
+            "groupName": group_folder["name"],
+            "runFolderId": run_folder_id,
+            "timestepsFolderId": timesteps_folder[0]["_id"],
+            "timesteps": {},
+            "expires": time.monotonic() + self._ttl,
+        }
+        await self._list_timesteps(gc, entry)
+
+        return entry
+
+    async def variable(self, gc, variable_id: str, refresh: bool = False) -> Dict:
+        key = (gc.token, variable_id)
+        entry = self._entries.get(key)
+        if refresh or entry is None or entry["expires"] < time.monotonic():
+            # Concurrent requests for the same variable share a single load
+            if key not in self._loading:
+                self._loading[key] = asyncio.create_task(self._load(gc, variable_id))
+            try:
+                entry = await asyncio.shield(self._loading[key])
+            finally:
+                self._loading.pop(key, None)
+            self._entries[key] = entry
+
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+        return entry
+
+    async def timesteps(self, gc, variable_id: str, timestep: int = None) -> List[int]:
+        entry = await self.variable(gc, variable_id)
+        timesteps = entry["item"]["meta"]["timesteps"]
+        if timestep is not None and timestep not in timesteps:
+            # The step may have been ingested since the entry was filled
+            entry = await self.variable(gc, variable_id, refresh=True)
+            timesteps = entry["item"]["meta"]["timesteps"]
+
+        return timesteps
+
+    async def _timestep(self, gc, variable_id: str, timestep: int) -> Dict:
+        entry = await self.variable(gc, variable_id)
+        if timestep not in entry["timesteps"]:
+            # New timesteps may have been ingested since the index was filled
+            await self._list_timesteps(gc, entry)
+        if timestep not in entry["timesteps"]:
+            raise HTTPException(status_code=404, detail="Timestep not found.")
+
+        return entry["timesteps"][timestep]
+
+    async def timestep_item(self, gc, variable_id: str, timestep: int) -> Dict:
+        return (await self._timestep(gc, variable_id, timestep))["item"]
+
+    async def timestep_files(
+        self, gc, variable_id: str, timestep: int, refresh: bool = False
+    ) -> List[Dict]:
+        ts = await self._timestep(gc, variable_id, timestep)
+        if refresh or "files" not in ts:
+            ts["files"] = await gc.list_file(ts["item"]["_id"])
+
+        return ts["files"]
+
+    async def bp_file(self, gc, variable_id: str, timestep: int) -> Dict:
+        group_name = (await self.variable(gc, variable_id))["groupName"]
+        timestep_item = await self.timestep_item(gc, variable_id, timestep)
+
+        # FIXME: This is a temporary hack to allow us to test the performance plots
+        # This block should be removed once those bp filenames are fixed.
+        stems = [
+            group_name,
+            f"{('').join(group_name.split())}-{timestep_item['name'].lstrip('0')}",
+        ]
+        filenames = [
+            f"{stem}{suffix}"
+            for suffix in [INDEXED_SUFFIX, ARCHIVE_SUFFIX]
+            for stem in stems
+        ]
+
+        # The groups of a timestep are uploaded independently, so the file may
+        # have been added since the listing was cached.
+        for refresh in [False, True]:
+            files = await self.timestep_files(gc, variable_id, timestep, refresh)
+            files = {f["name"]: f for f in files}
+            for filename in filenames:
+                if filename in files:
+                    return files[filename]
+
+        raise HTTPException(status_code=404, detail="Unable to locate BP file.")
+
+    async def bp_index_file(
+        self, gc, variable_id: str, timestep: int, bp_file: Dict
+    ) -> Dict:
+        filename = f"{bp_file['name'][: -len(INDEXED_SUFFIX)]}{INDEX_SUFFIX}"
+        for refresh in [False, True]:
+            files = await self.timestep_files(gc, variable_id, timestep, refresh)
+            for index_file in files:
+                if index_file["name"] == filename:
+                    return index_file
+
+        raise HTTPException(status_code=404, detail="Unable to locate BP file index.")
+
+    async def bp_file_id(self, gc, variable_id: str, timestep: int) -> str:
+        return (await self.bp_file(gc, variable_id, timestep))["_id"]
+
+
+hierarchy = HierarchyIndex(settings.HIERARCHY_INDEX_TTL)
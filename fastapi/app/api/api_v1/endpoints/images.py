@@ -1,9 +1,15 @@
+import asyncio
 import io
 import json
-import tempfile
-import zipfile
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import AsyncIterator
 from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Tuple
 from urllib.parse import unquote
 
 import numpy as np
@@ -14,18 +20,21 @@ import vtkmodules.vtkInteractionStyle  # noqa
 
 # noinspection PyUnresolvedReferences
 import vtkmodules.vtkRenderingOpenGL2  # noqa
+from app.core.cache import image_cache
+from app.core.config import settings
+from app.core.executor import BoundedExecutor
+from app.core.executor import batch
+from app.core.executor import executor
 from app.schemas.format import PlotFormat
 from fastapi.responses import FileResponse
 from PIL import Image
 from PIL import ImageDraw
 from starlette.responses import StreamingResponse
 from vtk.util import numpy_support
-from vtkmodules.vtkCommonCore import vtkIdList
 from vtkmodules.vtkCommonCore import vtkLookupTable
 from vtkmodules.vtkCommonCore import vtkPoints
 from vtkmodules.vtkCommonDataModel import vtkCellArray
 from vtkmodules.vtkCommonDataModel import vtkPolyData
-from vtkmodules.vtkIOImage import vtkPNGWriter
 from vtkmodules.vtkRenderingAnnotation import vtkCubeAxesActor
 from vtkmodules.vtkRenderingAnnotation import vtkScalarBarActor
 from vtkmodules.vtkRenderingCore import vtkActor
@@ -40,19 +49,55 @@ from vtkmodules.vtkRenderingMatplotlib import vtkMatplotlibMathTextUtilities  #
 
 from fastapi import APIRouter
 from fastapi import Header
+from fastapi import Response
 
+from .hierarchy import hierarchy
+from .mesh import geometry_hash
+from .utils import cache_headers
+from .utils import file_etag
 from .utils import get_girder_client
-from .variables import get_timestep_plot
+from .utils import not_modified
+from .utils import ordered_tasks
+from .utils import stream_zip
+from .variables import fetch_timestep_plot
+from .variables import plot_source
 
 router = APIRouter()
 
+# Number of prepared geometries each mesh pipeline holds on to
+GEOMETRY_CACHE_SIZE = 8
+
+logger = logging.getLogger(__name__)
+
 
 class PlotDetails:
+    # Settings that render the same whether or not they are given
+    _DEFAULTS = {
+        "log": False,
+        "useRunGlobals": False,
+        "showLegend": True,
+        "showXAxis": True,
+        "showYAxis": True,
+        "showScalarBar": True,
+        "showTitle": True,
+        "rangeAnnotations": True,
+    }
+
     def __init__(self, details=None) -> None:
         self._details = details if details else {}
         if isinstance(details, str):
             self._details = json.loads(unquote(details))
 
+    @property
+    def key(self) -> str:
+        # Canonical form of the details, used to identify rendered images
+        details = {
+            k: v
+            for k, v in self._details.items()
+            if k not in self._DEFAULTS or self._DEFAULTS[k] != v
+        }
+        return json.dumps(details, sort_keys=True, separators=(",", ":"))
+
     @property
     def log_scaling(self):
         return self._details.get("log", False)
@@ -163,15 +208,13 @@ def create_plotly_image(plot_data: dict, format: str, plot_details: PlotDetails)
     if not plot_details.show_title:
         plot_data["layout"]["title"]["text"] = ""
 
-    # Get image as bytes
+    # Get image as bytes, it is encoded to the requested format only once
     fig = go.Figure(plot_data["data"], plot_data["layout"])
-    output_file = tempfile.NamedTemporaryFile(suffix=f".{format}", delete=False)
-    fig.write_image(output_file.name, format=format)
-    return _convert_image(output_file, format, plot_details)
+    img = Image.open(io.BytesIO(fig.to_image(format="png")))
+    return _convert_image(img, format, plot_details)
 
 
-def _convert_image(png_image, format: str, plot_details: PlotDetails):
-    img = Image.open(png_image)
+def _convert_image(img: Image.Image, format: str, plot_details: PlotDetails):
     if plot_details.show_annotations:
         draw = ImageDraw.Draw(img)
         x, y, scalar = plot_details.bounds
@@ -188,63 +231,91 @@ def _convert_image(png_image, format: str, plot_details: PlotDetails):
     return buf.getvalue()
 
 
-def _mkVtkIdList(it):
-    # Makes a vtkIdList from a Python iterable.
-    vil = vtkIdList()
-    for i in it:
-        vil.InsertNextId(int(i))
-    return vil
+def _vtk_points(nodes: np.ndarray) -> vtkPoints:
+    # Pad the 2D nodes with z = 0 and hand the whole array to VTK at once
+    points = np.zeros((len(nodes), 3), dtype=np.float64)
+    points[:, :2] = nodes[:, :2]
+    vtk_points = vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    return vtk_points
+
+
+def _vtk_cells(connectivity: np.ndarray) -> vtkCellArray:
+    # Every cell has the same number of points, so the offsets are implicit
+    connectivity = np.asarray(connectivity, dtype=numpy_support.ID_TYPE_CODE)
+    n_cells, cell_size = connectivity.shape
+    offsets = np.arange(0, (n_cells + 1) * cell_size, cell_size).astype(
+        numpy_support.ID_TYPE_CODE
+    )
+    cells = vtkCellArray()
+    cells.SetData(
+        numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+        numpy_support.numpy_to_vtkIdTypeArray(connectivity.ravel(), deep=True),
+    )
+    return cells
+
+
+def _grid_geometry(xpoints: np.ndarray, ypoints: np.ndarray):
+    # Nodes are ordered with x varying fastest, each cell is a closed quad
+    nx, ny = len(xpoints), len(ypoints)
+    xx, yy = np.meshgrid(xpoints, ypoints)
+    nodes = np.column_stack([xx.ravel(), yy.ravel()])
+    corners = (np.arange(ny - 1)[:, None] * nx + np.arange(nx - 1)).ravel()
+    connectivity = corners[:, None] + np.array([0, nx, nx + 1, 1, 0])
+    return nodes, connectivity
 
 
 class MeshImagePipeline:
-    def _retrieve_mesh_data(
-        self, plot_type: str, plot_data: Dict, plot_details: PlotDetails
-    ):
+    def _geometry(self, plot_type: str, plot_data: Dict) -> vtkPolyData:
+        # Consecutive frames usually share their geometry, only the scalars change
         if plot_type == PlotFormat.mesh:
             nodes = np.asarray(plot_data["nodes"])
             connectivity = np.asarray(plot_data["connectivity"])
-            scale = 1
+            key = plot_data.get("geometryHash") or geometry_hash(nodes, connectivity)
         elif plot_type == PlotFormat.colormap:
-            xpoints, ypoints = plot_data["x"], plot_data["y"]
-            nodes, connectivity = [], []
-            idx = 0
-            for j in range(len(ypoints)):
-                for i in range(len(xpoints)):
-                    nodes.append([xpoints[i], ypoints[j]])
-                    if i < len(xpoints) - 1 and j < len(ypoints) - 1:
-                        connectivity.append(
-                            [
-                                idx,
-                                idx + len(xpoints),
-                                idx + len(xpoints) + 1,
-                                idx + 1,
-                                idx,
-                            ]
-                        )
-                    idx += 1
-            nodes = np.array(nodes)
-            connectivity = np.array(connectivity)
-            # TODO: Remove this when we have more functionality in VTK charts
-            # Manipulate actor scale to ensure the plot remains square
-            x0, x1 = (
-                plot_details.x_range
-                if plot_details.use_globals
-                else [min(xpoints), max(xpoints)]
-            )
-            y0, y1 = (
-                plot_details.y_range
-                if plot_details.use_globals
-                else [min(ypoints), max(ypoints)]
-            )
-            scale = (y1 - y0) / (x1 - x0)
-
-        return nodes, connectivity, scale
+            xpoints = np.asarray(plot_data["x"]).ravel()
+            ypoints = np.asarray(plot_data["y"]).ravel()
+            key = geometry_hash(xpoints, ypoints)
+        key = (plot_type, key)
+
+        if key in self._geometries:
+            self._geometries.move_to_end(key)
+            return self._geometries[key]
+
+        if plot_type == PlotFormat.colormap:
+            nodes, connectivity = _grid_geometry(xpoints, ypoints)
+        mesh = vtkPolyData()
+        mesh.SetPoints(_vtk_points(nodes))
+        mesh.SetPolys(_vtk_cells(connectivity))
+
+        self._geometries[key] = mesh
+        while len(self._geometries) > GEOMETRY_CACHE_SIZE:
+            self._geometries.popitem(last=False)
+
+        return mesh
+
+    def _scale(self, plot_type: str, plot_data: Dict, plot_details: PlotDetails):
+        if plot_type != PlotFormat.colormap:
+            return 1
+
+        xpoints = np.asarray(plot_data["x"])
+        ypoints = np.asarray(plot_data["y"])
+        x0, x1 = (
+            plot_details.x_range
+            if plot_details.use_globals
+            else [xpoints.min(), xpoints.max()]
+        )
+        y0, y1 = (
+            plot_details.y_range
+            if plot_details.use_globals
+            else [ypoints.min(), ypoints.max()]
+        )
+        return (y1 - y0) / (x1 - x0)
 
     def render_image(self, plot_data: Dict, format: str, plot_details: PlotDetails):
         plot_type = plot_data["type"]
-        nodes, connectivity, scale = self._retrieve_mesh_data(
-            plot_type, plot_data, plot_details
-        )
+        mesh = self._geometry(plot_type, plot_data)
+        scale = self._scale(plot_type, plot_data, plot_details)
         color = np.asarray(plot_data["color"])
 
         if color.ndim > 1:
@@ -254,18 +325,6 @@ class MeshImagePipeline:
         colorLabel = plot_data["colorLabel"]
         title = plot_data["title"]
 
-        if self.points is None or plot_data != self.prev_plot_type:
-            self.points = vtkPoints()
-            for i, (x, y) in enumerate(nodes):
-                self.points.InsertPoint(i, (x, y, 0.0))
-            self.mesh.SetPoints(self.points)
-        if self.cells is None or plot_data != self.prev_plot_type:
-            # For now we can cache mesh as the connectivity is the  for mesh plots
-            self.cells = vtkCellArray()
-            for pt in connectivity:
-                self.cells.InsertNextCell(_mkVtkIdList(pt))
-            self.mesh.SetPolys(self.cells)
-
         # TODO: Remove this when we have more functionality in VTK charts
         # Manipulate actor scale to ensure the plot remains square
         self.mesh_actor.SetScale(scale, 1, 1)
@@ -273,12 +332,12 @@ class MeshImagePipeline:
         scalars = numpy_support.numpy_to_vtk(color)
 
         # We now assign the pieces to the vtkPolyData.
-        self.mesh.GetPointData().SetScalars(scalars)
+        mesh.GetPointData().SetScalars(scalars)
 
         x, y, scalar = plot_details.bounds
 
         # Setup mapper and actor
-        self.mesh_mapper.SetInputData(self.mesh)
+        self.mesh_mapper.SetInputData(mesh)
         scalar_range = scalar if scalar else scalars.GetRange()
         self.mesh_mapper.SetScalarRange(scalar_range)
 
@@ -349,22 +408,18 @@ class MeshImagePipeline:
         w2if.ReadFrontBufferOff()
         w2if.Update()
 
-        output_file = tempfile.NamedTemporaryFile(suffix=f".{format}", delete=False)
-        self.writer.SetFileName(output_file.name)
-        self.writer.SetInputConnection(w2if.GetOutputPort())
-        self.writer.Write()
-
-        self.prev_plot_type = plot_type
+        # Hand the pixels to PIL directly, VTK's rows start at the bottom
+        image_data = w2if.GetOutput()
+        width, height, _ = image_data.GetDimensions()
+        pixels = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars())
+        pixels = pixels.reshape(height, width, -1)[::-1]
+        img = Image.fromarray(np.ascontiguousarray(pixels), "RGB")
 
-        return _convert_image(output_file, format, plot_details)
+        return _convert_image(img, format, plot_details)
 
     def __init__(self):
-        # Note previous plot type in order to take advantage of caching
-        self.prev_plot_type = None
-        # We"ll create the building blocks of polydata including data attributes.
-        self.mesh = vtkPolyData()
-        self.points = None  # vtkPoints()
-        self.cells = None  # vtkCellArray()
+        # Prepared geometries, keyed by plot type and geometry hash
+        self._geometries = OrderedDict()
 
         # Setup mapper and actor
         self.mesh_mapper = vtkPolyDataMapper()
@@ -397,6 +452,7 @@ class MeshImagePipeline:
 
         self.renderer = vtkRenderer()
         self.ren_win = vtkRenderWindow()
+        self.ren_win.SetOffScreenRendering(1)
         self.ren_win.AddRenderer(self.renderer)
 
         self.renderer.AddActor(self.mesh_actor)
@@ -451,20 +507,28 @@ class MeshImagePipeline:
         self.scalar_bar.GetTitleTextProperty().ItalicOff()
         self.renderer.AddActor2D(self.scalar_bar)
 
-        # Setup image filter
-        self.writer = vtkPNGWriter()
 
+# Each render worker process has its own pipeline, and with it its own
+# offscreen render window. Plotly starts a kaleido instance per process too.
+pipeline = None
 
-pipeline = MeshImagePipeline()
+pipeline_lock = threading.Lock()
 
 
-def create_mesh_image(plot_data: dict, format: str, plot_details: PlotDetails):
+def _init_render_worker() -> None:
     global pipeline
+    pipeline = MeshImagePipeline()
 
-    return pipeline.render_image(plot_data, format, plot_details)
 
+def create_mesh_image(plot_data: dict, format: str, plot_details: PlotDetails):
+    # The pipeline has a single render window, so renders can't overlap
+    with pipeline_lock:
+        if pipeline is None:
+            _init_render_worker()
+        return pipeline.render_image(plot_data, format, plot_details)
 
-async def get_timestep_image_data(plot: dict, format: str, plot_details: PlotDetails):
+
+def create_image(plot: dict, format: str, plot_details: PlotDetails) -> bytes:
     if plot["type"] in PlotFormat.plotly:
         image = create_plotly_image(plot, format, plot_details)
     elif plot["type"] == PlotFormat.mesh or plot["type"] == PlotFormat.colormap:
@@ -475,6 +539,108 @@ async def get_timestep_image_data(plot: dict, format: str, plot_details: PlotDet
     return image
 
 
+render_pool = BoundedExecutor(
+    "process",
+    settings.RENDER_WORKERS,
+    settings.RENDER_QUEUE_SIZE,
+    initializer=_init_render_worker,
+)
+
+
+async def get_timestep_image_data(plot: dict, format: str, plot_details: PlotDetails):
+    return (await get_timestep_image_data_timed(plot, format, plot_details))[0]
+
+
+async def get_timestep_image_data_timed(
+    plot: dict, format: str, plot_details: PlotDetails
+) -> Tuple[bytes, Dict[str, float]]:
+    return await render_pool.run_timed(create_image, plot, format, plot_details)
+
+
+def _convert_static_image(path: str, format: str) -> bytes:
+    with Image.open(path) as img:
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format.upper())
+    return buf.getvalue()
+
+
+async def render_timestep_image_timed(
+    gc, variable_id: str, timestep: int, format: str, plot_details: PlotDetails
+) -> Tuple[bytes, Dict[str, float]]:
+    """
+    Renders the image of a timestep, or converts its static image, going
+    through the image cache. Also returns how long the render waited for a
+    worker and how long it took, which is empty if nothing was rendered.
+    """
+    variable = (await hierarchy.variable(gc, variable_id))["name"]
+    key = None
+    if source := await plot_source(gc, variable_id, timestep, as_image=True):
+        key = (source["_id"], variable, plot_details.key, format)
+        if (image := image_cache.get(key)) is not None:
+            return image, {}
+
+    timings = {}
+    plot = await fetch_timestep_plot(gc, variable_id, timestep, as_image=True)
+    if isinstance(plot, FileResponse):
+        image = await executor.run(_convert_static_image, plot.path, format)
+    else:
+        image, timings = await get_timestep_image_data_timed(plot, format, plot_details)
+
+    if key is not None:
+        image_cache.set(key, image)
+
+    return image, timings
+
+
+async def render_timestep_image(
+    gc, variable_id: str, timestep: int, format: str, plot_details: PlotDetails
+) -> bytes:
+    return (
+        await render_timestep_image_timed(
+            gc, variable_id, timestep, format, plot_details
+        )
+    )[0]
+
+
+async def warm_image_cache(
+    gc, variable_id: str, timesteps: List[int], format: str, plot_details: PlotDetails
+) -> None:
+    for step in timesteps:
+        try:
+            await render_timestep_image(gc, variable_id, step, format, plot_details)
+        except Exception:
+            logger.exception("Unable to render timestep %s of %s", step, variable_id)
+
+
+async def render_frames(
+    gc, variable_id: str, steps: List[int], format: str, plot_details: PlotDetails
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Renders the timesteps in parallel on the render pool and yields the images
+    in timestep order. The renders wait for a free worker rather than being
+    turned away, and a frame that fails to render fails the whole batch.
+    """
+    # Keep every render worker busy, but only hold a few frames in memory
+    window = 2 * render_pool.max_workers
+
+    async def render(step):
+        with batch():
+            return await render_timestep_image(
+                gc, variable_id, step, format, plot_details
+            )
+
+    async with aclosing(ordered_tasks(steps, render, window)) as tasks:
+        async for step, task in tasks:
+            try:
+                image = await task
+            except Exception:
+                logger.exception(
+                    "Unable to render timestep %s of %s", step, variable_id
+                )
+                raise
+            yield step, image
+
+
 @router.get("/{variable_id}/timesteps/{timestep}/image")
 async def get_timestep_image(
     variable_id: str,
@@ -482,19 +648,36 @@ async def get_timestep_image(
     format: str,
     details: Optional[str] = None,
     girder_token: str = Header(None),
+    if_none_match: str = Header(None),
 ):
     # Make sure time step exists
     gc = get_girder_client(girder_token)
-    item = gc.getItem(variable_id)
-    timesteps = item["meta"]["timesteps"]
+    timesteps = await hierarchy.timesteps(gc, variable_id, timestep)
     if timestep not in timesteps:
         timestep = max([s for s in timesteps if s < timestep])
+
     # Check if there are additional settings to apply
     plot_details = PlotDetails(details)
-    # call generate plot response and get plot
-    plot = await get_timestep_plot(variable_id, timestep, girder_token, as_image=True)
-    img_bytes = await get_timestep_image_data(plot, format, plot_details)
-    return StreamingResponse(io.BytesIO(img_bytes), media_type=f"image/{format}")
+
+    headers = {}
+    if source := await plot_source(gc, variable_id, timestep, as_image=True):
+        etag = file_etag(source, variable_id, "image", format, plot_details.key)
+        headers = cache_headers(etag)
+        if not_modified(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+    img_bytes, timings = await render_timestep_image_timed(
+        gc, variable_id, timestep, format, plot_details
+    )
+    if timings:
+        # Time spent waiting for a render worker and rendering, in ms
+        headers["Server-Timing"] = (
+            f"queue;dur={timings['queue'] * 1000:.1f}, "
+            f"render;dur={timings['run'] * 1000:.1f}"
+        )
+    return StreamingResponse(
+        io.BytesIO(img_bytes), media_type=f"image/{format}", headers=headers
+    )
 
 
 @router.get("/{variable_id}/timesteps/image")
@@ -507,8 +690,7 @@ async def get_timestep_images(
 ):
     # Get all timesteps
     gc = get_girder_client(girder_token)
-    item = gc.getItem(variable_id)
-    timesteps = item["meta"]["timesteps"]
+    timesteps = await hierarchy.timesteps(gc, variable_id)
     # Check if there are specific time steps to use
     if selectedTimeSteps:
         selectedTimeSteps = json.loads(unquote(selectedTimeSteps))
@@ -517,23 +699,46 @@ async def get_timestep_images(
     # Check if there are additional settings to apply
     plot_details = PlotDetails(details)
 
-    output_file = tempfile.NamedTemporaryFile(suffix=f".zip", delete=False)
-    with zipfile.ZipFile(output_file, "w") as zip_obj:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            for step in selectedTimeSteps:
-                if step in timesteps:
-                    # call generate plot response and get plot
-                    plot = await get_timestep_plot(
-                        variable_id, step, girder_token, as_image=True
-                    )
-                    image = await get_timestep_image_data(plot, "png", plot_details)
-                    im = Image.open(io.BytesIO(image), "r", ["PNG"]).convert("RGB")
-                    f = tempfile.NamedTemporaryFile(
-                        dir=tmpdir, prefix=f"{step}_", suffix=f".{format}", delete=False
-                    )
-                    im.save(f.name, format.upper())
-                    zip_obj.write(f.name, f"{step}.{format}")
-
-        return FileResponse(
-            path=output_file.name, media_type=f"application/x-zip-compressed"
+    steps = [step for step in selectedTimeSteps if step in timesteps]
+    frames = (
+        (f"{step}.{format}", image)
+        async for step, image in render_frames(
+            gc, variable_id, steps, format, plot_details
         )
+    )
+
+    return StreamingResponse(
+        stream_zip(frames), media_type="application/x-zip-compressed"
+    )
+
+
+# Holds on to the warming tasks until they are done
+_warming = set()
+
+
+@router.post("/{variable_id}/timesteps/image/cache", status_code=202)
+async def cache_timestep_images(
+    variable_id: str,
+    format: str,
+    selectedTimeSteps: str = None,
+    details: Optional[str] = None,
+    girder_token: str = Header(None),
+):
+    """
+    Renders the images of a variable into the image cache in the background,
+    so later image, export and movie requests with the same settings don't
+    have to.
+    """
+    gc = get_girder_client(girder_token)
+    timesteps = await hierarchy.timesteps(gc, variable_id)
+    if selectedTimeSteps:
+        selectedTimeSteps = json.loads(unquote(selectedTimeSteps))
+        timesteps = [s for s in selectedTimeSteps if s in timesteps]
+
+    task = asyncio.create_task(
+        warm_image_cache(gc, variable_id, timesteps, format, PlotDetails(details))
+    )
+    _warming.add(task)
+    task.add_done_callback(_warming.discard)
+
+    return {"timesteps": timesteps}
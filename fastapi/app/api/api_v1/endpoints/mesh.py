@@ -1,9 +1,29 @@
+import hashlib
 from typing import Dict
+from typing import Optional
+
+import numpy as np
 
 from .utils import MsgpackResponse
 
+GEOMETRY_KEYS = ["nodes", "connectivity"]
+
+
+def geometry_hash(nodes: np.ndarray, connectivity: np.ndarray) -> str:
+    # The mesh is usually the same for the whole run, so it is identified by
+    # its content and the client only has to fetch it once.
+    h = hashlib.blake2b(digest_size=16)
+    for values in [nodes, connectivity]:
+        values = np.ascontiguousarray(values)
+        h.update(f"{values.dtype.str}{values.shape}".encode())
+        h.update(values.data)
+
+    return h.hexdigest()
 
-async def generate_mesh_data(plot_config: Dict, bp_file, variable: str):
+
+def generate_mesh_data(
+    plot_config: Dict, bp_file, variable: str, known_hash: Optional[str] = None
+):
     nodes_variable = plot_config["nodes"]
     connectivity_variable = plot_config["connectivity"]
     color_variable = plot_config["color"]
@@ -11,22 +31,63 @@ async def generate_mesh_data(plot_config: Dict, bp_file, variable: str):
     y_label = plot_config["ylabel"]
     title = plot_config["title"]
 
-    nodes = bp_file.read(nodes_variable).data
-    connectivity = bp_file.read(connectivity_variable).data
-    color = bp_file.read(color_variable).data
-
-    return {
-        "connectivity": connectivity,
-        "nodes": nodes,
-        "color": color,
+    mesh_json = {
+        "color": bp_file.read(color_variable),
         "xLabel": x_label,
         "yLabel": y_label,
         "colorLabel": color_variable,
         "title": title,
         "type": "mesh-colormap",
     }
+    if known_hash is not None:
+        # The client already has the geometry, only the color is read
+        mesh_json["geometryHash"] = known_hash
+        return mesh_json
+
+    nodes = bp_file.read(nodes_variable)
+    connectivity = bp_file.read(connectivity_variable)
+
+    return {
+        "connectivity": connectivity,
+        "nodes": nodes,
+        **mesh_json,
+        "geometryHash": geometry_hash(nodes, connectivity),
+    }
+
+
+def ingested_geometry_hash(item_meta: Dict, timestep: int) -> Optional[str]:
+    # Ingest records the geometry hash of each run of timesteps sharing a mesh
+    for hash, first, last in item_meta.get("geometry", []):
+        if first <= timestep <= last:
+            return hash
+
+    return None
+
+
+def _geometry_hash(mesh_json: Dict) -> str:
+    if "geometryHash" in mesh_json:
+        return mesh_json["geometryHash"]
+
+    return geometry_hash(mesh_json["nodes"], mesh_json["connectivity"])
+
+
+def mesh_geometry(mesh_json: Dict) -> Dict:
+    return {
+        "nodes": mesh_json["nodes"],
+        "connectivity": mesh_json["connectivity"],
+        "geometryHash": _geometry_hash(mesh_json),
+    }
+
+
+def mesh_without_geometry(mesh_json: Dict) -> Dict:
+    color_json = {k: v for k, v in mesh_json.items() if k not in GEOMETRY_KEYS}
+    color_json["geometryHash"] = _geometry_hash(mesh_json)
+
+    return color_json
+
 
+def generate_mesh_response(mesh_json: Dict, geometry: bool = True) -> MsgpackResponse:
+    if not geometry:
+        mesh_json = mesh_without_geometry(mesh_json)
 
-async def generate_mesh_response(plot_config: Dict, bp_file, variable: str):
-    mesh_json = await generate_mesh_data(plot_config, bp_file, variable)
     return MsgpackResponse(content=mesh_json)
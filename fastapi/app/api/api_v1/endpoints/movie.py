@@ -1,83 +1,256 @@
-import glob
+import asyncio
 import io
 import json
+import logging
 import os
+import re
 import tempfile
+from contextlib import ExitStack
+from contextlib import aclosing
+from functools import partial
+from pathlib import Path
+from typing import Any
+from typing import AsyncIterator
+from typing import Callable
+from typing import Dict
+from typing import List
 from typing import Optional
-from typing import TypeAlias
+from typing import Tuple
 from urllib.parse import unquote
 
 import ffmpeg
+from app.core.assetstore import assetstore
+from app.core.config import settings
+from app.core.jobs import JobQueue
+from app.core.scratch import scratch
 from fastapi.responses import FileResponse
-from PIL import Image
+from starlette.background import BackgroundTask
 
 from fastapi import APIRouter
 from fastapi import Header
+from fastapi import HTTPException
 
+from .hierarchy import hierarchy
 from .images import PlotDetails
-from .images import get_timestep_image_data
+from .images import render_frames
 from .utils import get_girder_client
-from .variables import get_group_folder_id
-from .variables import get_timestep_item
-from .variables import get_timestep_plot
 
-router = APIRouter()
-
-TempFile: TypeAlias = tempfile._TemporaryFileWrapper
+logger = logging.getLogger(__name__)
 
+router = APIRouter()
 
-async def _image_bytes(
-    id: str, step: str, girder_token: str, as_image: bool, ext: str, details: dict
-) -> io.BytesIO:
-    plot = await get_timestep_plot(id, step, girder_token, as_image)
-    if isinstance(plot, FileResponse):
-        with Image.open(plot.path) as img:
-            buf = io.BytesIO()
-            img.save(buf, ext.upper())
-        return buf
-    else:
-        plot_details = PlotDetails(details)
-        image = await get_timestep_image_data(plot, ext, plot_details)
-        return io.BytesIO(image)
+movie_jobs = JobQueue(
+    Path(settings.CACHE_DIRECTORY) / "jobs" / "movies",
+    settings.MOVIE_WORKERS,
+    settings.MOVIE_QUEUE_SIZE,
+)
 
 
-def _save_file(
-    gc, parent_id: str, data: io.BytesIO | TempFile, item: dict, ext: str
+async def _save_file(
+    gc, parent_id: str, data: io.BytesIO | Path, item: dict, ext: str
 ) -> None:
     new_fname = f"{item['name']}.{ext}"
-    for f in gc.listFile(parent_id):
+    for f in await gc.list_file(parent_id):
         if f["name"] == new_fname:
             return
 
-    size = 0
-    if isinstance(data, io.BytesIO):
-        size = data.getbuffer().nbytes
-    elif isinstance(data, TempFile):
-        size = os.path.getsize(data.name)
-
-    gc.uploadFile(
-        parentId=parent_id,
-        stream=data,
-        name=new_fname,
-        size=size,
-        parentType="item",
-        mimeType=f"image/{ext}",
+    if isinstance(data, Path):
+        with open(data, "rb") as fp:
+            await gc.upload_file(
+                parent_id,
+                fp,
+                new_fname,
+                os.path.getsize(data),
+                parent_type="item",
+                mime_type=f"image/{ext}",
+            )
+        return
+
+    data.seek(0)
+    await gc.upload_file(
+        parent_id,
+        data,
+        new_fname,
+        data.getbuffer().nbytes,
+        parent_type="item",
+        mime_type=f"image/{ext}",
+    )
+
+
+# Segments are H.264 in MPEG-TS so they can be concatenated without
+# re-encoding, the MP4 is then just a remux of them.
+_OUTPUT_ARGS = {
+    ".ts": {"vcodec": "libx264", "pix_fmt": "yuv420p", "format": "mpegts"},
+}
+_CONCAT_OUTPUT_ARGS = {
+    ".mp4": {"c": "copy"},
+}
+SEGMENT_PATTERN = re.compile(r"^segment-(\d+)-(\d+)\.ts$")
+
+
+def _movies_key(id: str) -> str:
+    return f"{id}:movies"
+
+
+def _segment_key(id: str) -> str:
+    return f"{id}:segments"
+
+
+async def _run_ffmpeg(args, frames: Optional[AsyncIterator[bytes]] = None) -> None:
+    process = await asyncio.create_subprocess_exec(
+        *args.compile(),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    # Drain stderr as we go so ffmpeg never blocks on a full pipe
+    stderr = asyncio.create_task(process.stderr.read())
+    try:
+        if frames is not None:
+            async for frame in frames:
+                process.stdin.write(frame)
+                await process.stdin.drain()
+        process.stdin.close()
+        await process.wait()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg exited early, the return code and stderr say why
+        await process.wait()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+    finally:
+        error = await stderr
+
+    if process.returncode != 0:
+        logger.error("ffmpeg failed: %s", error.decode(errors="replace"))
+        raise HTTPException(status_code=500, detail="Unable to encode movie.")
+
+
+async def _encode_movie(
+    frames: AsyncIterator[bytes], outputs: List[str], fps: float = 10.0
+) -> None:
+    """
+    Writes the JPEG frames to the stdin of a single ffmpeg process that encodes
+    all of the outputs in one pass.
+    """
+    stream = ffmpeg.input("pipe:", format="image2pipe", framerate=fps).filter(
+        "fps", fps=fps, round="up"
     )
+    if len(outputs) > 1:
+        stream = stream.split()
+        streams = [stream[i] for i in range(len(outputs))]
+    else:
+        streams = [stream]
+    args = ffmpeg.merge_outputs(
+        *[
+            s.output(output, r=30, **_OUTPUT_ARGS.get(Path(output).suffix, {}))
+            for s, output in zip(streams, outputs)
+        ]
+    ).overwrite_output()
+
+    await _run_ffmpeg(args, frames)
+
+
+async def _concat_segments(segments: List[str], outputs: List[str]) -> None:
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as listing:
+        listing.writelines(f"file '{segment}'\n" for segment in segments)
+        listing.flush()
+        stream = ffmpeg.input(listing.name, format="concat", safe=0)
+        args = ffmpeg.merge_outputs(
+            *[
+                stream.output(
+                    output, **_CONCAT_OUTPUT_ARGS.get(Path(output).suffix, {})
+                )
+                for output in outputs
+            ]
+        ).overwrite_output()
+
+        await _run_ffmpeg(args)
+
+
+def _segments(files: List[Dict]) -> List[Tuple[int, int, Dict]]:
+    # The first and last timestep of each segment, in timestep order
+    segments = []
+    for f in files:
+        if match := SEGMENT_PATTERN.match(f["name"]):
+            segments.append((int(match.group(1)), int(match.group(2)), f))
+
+    return sorted(segments, key=lambda segment: segment[0])
+
+
+async def _default_frames(
+    gc,
+    id: str,
+    item: Dict,
+    steps: List[int],
+    progress: Callable[[int, int], None],
+    uploads: List[asyncio.Task],
+) -> AsyncIterator[bytes]:
+    # Renders the frames of the default movie, saving each one as a static image
+    # for fast-play as we go.
+    progress(0, len(steps))
+    # Close the renders promptly if the job is cancelled
+    async with aclosing(
+        render_frames(gc, id, steps, "jpeg", PlotDetails())
+    ) as rendered:
+        async for step, image in rendered:
+            time_step_item = await hierarchy.timestep_item(gc, id, step)
+            uploads.append(
+                asyncio.create_task(
+                    _save_file(
+                        gc, time_step_item["_id"], io.BytesIO(image), item, "jpeg"
+                    )
+                )
+            )
+            yield image
+            progress(steps.index(step) + 1, len(steps))
+
+
+async def _append_segment(
+    gc,
+    id: str,
+    item: Dict,
+    files: List[Dict],
+    timesteps: List[int],
+    progress: Callable[[int, int], None],
+) -> None:
+    # Encodes the timesteps after the last segment into a new segment
+    segments = _segments(files)
+    covered = segments[-1][1] if segments else None
+    steps = [t for t in timesteps if covered is None or t > covered]
+    if not steps:
+        return
 
+    uploads = []
+    with scratch.directory_for(prefix="segment") as output_dir:
+        segment = output_dir / "segment.ts"
+        try:
+            await _encode_movie(
+                _default_frames(gc, id, item, steps, progress, uploads),
+                [str(segment)],
+            )
+        finally:
+            await asyncio.gather(*uploads)
+        # Raises if the job was cancelled while the segment was encoded
+        progress(len(steps), len(steps))
+        with open(segment, "rb") as data:
+            await gc.upload_file(
+                item["meta"]["movieItemId"],
+                data,
+                f"segment-{steps[0]:06d}-{steps[-1]:06d}.ts",
+                os.path.getsize(segment),
+                parent_type="item",
+                mime_type="video/mp2t",
+            )
 
-def _build_movie(input: TempFile, output: TempFile) -> None:
-    ffmpeg.input(
-        os.path.join(input, "*.jpeg"), pattern_type="glob", framerate=10
-    ).filter("fps", fps=10, round="up").output(
-        output.name, **{"r": 30}
-    ).overwrite_output().run()
 
+async def _movies_cover(gc, movie_id: str, timesteps: List[int]) -> bool:
+    # The default movies record the last timestep they cover, movies without
+    # it are regenerated
+    last = (await gc.get_item(movie_id)).get("meta", {}).get("lastTimestep", None)
 
-def _cleanup() -> None:
-    # Make sure we don't start collecting temp movie files as they can get quite large
-    path = f"{tempfile.gettempdir()}/esimmon*"
-    for ext in ["mp4", "mpg"]:
-        [os.remove(f) for f in glob.glob(f"{path}.{ext}")]
+    return last is not None and (not timesteps or last >= max(timesteps))
 
 
 @router.get("/{id}/timesteps/movie", response_class=FileResponse)
@@ -90,103 +263,223 @@ async def create_movie(
     fps: Optional[str] = None,
     girder_token: str = Header(None),
 ) -> FileResponse:
-    # Clean up any old temp files that might be hanging around
-    _cleanup()
-
     # Get item information
     gc = get_girder_client(girder_token)
-    item = gc.getItem(id)
-    movie_id = gc.getItem(id)["meta"].get("movieItemId", None)
-    files = list(gc.listFile(movie_id)) if movie_id else []
+    item = (await hierarchy.variable(gc, id))["item"]
+    movie_id = item["meta"].get("movieItemId", None)
+    files = await gc.list_file(movie_id) if movie_id else []
 
     # Get all timesteps
-    timeSteps = item["meta"]["timesteps"]
+    timeSteps = await hierarchy.timesteps(gc, id)
     selectedTimeSteps = (
         json.loads(unquote(selectedTimeSteps)) if selectedTimeSteps else timeSteps
     )
 
     # Check if there are additional settings to apply
-    float(fps) if fps else 10.0
+    fps = float(fps) if fps else 10.0
     details = json.loads(unquote(details)) if details else {}
 
     found_exts = [os.path.splitext(f["name"])[-1] for f in files]
     if useDefault and f".{format}" in found_exts:
-        # The user is requesting the default movie, grab the pre-generated one
-        file_id = files[found_exts.index(f".{format}")]["_id"]
-        output_file = tempfile.NamedTemporaryFile(
-            prefix="esimmon", suffix=f".{format}", delete=False
-        )
-        gc.downloadFile(file_id, output_file.name)
-    else:
-        # This is a customized movie, generate it now
-        with tempfile.TemporaryDirectory(prefix="esimmon") as tmpdir:
-            for step in selectedTimeSteps:
-                if step not in timeSteps:
-                    continue
-                # call generate plot response and get plot
-                bytes_io = await _image_bytes(
-                    id, step, girder_token, True, "jpeg", details
-                )
-                im = Image.open(bytes_io, "r", ["JPEG"])
-                f = tempfile.NamedTemporaryFile(
-                    dir=tmpdir, prefix=f"{step}_", suffix=".jpeg", delete=False
+        default_file = files[found_exts.index(f".{format}")]
+        if (path := assetstore.path(default_file)) is not None:
+            return FileResponse(path=path, media_type=f"video/{format}")
+
+    # The movie is removed once it has been sent
+    stack = ExitStack()
+    output_dir = stack.enter_context(scratch.directory_for(prefix="movie"))
+    output_file = output_dir / f"movie.{format}"
+    try:
+        if useDefault and f".{format}" in found_exts:
+            # The user is requesting the default movie, grab the pre-generated one
+            await gc.download_file(default_file["_id"], str(output_file))
+        else:
+            # This is a customized movie, generate it now. It isn't saved, only
+            # the default movies are.
+            steps = [step for step in selectedTimeSteps if step in timeSteps]
+            frames = (
+                image
+                async for _, image in render_frames(
+                    gc, id, steps, "jpeg", PlotDetails(details)
                 )
-                im.save(f, "JPEG")
-            output_file = tempfile.NamedTemporaryFile(
-                prefix="esimmon", suffix=f".{format}", delete=False
             )
-            try:
-                _build_movie(tmpdir, output_file)
-                _save_file(gc, movie_id, output_file, item, format)
-            except ffmpeg.Error as e:
-                raise e
-    return FileResponse(path=output_file.name, media_type=f"video/{format}")
+            await _encode_movie(frames, [str(output_file)], fps)
+    except BaseException:
+        stack.close()
+        raise
 
+    return FileResponse(
+        path=output_file,
+        media_type=f"video/{format}",
+        background=BackgroundTask(stack.close),
+    )
 
-@router.put("/{id}/timesteps/movie")
-async def save_movie(
-    id: str,
-    formats: str,
-    girder_token: str = Header(None),
+
+async def _generate_movies(
+    gc, id: str, formats: List[str], progress: Callable[[int, int], None]
 ) -> None:
-    # Clean up any old temp files that might be hanging around
-    _cleanup()
+    # Stop any segment that is being encoded, the frames it would have
+    # covered are rendered here instead.
+    segment_job = movie_jobs.active(_segment_key(id))
+    if segment_job is not None:
+        movie_jobs.cancel(segment_job["id"])
+        # It may still be uploading a segment, which has to be in the list
+        await movie_jobs.wait(segment_job["id"], lambda: progress(0, None))
 
-    # Get item information
-    gc = get_girder_client(girder_token)
-    item = gc.getItem(id)
-    movie_id = gc.getItem(id)["meta"].get("movieItemId", None)
-    files = list(gc.listFile(movie_id)) if movie_id else []
-    formats = json.loads(unquote(formats))
+    # The run is complete, make sure we see all of the timesteps
+    item = (await hierarchy.variable(gc, id, refresh=True))["item"]
+    movie_id = item["meta"].get("movieItemId", None)
+    files = await gc.list_file(movie_id) if movie_id else []
 
     # Get all timesteps
     timeSteps = item["meta"]["timesteps"]
 
+    movies = [f for f in files if not SEGMENT_PATTERN.match(f["name"])]
+    if movies and not await _movies_cover(gc, movie_id, timeSteps):
+        # Timesteps have been added since the movies were generated
+        for f in movies:
+            await gc.delete(f"file/{f['_id']}")
+        files = [f for f in files if f not in movies]
+
     found_exts = [os.path.splitext(f["name"])[-1] for f in files]
     missing_exts = [f for f in formats if f".{f}" not in found_exts]
-    if missing_exts:
-        # We don't have the default movie(s) saved yet, generate them now
-        with tempfile.TemporaryDirectory(prefix="esimmon") as tmpdir:
-            img_bytes = []
-            for step in timeSteps:
-                # call generate plot response and get plot
-                bytes_io = await _image_bytes(id, step, girder_token, True, "jpeg", {})
-                # save the static images for fast-play
-                group_folder_id = get_group_folder_id(gc, id)
-                time_step_item = get_timestep_item(gc, group_folder_id, step)
-                _save_file(gc, time_step_item["_id"], bytes_io, item, "jpeg")
-                img_bytes.append(ffmpeg.input(bytes_io))
-                im = Image.open(bytes_io, "r", ["JPEG"])
-                f = tempfile.NamedTemporaryFile(
-                    dir=tmpdir, prefix=f"{step}_", suffix=".jpeg", delete=False
-                )
-                im.save(f, "JPEG")
-            for format in formats:
-                output_file = tempfile.NamedTemporaryFile(
-                    prefix="esimmon", suffix=f".{format}", delete=False
+    if not missing_exts:
+        return
+
+    # We don't have the default movie(s) saved yet, generate them now
+    segments = _segments(files)
+    with scratch.directory_for(prefix="movie") as output_dir:
+        output_files = [output_dir / f"movie.{format}" for format in missing_exts]
+        outputs = [str(f) for f in output_files]
+        if segments:
+            # Most of the movie was encoded while the run was in progress, only
+            # the frames after the last segment have to be rendered.
+            await _append_segment(gc, id, item, files, timeSteps, progress)
+            segments = _segments(await gc.list_file(movie_id))
+            paths = []
+            for _, _, f in segments:
+                # Segments in a locally mounted assetstore are read in place
+                if (path := assetstore.path(f)) is not None:
+                    paths.append(str(path))
+                    continue
+                paths.append(str(output_dir / f["name"]))
+                await gc.download_file(f["_id"], paths[-1])
+            await _concat_segments(paths, outputs)
+        else:
+            uploads = []
+            try:
+                await _encode_movie(
+                    _default_frames(gc, id, item, timeSteps, progress, uploads),
+                    outputs,
                 )
-                try:
-                    _build_movie(tmpdir, output_file)
-                    _save_file(gc, movie_id, output_file, item, format)
-                except ffmpeg.Error as e:
-                    raise e
+            finally:
+                await asyncio.gather(*uploads)
+
+        for format, output_file in zip(missing_exts, output_files):
+            await _save_file(gc, movie_id, output_file, item, format)
+    await gc.put(f"item/{movie_id}/metadata", json={"lastTimestep": max(timeSteps)})
+    # The segments aren't needed once the movies are saved
+    for _, _, f in segments:
+        await gc.delete(f"file/{f['_id']}")
+
+
+async def _generate_segment(
+    gc, id: str, last: int, progress: Callable[[int, int], None]
+) -> None:
+    item = (await hierarchy.variable(gc, id, refresh=True))["item"]
+    movie_id = item["meta"].get("movieItemId", None)
+    if movie_id is None:
+        return
+    files = await gc.list_file(movie_id)
+    timesteps = [t for t in item["meta"]["timesteps"] if t <= last]
+    if any(not SEGMENT_PATTERN.match(f["name"]) for f in files) and await _movies_cover(
+        gc, movie_id, timesteps
+    ):
+        # The movies have already been generated
+        return
+
+    await _append_segment(gc, id, item, files, timesteps, progress)
+
+
+@router.put("/{id}/timesteps/movie", status_code=202)
+async def save_movie(
+    id: str,
+    formats: str,
+    girder_token: str = Header(None),
+) -> Dict[str, Any]:
+    """
+    Queues a job that generates the default movies of a variable, poll the
+    returned job for its progress. A job that is already generating the movies
+    is returned rather than starting another. Formats that it isn't generating
+    are queued in a job that runs once it is done.
+    """
+    gc = get_girder_client(girder_token)
+    formats = json.loads(unquote(formats))
+
+    after = None
+    if (job := movie_jobs.active(_movies_key(id))) is not None:
+        if set(formats) <= set(job["formats"]):
+            return job
+        # Its movies are saved by the time the next job runs, which then only
+        # has to encode the other formats
+        after = job["id"]
+        formats = sorted(set(formats) | set(job["formats"]))
+
+    return movie_jobs.submit(
+        _movies_key(id),
+        partial(_generate_movies, gc, id, formats),
+        after=after,
+        variable_id=id,
+        formats=formats,
+    )
+
+
+@router.put("/{id}/timesteps/movie/segments", status_code=202)
+async def save_movie_segment(
+    id: str,
+    last: int,
+    girder_token: str = Header(None),
+) -> Dict[str, Any]:
+    """
+    Queues a job that encodes the frames of the default movie up to and
+    including timestep `last` that are not in a segment yet into a new one.
+    Generating the movies once the run is complete then only has to render the
+    remaining frames and join the segments.
+    """
+    gc = get_girder_client(girder_token)
+
+    return movie_jobs.submit(
+        _segment_key(id),
+        partial(_generate_segment, gc, id, last),
+        variable_id=id,
+        last=last,
+    )
+
+
+async def _movie_job(gc, id: str, job_id: str) -> Dict[str, Any]:
+    # Only those who can read the variable can see or cancel its jobs
+    await hierarchy.variable(gc, id)
+    job = movie_jobs.get(job_id)
+    if job is None or job["variable_id"] != id:
+        raise HTTPException(status_code=404, detail="Movie job not found.")
+
+    return job
+
+
+@router.get("/{id}/timesteps/movie/jobs/{job_id}")
+async def get_movie_job(
+    id: str, job_id: str, girder_token: str = Header(None)
+) -> Dict[str, Any]:
+    gc = get_girder_client(girder_token)
+
+    return await _movie_job(gc, id, job_id)
+
+
+@router.delete("/{id}/timesteps/movie/jobs/{job_id}")
+async def cancel_movie_job(
+    id: str, job_id: str, girder_token: str = Header(None)
+) -> Dict[str, Any]:
+    gc = get_girder_client(girder_token)
+    await _movie_job(gc, id, job_id)
+
+    return movie_jobs.cancel(job_id)
@@ -3,6 +3,17 @@ from typing import Dict
 import numpy as np
 from fastapi.responses import JSONResponse
 
+from .downsample import minmax_indices
+from .utils import MsgpackResponse
+
+PLOTLY_JSON_MEDIA_TYPE = "application/vnd.plotly.v1+json"
+# Same plot as the JSON response but with the x and y values sent as raw
+# little-endian typed arrays that are referenced by index from the traces.
+PLOTLY_MSGPACK_MEDIA_TYPE = "application/vnd.plotly.v1+msgpack"
+
+# dtypes that map onto JavaScript typed arrays, others are sent as float64
+_TYPED_ARRAY_DTYPES = ["f4", "f8", "i1", "i2", "i4", "u1", "u2", "u4"]
+
 
 def generate_data(x: np.ndarray, y: np.ndarray, name: str, plot_type: str):
     data = {
@@ -72,7 +83,9 @@ def generate_python_layout(title: str, x_label: str, y_label: str, plot_type: st
     return layout
 
 
-async def generate_plotly_response(plot_config: Dict, bp_file, variable: str):
+def generate_plotly_data(
+    plot_config: Dict, bp_file, variable: str, as_image: bool = True
+):
     x_variable = plot_config["x"]
     x_label = plot_config["xlabel"]
     y_variables = plot_config["y"]
@@ -81,13 +94,23 @@ async def generate_plotly_response(plot_config: Dict, bp_file, variable: str):
     plot_type = plot_config["type"]
 
     data = []
-    x = bp_file.read(x_variable).tolist()
+    # All of the series share the same x array
+    x = bp_file.read(x_variable)
 
     for y_variable, y_name in zip(y_variables, y_names):
-        y = bp_file.read(y_variable).tolist()
+        y = bp_file.read(y_variable)
         data.append(generate_data(x, y, y_name, plot_type)),
 
-    plotly_json = {
+    if as_image:
+        return {
+            "data": data,
+            "layout": generate_python_layout(
+                title=variable, x_label=x_label, y_label=y_label, plot_type=plot_type
+            ),
+            "type": plot_type,
+        }
+
+    return {
         "data": data,
         "layout": generate_js_layout(
             title=variable,
@@ -99,32 +122,74 @@ async def generate_plotly_response(plot_config: Dict, bp_file, variable: str):
         "type": "plotly",
     }
 
-    return JSONResponse(
-        media_type="application/vnd.plotly.v1+json", content=plotly_json
-    )
 
+def downsample_plotly_data(plotly_json: Dict, max_points: int) -> Dict:
+    traces = plotly_json["data"]
+    if not traces or any(t["type"] == "bar" for t in traces):
+        # Every bar is drawn, so there is nothing to reduce
+        return plotly_json
 
-async def generate_plotly_data(plot_config: Dict, bp_file, variable: str):
-    x_variable = plot_config["x"]
-    x_label = plot_config["xlabel"]
-    y_variables = plot_config["y"]
-    y_names = plot_config["yname"]
-    y_label = plot_config["ylabel"]
-    plot_type = plot_config["type"]
+    x = np.asarray(traces[0]["x"])
+    if any(len(t["x"]) != len(x) or len(t["y"]) != len(x) for t in traces):
+        return plotly_json
+
+    indices = minmax_indices([np.asarray(t["y"]) for t in traces], max_points)
+    # Keep a single x array shared by the series
+    x = x[indices]
+    data = [{**t, "x": x, "y": np.asarray(t["y"])[indices]} for t in traces]
 
+    return {**plotly_json, "data": data}
+
+
+def plotly_to_json(plotly_json: Dict) -> Dict:
     data = []
-    x = bp_file.read(x_variable).tolist()
+    for trace in plotly_json["data"]:
+        trace = dict(trace)
+        for axis in ["x", "y"]:
+            trace[axis] = np.asarray(trace[axis]).tolist()
+        data.append(trace)
 
-    for y_variable, y_name in zip(y_variables, y_names):
-        y = bp_file.read(y_variable).tolist()
-        data.append(generate_data(x, y, y_name, plot_type)),
+    return {**plotly_json, "data": data}
 
-    plotly_json = {
-        "data": data,
-        "layout": generate_python_layout(
-            title=variable, x_label=x_label, y_label=y_label, plot_type=plot_type
-        ),
-        "type": plot_type,
+
+def _typed_array(values) -> Dict:
+    values = np.asarray(values)
+    if values.dtype.str[1:] not in _TYPED_ARRAY_DTYPES:
+        values = values.astype(np.float64)
+    values = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("<"))
+
+    return {
+        "dtype": values.dtype.str,
+        "shape": list(values.shape),
+        "data": values.tobytes(),
     }
 
-    return plotly_json
+
+def plotly_to_typed_arrays(plotly_json: Dict) -> Dict:
+    arrays = []
+    # Keyed by id so that the shared x array is only sent once
+    indices = {}
+    data = []
+    for trace in plotly_json["data"]:
+        trace = dict(trace)
+        for axis in ["x", "y"]:
+            values = trace[axis]
+            if id(values) not in indices:
+                indices[id(values)] = len(arrays)
+                arrays.append(_typed_array(values))
+            trace[axis] = indices[id(values)]
+        data.append(trace)
+
+    return {**plotly_json, "data": data, "arrays": arrays}
+
+
+def generate_plotly_response(plotly_json: Dict, binary: bool = False):
+    if binary:
+        return MsgpackResponse(
+            media_type=PLOTLY_MSGPACK_MEDIA_TYPE,
+            content=plotly_to_typed_arrays(plotly_json),
+        )
+
+    return JSONResponse(
+        media_type=PLOTLY_JSON_MEDIA_TYPE, content=plotly_to_json(plotly_json)
+    )
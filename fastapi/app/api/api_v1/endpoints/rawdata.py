@@ -1,92 +1,228 @@
+import asyncio
 import json
-import shutil
-import tempfile
+from contextlib import ExitStack
+from contextlib import aclosing
+from pathlib import Path
+from typing import AsyncIterator
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import unquote
 
 import adios2 as adios
 import numpy as np
-from fastapi.responses import FileResponse
+from app.core.config import settings
+from app.core.scratch import scratch
+from starlette.responses import StreamingResponse
 
 from fastapi import APIRouter
 from fastapi import Header
+from fastapi import HTTPException
+from fastapi import Query
 
+from .hierarchy import hierarchy
+from .utils import ZIP_CHUNK_SIZE
 from .utils import get_girder_client
+from .utils import ordered_tasks
+from .utils import select_timesteps
+from .utils import stream_zip
 from .variables import download_bp_file
-from .variables import get_group_folder_id
-from .variables import get_timestep_item
 
 router = APIRouter()
 
 
 def _write_data(output: adios.File, name: str, data: np.array) -> None:
-    array = data
-    shape = list(array.shape)
-    count = [array.size]
-    start = [] if shape == [] else [0]
-    output.write(name, array, shape, start, count)
-
-
-def write_to_bp_file(output: adios.File, input: adios.File, variable: str) -> None:
+    shape = list(data.shape)
+    start = [0] * len(shape)
+    output.write(name, data, shape, start, shape)
+
+
+def _read_data(
+    input: adios.File, name: str, selection: Optional[Dict]
+) -> Optional[np.ndarray]:
+    # Only the selected box is read for arrays with as many dimensions as the
+    # selection, others are read whole.
+    shape = input.available_variables()[name]["Shape"]
+    shape = [int(n) for n in shape.split(",")] if shape else []
+    if selection is None or len(shape) != len(selection["start"]):
+        return input.read(name)
+
+    start = [min(s, n) for s, n in zip(selection["start"], shape)]
+    count = [min(c, n - s) for s, c, n in zip(start, selection["count"], shape)]
+    if not all(count):
+        # The box is outside of the array
+        return None
+
+    return input.read(name, start, count)
+
+
+def write_to_bp_file(
+    output: adios.File,
+    input: adios.File,
+    variable: str,
+    selection: Optional[Dict] = None,
+    geometry: bool = True,
+) -> None:
     plot_config = input.read_attribute_string(variable)
     if not output.read_attribute_string(variable):
         output.write_attribute(variable, plot_config)
     plot_config = json.loads(plot_config[0])
 
-    if x_variable := plot_config.get("x"):
-        x_data = input.read(x_variable)
-        _write_data(output, x_variable, x_data)
+    names = []
+    for key in ["x", "y", "color"]:
+        if name := plot_config.get(key):
+            names.extend(name if isinstance(name, list) else [name])
+    for name in names:
+        data = _read_data(input, name, selection)
+        if data is not None:
+            _write_data(output, name, data)
+
+    # The mesh doesn't change between timesteps, so it is only written with
+    # the first one and always in full.
+    if geometry:
+        for key in ["nodes", "connectivity"]:
+            if name := plot_config.get(key):
+                _write_data(output, name, input.read(name))
+    output.end_step()
 
-    if y_variable := plot_config.get("y"):
-        if not isinstance(y_variable, list):
-            y_variable = [y_variable]
-        for var in y_variable:
-            y_data = input.read(var)
-            _write_data(output, var, y_data)
 
-    if color_variable := plot_config.get("color"):
-        color_data = input.read(color_variable)
-        _write_data(output, color_variable, color_data)
+def _write_step(
+    output: adios.File,
+    bp_file_path: Path,
+    variable: str,
+    ts: int,
+    selection: Optional[Dict],
+    geometry: bool,
+) -> None:
+    output.write("time step", str(ts))
+    # Extract data from the BP file
+    with adios.open(str(bp_file_path), "r") as bp:
+        write_to_bp_file(output, bp, variable, selection, geometry)
+
+
+def _parse_selection(selection: Optional[str]) -> Optional[Dict]:
+    if selection is None:
+        return None
+
+    try:
+        selection = json.loads(unquote(selection))
+        start = [int(s) for s in selection["start"]]
+        count = [int(c) for c in selection["count"]]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid selection.")
+    if len(start) != len(count) or min(start + count, default=0) < 0:
+        raise HTTPException(status_code=400, detail="Invalid selection.")
+
+    return {"start": start, "count": count}
 
-    if connectivity_variable := plot_config.get("connectivity"):
-        connectivity_data = input.read(connectivity_variable)
-        _write_data(output, connectivity_variable, connectivity_data)
-    output.end_step()
+
+# The data file of the BP file, the writer only ever appends to it
+BP_DATA_FILE = "data.0"
+
+
+async def _write_steps(
+    gc,
+    output: Path,
+    variable_id: str,
+    variable: str,
+    time_steps: List[int],
+    selection: Optional[Dict],
+) -> AsyncIterator[bytes]:
+    def download(ts):
+        return download_bp_file(gc, variable_id, ts)
+
+    fh = await asyncio.to_thread(adios.open, str(output), "w")
+    with ExitStack() as stack:
+        data = None
+        try:
+            # The timesteps are downloaded concurrently, but have to be written
+            # to the output in order.
+            async with aclosing(
+                ordered_tasks(time_steps, download, settings.RAW_DATA_DOWNLOADS)
+            ) as downloads:
+                async for ts, task in downloads:
+                    bp_file_path = await task
+                    await asyncio.to_thread(
+                        _write_step,
+                        fh,
+                        bp_file_path,
+                        variable,
+                        ts,
+                        selection,
+                        ts == time_steps[0],
+                    )
+                    # Send what was written for this step while the later
+                    # ones are still downloading
+                    if data is None:
+                        data = stack.enter_context(open(output / BP_DATA_FILE, "rb"))
+                    while chunk := await asyncio.to_thread(data.read, ZIP_CHUNK_SIZE):
+                        yield chunk
+        finally:
+            await asyncio.to_thread(fh.close)
+
+        # Anything flushed when the file was closed
+        if data is None:
+            data = stack.enter_context(open(output / BP_DATA_FILE, "rb"))
+        while chunk := await asyncio.to_thread(data.read, ZIP_CHUNK_SIZE):
+            yield chunk
+
+
+async def _raw_data_files(
+    gc,
+    variable_id: str,
+    variable: str,
+    time_steps: List[int],
+    selection: Optional[Dict],
+) -> AsyncIterator[Tuple[str, Path | AsyncIterator[bytes]]]:
+    with scratch.directory_for(prefix="raw") as output_dir:
+        # One bp file per variable for all time steps, its data is streamed as
+        # each step is written and the metadata once it is complete.
+        output = output_dir / f"{variable}.bp"
+        yield BP_DATA_FILE, _write_steps(
+            gc, output, variable_id, variable, time_steps, selection
+        )
+
+        for path in sorted(output.rglob("*")):
+            if path.is_file() and path.name != BP_DATA_FILE:
+                yield str(path.relative_to(output)), path
 
 
 @router.get("/{variable_id}/timesteps/raw")
 async def get_raw_data(
     variable_id: str,
+    start: Optional[int] = None,
+    stop: Optional[int] = None,
+    stride: int = Query(1, ge=1),
+    selection: Optional[str] = None,
     girder_token: str = Header(None),
-) -> FileResponse:
+) -> StreamingResponse:
+    """
+    Exports the data of a variable as a single BP file with a step per
+    timestep, for the timesteps from `start` to `stop` (inclusive) every
+    `stride` steps. `selection` is a JSON object with the `start` and `count`
+    of a box, only that part of the arrays with as many dimensions is read
+    and exported. The mesh nodes and connectivity are written once, with the
+    first step.
+    """
     gc = get_girder_client(girder_token)
-    group_folder_id = get_group_folder_id(gc, variable_id)
+    selection = _parse_selection(selection)
 
-    # Get all timesteps
-    variable_item = gc.getItem(variable_id)
-    time_steps = variable_item["meta"]["timesteps"]
+    # Get the selected timesteps
+    time_steps = select_timesteps(
+        await hierarchy.timesteps(gc, variable_id), start, stop, stride
+    )
+    if not time_steps:
+        raise HTTPException(status_code=404, detail="No timesteps selected.")
 
     # Get the BP file name
-    group_folder = gc.getFolder(group_folder_id)
-    group_name = group_folder["name"]
-    variable = variable_item["name"]
+    variable = (await hierarchy.variable(gc, variable_id))["name"]
     bp_file_name = f"{variable}.bp"
 
-    # One bp file per variable for all time steps
-    output_dir = tempfile.mkdtemp(suffix=".bp")
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with adios.open(output_dir, "w") as fh:
-            for ts in time_steps:
-                fh.write("time step", str(ts))
-                get_timestep_item(gc, group_folder_id, ts)
-                # Get the BP file for the timestep
-                bp_file_path = await download_bp_file(
-                    gc, tmpdir, group_folder["_id"], group_name, ts
-                )
-                # Extract data from the BP file
-                with adios.open(str(bp_file_path), "r") as bp:
-                    write_to_bp_file(fh, bp, variable)
-        shutil.make_archive(bp_file_name, "zip", output_dir)
-
-    return FileResponse(
-        path=f"{bp_file_name}.zip", media_type=f"application/x-zip-compressed"
+    files = _raw_data_files(gc, variable_id, variable, time_steps, selection)
+
+    return StreamingResponse(
+        stream_zip(files),
+        media_type="application/x-zip-compressed",
+        headers={"Content-Disposition": f'attachment; filename="{bp_file_name}.zip"'},
     )
@@ -1,16 +1,19 @@
 from typing import Dict
 
+import numpy as np
+
+from .downsample import grid_indices
 from .utils import MsgpackResponse
 
 
-async def generate_scatter_data(plot_config: Dict, bp_file, variable: str):
+def generate_scatter_data(plot_config: Dict, bp_file, variable: str):
     x_variable = plot_config["x"]
     x_label = plot_config["xlabel"]
     y_variable = plot_config["y"]
     y_label = plot_config["ylabel"]
 
-    x = bp_file.read(x_variable).data
-    y = bp_file.read(y_variable).data
+    x = bp_file.read(x_variable)
+    y = bp_file.read(y_variable)
 
     return {
         "x": x,
@@ -22,6 +25,16 @@ async def generate_scatter_data(plot_config: Dict, bp_file, variable: str):
     }
 
 
-async def generate_scatter_response(plot_config: Dict, bp_file, variable: str):
-    scatter_json = await generate_scatter_data(plot_config, bp_file, variable)
+def downsample_scatter_data(scatter_json: Dict, max_points: int) -> Dict:
+    x = np.asarray(scatter_json["x"])
+    y = np.asarray(scatter_json["y"])
+    if x.shape != y.shape or x.ndim != 1:
+        return scatter_json
+
+    indices = grid_indices(x, y, max_points)
+
+    return {**scatter_json, "x": x[indices], "y": y[indices]}
+
+
+def generate_scatter_response(scatter_json: Dict) -> MsgpackResponse:
     return MsgpackResponse(content=scatter_json)
@@ -0,0 +1,86 @@
+import io
+from typing import Optional
+
+import numpy as np
+from app.core.assetstore import assetstore
+from app.core.cache import plot_cache
+from fastapi.responses import JSONResponse
+
+from fastapi import APIRouter
+from fastapi import Header
+from fastapi import HTTPException
+from fastapi import Query
+
+from .utils import VARY_NEGOTIATED
+from .utils import MsgpackResponse
+from .utils import get_girder_client
+from .utils import json_columns
+from .utils import select_timesteps
+
+router = APIRouter()
+
+# The sidecar ingest keeps on each variable item
+STATS_FILE_NAME = "stats.npy"
+STATS_FIELDS = ["min", "max", "mean", "nan_count", "histogram"]
+
+
+async def load_stats(gc, variable_id: str) -> np.ndarray:
+    for f in await gc.list_file(variable_id):
+        if f["name"] == STATS_FILE_NAME:
+            break
+    else:
+        raise HTTPException(status_code=404, detail="No statistics found.")
+
+    # The sidecar is rewritten as timesteps are ingested
+    key = ("stats", f["_id"], f["size"], f.get("sha512"), f.get("updated"))
+    stats = plot_cache.get(key)
+    if stats is None:
+        data = await assetstore.read_file(gc, f)
+        stats = np.load(io.BytesIO(data), allow_pickle=False)
+        plot_cache.set(key, stats)
+
+    return stats
+
+
+@router.get("/{variable_id}/timesteps/stats")
+async def get_timestep_stats(
+    variable_id: str,
+    start: Optional[int] = None,
+    stop: Optional[int] = None,
+    stride: int = Query(1, ge=1),
+    array: Optional[str] = None,
+    girder_token: str = Header(None),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Returns the min, max, mean, NaN count and histogram of each array of a
+    variable for the timesteps from `start` to `stop` (inclusive) every
+    `stride` steps, as computed at ingest. The histogram bins are evenly
+    spaced from the min to the max of the timestep. The columns are sent as
+    typed arrays when msgpack is accepted, the histograms as a steps by bins
+    uint32 array.
+    """
+    gc = get_girder_client(girder_token)
+    stats = await load_stats(gc, variable_id)
+    if array is not None and array.encode() not in stats["array"]:
+        raise HTTPException(status_code=404, detail=f"No statistics found for {array}.")
+
+    steps = select_timesteps(np.unique(stats["timestep"]).tolist(), start, stop, stride)
+    stats = stats[np.isin(stats["timestep"], steps)]
+    names = dict.fromkeys(stats["array"].tolist())
+    if array is not None:
+        names = [n for n in names if n.decode() == array]
+
+    content = {}
+    for name in names:
+        rows = stats[stats["array"] == name]
+        content[name.decode()] = {
+            "steps": rows["timestep"],
+            **{field: rows[field] for field in STATS_FIELDS},
+        }
+
+    headers = {"Vary": VARY_NEGOTIATED}
+    if "application/msgpack" in (accept or ""):
+        return MsgpackResponse(content=content, headers=headers)
+
+    return JSONResponse(content=json_columns(content), headers=headers)
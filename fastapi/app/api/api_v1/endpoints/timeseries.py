@@ -0,0 +1,211 @@
+import json
+from contextlib import aclosing
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import adios2 as adios
+import numpy as np
+from app.core.cache import plot_cache
+from app.core.executor import batch
+from app.core.executor import executor
+from app.schemas.timeseries import Field
+from app.schemas.timeseries import Reduction
+from fastapi.responses import JSONResponse
+
+from fastapi import APIRouter
+from fastapi import Header
+from fastapi import HTTPException
+from fastapi import Query
+
+from .hierarchy import hierarchy
+from .utils import VARY_NEGOTIATED
+from .utils import MsgpackResponse
+from .utils import get_girder_client
+from .utils import json_columns
+from .utils import ordered_tasks
+from .utils import select_timesteps
+from .variables import download_bp_file
+
+router = APIRouter()
+
+
+def _reduce(values: np.ndarray, reduction: str, index: Optional[int]) -> float:
+    if reduction == Reduction.value:
+        if not 0 <= index < values.size:
+            raise ValueError(f"Index {index} is out of range.")
+        return float(values[index])
+
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return np.nan
+    if reduction == Reduction.min:
+        return float(values.min())
+    elif reduction == Reduction.max:
+        return float(values.max())
+    elif reduction == Reduction.mean:
+        return float(values.mean())
+
+    return float(np.sqrt(np.dot(values, values)))
+
+
+def reduce_timestep(bp_file_path: str, variable: str, spec: Tuple) -> float:
+    """
+    Reduces one field of a variable's plot in a BP file to a single value,
+    only the arrays that are needed are read. Raises a KeyError if the
+    variable, or one of its arrays, isn't in the file.
+    """
+    field, series, reduction, index, x = spec
+    with adios.open(bp_file_path, "r") as bp:
+        plot_config = bp.read_attribute_string(variable)
+        if not plot_config:
+            raise KeyError(f"{variable} is not in the BP file.")
+        plot_config = json.loads(plot_config[0])
+        arrays = bp.available_variables()
+        names = plot_config.get(field)
+        if names is None:
+            raise ValueError(f"{variable} has no {field} values.")
+        if isinstance(names, list):
+            if not 0 <= series < len(names):
+                raise ValueError(f"{variable} has no series {series}.")
+            names = names[series]
+        if names not in arrays:
+            raise KeyError(f"{names} is not in the BP file.")
+        values = np.asarray(bp.read(names), dtype=np.float64).ravel()
+
+        if reduction != Reduction.sample:
+            return _reduce(values, reduction, index)
+
+        if plot_config.get("x") not in arrays:
+            raise KeyError(f"{variable} has no x values.")
+        xs = np.asarray(bp.read(plot_config["x"]), dtype=np.float64).ravel()
+        if len(xs) != len(values):
+            raise ValueError(f"The {field} values of {variable} can't be sampled.")
+        order = np.argsort(xs)
+
+        return float(np.interp(x, xs[order], values[order], left=np.nan, right=np.nan))
+
+
+async def _timeseries(
+    gc, variable_id: str, variable: str, steps: List[int], spec: Tuple
+) -> Dict[str, np.ndarray]:
+    # The values are cached as columns per variable and reduction, along with
+    # the BP file each one was read from. Only steps that haven't been reduced
+    # yet, or whose file has been ingested again since, are read.
+    key = ("timeseries", variable_id, variable, spec)
+    column = plot_cache.get(key) or {
+        "steps": np.empty(0, dtype=np.int64),
+        "values": np.empty(0, dtype=np.float64),
+        "files": np.empty(0, dtype=object),
+    }
+
+    async def file_id(step):
+        return await hierarchy.bp_file_id(gc, variable_id, int(step))
+
+    file_ids = {}
+    async with aclosing(
+        ordered_tasks(steps, file_id, 2 * executor.max_workers)
+    ) as tasks:
+        async for step, task in tasks:
+            file_ids[step] = await task
+    reduced = dict(zip(column["steps"].tolist(), column["files"].tolist()))
+    missing = [step for step in steps if reduced.get(step) != file_ids[step]]
+    if missing:
+
+        async def reduce(step):
+            # Wait for a worker rather than failing the series on a busy server
+            with batch():
+                bp_file_path = await download_bp_file(gc, variable_id, step)
+                return await executor.run(
+                    reduce_timestep, str(bp_file_path), variable, spec
+                )
+
+        values = []
+        async with aclosing(
+            ordered_tasks(missing, reduce, 2 * executor.max_workers)
+        ) as tasks:
+            async for _, task in tasks:
+                try:
+                    values.append(await task)
+                except KeyError as e:
+                    raise HTTPException(status_code=404, detail=e.args[0])
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+
+        # Merge with whatever other requests have added in the meantime
+        column = plot_cache.get(key) or column
+        merged = {
+            step: (value, file)
+            for step, value, file in zip(
+                column["steps"].tolist(),
+                column["values"].tolist(),
+                column["files"].tolist(),
+            )
+        }
+        merged.update(
+            (step, (value, file_ids[step])) for step, value in zip(missing, values)
+        )
+        order = sorted(merged)
+        column = {
+            "steps": np.array(order, dtype=np.int64),
+            "values": np.array([merged[s][0] for s in order], dtype=np.float64),
+            "files": np.array([merged[s][1] for s in order], dtype=object),
+        }
+        plot_cache.set(key, column)
+
+    return column
+
+
+@router.get("/{variable_id}/timeseries")
+async def get_timeseries(
+    variable_id: str,
+    field: Field = Field.color,
+    reduction: Reduction = Reduction.max,
+    series: int = 0,
+    index: Optional[int] = None,
+    x: Optional[float] = None,
+    start: Optional[int] = None,
+    stop: Optional[int] = None,
+    stride: int = Query(1, ge=1),
+    girder_token: str = Header(None),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Reduces a field of a variable to one value per timestep, for the
+    timesteps from `start` to `stop` (inclusive) every `stride` steps.
+    `value` returns the value at `index` and `sample` the y values linearly
+    interpolated at `x`. The values are returned as columns, and as float64
+    arrays when msgpack is accepted.
+    """
+    if reduction == Reduction.value and index is None:
+        raise HTTPException(status_code=400, detail="An index is required.")
+    if reduction == Reduction.sample and (x is None or field != Field.y):
+        raise HTTPException(
+            status_code=400, detail="Sampling requires the y field and an x value."
+        )
+
+    gc = get_girder_client(girder_token)
+    item = (await hierarchy.variable(gc, variable_id))["item"]
+    variable = item["name"]
+    timesteps = item["meta"]["timesteps"]
+    times = item["meta"].get("time", [])
+    time = dict(zip(timesteps, times)) if len(times) == len(timesteps) else {}
+
+    steps = select_timesteps(timesteps, start, stop, stride)
+    spec = (field.value, series, reduction.value, index, x)
+    column = await _timeseries(gc, variable_id, variable, steps, spec)
+
+    selected = np.searchsorted(column["steps"], steps)
+    values = column["values"][selected]
+    content = {
+        "steps": np.asarray(steps, dtype=np.int64),
+        "time": np.array([time.get(s, np.nan) for s in steps], dtype=np.float64),
+        "values": values,
+    }
+
+    headers = {"Vary": VARY_NEGOTIATED}
+    if "application/msgpack" in (accept or ""):
+        return MsgpackResponse(content=content, headers=headers)
+
+    return JSONResponse(content=json_columns(content), headers=headers)
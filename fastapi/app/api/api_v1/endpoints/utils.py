@@ -1,36 +1,220 @@
+import asyncio
+import hashlib
+import time
+import zipfile
+from collections import deque
+from contextlib import aclosing
+from itertools import islice
+from pathlib import Path
 from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
 
 import msgpack
+import numpy as np
 from app.core.config import settings
-from girder_client import GirderClient
+from app.core.girder import AsyncGirderClient
+from app.core.girder import get_session
 
 from fastapi import HTTPException
 from fastapi import Response
 
-cache_settings = {
-    "directory": "/tmp/cache",
-    "eviction_policy": "least-frequently-used",
-    "size_limit": 2**20,  # 1g
-}
 
-_gc = None
-
-
-def get_girder_client(girder_token):
+def get_girder_client(girder_token) -> AsyncGirderClient:
     if girder_token is None:
         raise HTTPException(status_code=400, detail="Invalid token.")
 
-    global _gc
-    if _gc is None:
-        _gc = GirderClient(apiUrl=settings.GIRDER_API_URL, cacheSettings=cache_settings)
+    return AsyncGirderClient(get_session(), settings.GIRDER_API_URL, girder_token)
 
-    _gc.setToken(girder_token)
 
-    return _gc
+def _encode_array(obj: Any) -> Any:
+    # Arrays are sent as their raw bytes
+    if isinstance(obj, np.ndarray):
+        return obj.tobytes()
+    raise TypeError(f"Cannot serialize {type(obj)}")
 
 
 class MsgpackResponse(Response):
     media_type = "application/msgpack"
 
     def render(self, content: Any) -> bytes:
-        return msgpack.packb(content)
+        return msgpack.packb(content, default=_encode_array)
+
+
+def json_columns(content: Any) -> Any:
+    # Arrays as lists, with NaN (which isn't valid JSON) as null
+    if isinstance(content, dict):
+        return {k: json_columns(v) for k, v in content.items()}
+    if isinstance(content, np.ndarray):
+        if content.dtype.kind == "f":
+            return np.where(np.isnan(content), None, content).tolist()
+        return content.tolist()
+
+    return content
+
+
+def file_etag(file: Dict, *details) -> str:
+    # A file is never modified once it has been ingested, so its id (and
+    # checksum when Girder has one) along with the details of how the
+    # response was built from it is enough to identify the response.
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((file["_id"], file.get("sha512"), *details)).encode())
+
+    return f'"{h.hexdigest()}"'
+
+
+def content_etag(content: Any) -> str:
+    h = hashlib.blake2b(msgpack.packb(content), digest_size=16)
+
+    return f'"{h.hexdigest()}"'
+
+
+# Girder decides who can read what, so responses are cached per token, and per
+# format for the ones that pick it from the Accept header
+VARY = "Girder-Token"
+VARY_NEGOTIATED = "Girder-Token, Accept"
+
+
+def cache_headers(
+    etag: str, immutable: bool = True, negotiated: bool = False
+) -> Dict[str, str]:
+    if immutable:
+        cache_control = f"public, max-age={settings.HTTP_CACHE_MAX_AGE}, immutable"
+    else:
+        # Can be stored but has to be revalidated every time
+        cache_control = "public, no-cache"
+
+    vary = VARY_NEGOTIATED if negotiated else VARY
+    return {"ETag": etag, "Cache-Control": cache_control, "Vary": vary}
+
+
+def not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+# Formats that are already compressed, deflating them again is wasted effort
+COMPRESSED_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4", ".gz", ".tgz"}
+
+
+class _ZipBuffer:
+    # Write-only, unseekable file object, so zipfile writes data descriptors
+    # and never has to go back to patch a header that has already been sent.
+    def __init__(self) -> None:
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def select_timesteps(
+    timesteps: List[int],
+    start: Optional[int] = None,
+    stop: Optional[int] = None,
+    stride: int = 1,
+) -> List[int]:
+    # The timesteps from start to stop (inclusive), every stride steps
+    return [
+        t
+        for t in sorted(timesteps)
+        if (start is None or t >= start) and (stop is None or t <= stop)
+    ][::stride]
+
+
+# Files are added to a zip in chunks of this size
+ZIP_CHUNK_SIZE = 2**20
+
+
+async def ordered_tasks(
+    items: Iterable, func: Callable[[Any], Awaitable], window: int
+) -> AsyncIterator[Tuple[Any, asyncio.Task]]:
+    """
+    Runs `func` on up to `window` of the items at once, yielding each item
+    with its task in the order of the items. Moving on from a task lets the
+    next item start, and the tasks that are still pending are cancelled when
+    the iteration stops early.
+    """
+    remaining = iter(items)
+    pending = deque()
+
+    def schedule():
+        for item in islice(remaining, window - len(pending)):
+            pending.append((item, asyncio.create_task(func(item))))
+
+    try:
+        schedule()
+        while pending:
+            item, task = pending[0]
+            yield item, task
+            pending.popleft()
+            schedule()
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+
+async def _file_chunks(path: Path) -> AsyncIterator[bytes]:
+    with open(path, "rb") as fp:
+        while chunk := await asyncio.to_thread(fp.read, ZIP_CHUNK_SIZE):
+            yield chunk
+
+
+async def stream_zip(
+    entries: AsyncIterator[Tuple[str, Union[bytes, Path, AsyncIterator[bytes]]]]
+) -> AsyncIterator[bytes]:
+    """
+    Builds a zip file from (name, data) entries as they arrive, yielding the
+    bytes of each entry as soon as it has been added. The data is either the
+    content of the entry, the path of a file, which is read in chunks, or an
+    iterator of the chunks of the content.
+    """
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, "w") as zip_obj:
+        async for name, data in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.external_attr = 0o644 << 16
+            if Path(name).suffix.lower() in COMPRESSED_SUFFIXES:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            if isinstance(data, bytes):
+                zip_obj.writestr(info, data)
+                yield buffer.drain()
+                continue
+
+            if isinstance(data, Path):
+                data = _file_chunks(data)
+            # The size isn't known up front, so allow for large files
+            async with aclosing(data) as chunks:
+                with zip_obj.open(info, "w", force_zip64=True) as entry:
+                    async for chunk in chunks:
+                        await asyncio.to_thread(entry.write, chunk)
+                        yield buffer.drain()
+            yield buffer.drain()
+
+    # The central directory
+    yield buffer.drain()
@@ -1,137 +1,217 @@
+import asyncio
 import json
-import tarfile
 import tempfile
 from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 import adios2
+from app.core.assetstore import assetstore
+from app.core.cache import bp_cache
+from app.core.cache import plot_cache
+from app.core.config import settings
+from app.core.executor import executor
+from app.core.prefetch import Prefetcher
 from app.schemas.format import PlotFormat
+from app.schemas.plots import BatchPlotRequest
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse
 
 from fastapi import APIRouter
 from fastapi import Header
 from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Response
 
 from .colormap import generate_colormap_data
 from .colormap import generate_colormap_response
+from .hierarchy import hierarchy
+from .hierarchy import is_indexed
 from .mesh import generate_mesh_data
 from .mesh import generate_mesh_response
+from .mesh import ingested_geometry_hash
+from .mesh import mesh_geometry
+from .mesh import mesh_without_geometry
+from .plotly import PLOTLY_MSGPACK_MEDIA_TYPE
+from .plotly import downsample_plotly_data
 from .plotly import generate_plotly_data
 from .plotly import generate_plotly_response
+from .plotly import plotly_to_json
+from .plotly import plotly_to_typed_arrays
+from .scatter import downsample_scatter_data
 from .scatter import generate_scatter_data
 from .scatter import generate_scatter_response
+from .utils import MsgpackResponse
+from .utils import cache_headers
+from .utils import content_etag
+from .utils import file_etag
 from .utils import get_girder_client
+from .utils import not_modified
 
 router = APIRouter()
 
+_downloads = {}
 
-def get_group_folder_id(gc, variable_item_id):
-    return gc.getItem(variable_item_id)["folderId"]
 
+async def _download_and_extract(gc, variable_id: str, bp_file: Dict) -> Path:
+    # Archives in a locally mounted assetstore are extracted in place
+    if (bp_path := assetstore.path(bp_file)) is not None:
+        return await executor.run(bp_cache.add, bp_file["_id"], bp_path)
 
-def get_timestep_folder_id(gc, group_folder_id):
-    return next(
-        gc.listFolder(group_folder_id, parentFolderType="folder", name="timesteps")
-    )["_id"]
-
-
-def get_run_folder_id(gc, group_folder_id):
-    return gc.getFolder(group_folder_id)["parentId"]
-
-
-def get_timesteps_folder_id(gc, group_folder_id):
-    run_folder_id = get_run_folder_id(gc, group_folder_id)
-
-    timesteps_folder = list(gc.listFolder(run_folder_id, name="timesteps"))
-    if len(timesteps_folder) != 1:
-        raise HTTPException(status_code=404, detail="Timesteps folder not found.")
-
-    return timesteps_folder[0]["_id"]
-
-
-def get_timestep_item(gc, group_folder_id, timestep):
-    timesteps_folder_id = get_timesteps_folder_id(gc, group_folder_id)
-
-    timestep_item = list(gc.listItem(timesteps_folder_id, name=f"{timestep:04}"))
-    if len(timestep_item) != 1:
-        raise HTTPException(status_code=404, detail="Timestep not found.")
-
-    return timestep_item[0]
-
-
-def get_timestep_bp_file_id(gc, group_folder_id, group_name, timestep):
-    timestep_item = get_timestep_item(gc, group_folder_id, timestep)
-
-    # FIXME: This is a temporary hack to allow us to test the performance plots
-    # This block should be removed once those bp filenames are fixed.
-    filename = f"{group_name}.bp.tgz"
-    alt_filename = (
-        f"{('').join(group_name.split())}-{timestep_item['name'].lstrip('0')}.bp.tgz"
-    )
-
-    for bp_file in gc.listFile(timestep_item["_id"]):
-        if bp_file["name"] == filename or bp_file["name"] == alt_filename:
-            return bp_file["_id"]
-
-    raise HTTPException(status_code=404, detail="Unable to locate BP file.")
-
-
-async def download_bp_file(
-    gc, output_dir: str, group_folder_id: str, group_name: str, timestep: int
-):
-    file_id = get_timestep_bp_file_id(gc, group_folder_id, group_name, timestep)
-
-    bp_path = Path(output_dir) / f"{group_name}.bp.tgz"
-    gc.downloadFile(file_id, str(bp_path))
-    tar = tarfile.open(bp_path)
-    # Get the name of the BP file
-    bp_filename = tar.getnames()[0]
-    # Extract contents
-    tar.extractall(output_dir)
-    tar.close()
-
-    return Path(output_dir) / bp_filename
-
-
-async def generate_plot_response(bp, variable: str):
+    group_name = (await hierarchy.variable(gc, variable_id))["groupName"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bp_path = Path(tmpdir) / f"{group_name}.bp.tgz"
+        await gc.download_file(bp_file["_id"], str(bp_path))
+        return await executor.run(bp_cache.add, bp_file["_id"], bp_path)
+
+
+async def _bp_index_entry(gc, variable_id: str, timestep: int, bp_file: Dict) -> Dict:
+    index_file = await hierarchy.bp_index_file(gc, variable_id, timestep, bp_file)
+    key = ("bp-index", index_file["_id"])
+    if (index := plot_cache.get(key)) is None:
+        index = json.loads(await assetstore.read_file(gc, index_file))
+        plot_cache.set(key, index)
+
+    variable = (await hierarchy.variable(gc, variable_id))["name"]
+    if (entry := index["plots"].get(variable)) is None:
+        raise HTTPException(
+            status_code=404, detail="Unable to locate plot data in BP file."
+        )
+
+    return entry
+
+
+async def _download_members(gc, bp_file: Dict, key: str, entry: Dict) -> Path:
+    # The files of a plot are stored one after the other, so a single range
+    # request fetches all of them.
+    start = entry["offset"]
+    data = await assetstore.read_file(gc, bp_file, start, start + entry["size"])
+    members = [
+        (name, data[offset - start : offset - start + size])
+        for name, offset, size in entry["members"]
+    ]
+
+    return await executor.run(bp_cache.add_members, key, entry["path"], members)
+
+
+async def download_bp_file(gc, variable_id: str, timestep: int) -> Path:
+    bp_file = await hierarchy.bp_file(gc, variable_id, timestep)
+    key, entry = bp_file["_id"], None
+    if is_indexed(bp_file):
+        # Only the requested plot is read from an indexed archive
+        entry = await _bp_index_entry(gc, variable_id, timestep, bp_file)
+        key = f"{bp_file['_id']}.{entry['path']}"
+
+    # Check if the archive has already been extracted
+    if bp_file_path := bp_cache.get(key):
+        return bp_file_path
+
+    # Concurrent requests for the same archive share a single download
+    if key not in _downloads:
+        if entry is None:
+            download = _download_and_extract(gc, variable_id, bp_file)
+        else:
+            download = _download_members(gc, bp_file, key, entry)
+        _downloads[key] = asyncio.create_task(download)
+    try:
+        return await asyncio.shield(_downloads[key])
+    finally:
+        _downloads.pop(key, None)
+
+
+def generate_plot_data(
+    bp, variable: str, as_image: bool = True, known_hash: Optional[str] = None
+) -> Dict:
     plot_config = bp.read_attribute_string(variable)
     plot_config = json.loads(plot_config[0])
 
     plot_type = plot_config["type"]
+
     if plot_type in PlotFormat.plotly:
-        return await generate_plotly_response(plot_config, bp, variable)
+        return generate_plotly_data(plot_config, bp, variable, as_image)
     elif plot_type == PlotFormat.mesh:
-        return await generate_mesh_response(plot_config, bp, variable)
+        return generate_mesh_data(plot_config, bp, variable, known_hash)
     elif plot_type == PlotFormat.colormap:
-        return await generate_colormap_response(plot_config, bp, variable)
+        return generate_colormap_data(plot_config, bp, variable)
     elif plot_type == PlotFormat.scatter:
-        return await generate_scatter_response(plot_config, bp, variable)
-
-    raise HTTPException(status_code=400, detail="Unsupported plot type.")
-
+        return generate_scatter_data(plot_config, bp, variable)
+
+    raise ValueError("Unsupported plot type.")
+
+
+def read_plot_data(
+    bp_file_path: str,
+    variable: str,
+    as_image: bool = True,
+    known_hash: Optional[str] = None,
+) -> Optional[Dict]:
+    # This is run on the executor, so it opens the BP file itself
+    with adios2.open(bp_file_path, "r") as bp:
+        if not bp.read_attribute_string(variable):
+            # Variable does not exist in BP file
+            return None
+        return generate_plot_data(bp, variable, as_image, known_hash)
+
+
+def read_plots_data(
+    bp_file_path: str, variables: List[str], as_image: bool = True
+) -> List[Optional[Dict]]:
+    # Several variables of a group share the same archive, so open it once
+    plots = []
+    with adios2.open(bp_file_path, "r") as bp:
+        for variable in variables:
+            try:
+                if not bp.read_attribute_string(variable):
+                    plots.append(None)
+                    continue
+                plots.append(generate_plot_data(bp, variable, as_image))
+            except Exception:
+                plots.append(None)
+
+    return plots
+
+
+def downsample_plot_data(plot_data: Dict, max_points: int) -> Dict:
+    plot_type = plot_data["type"]
+    if plot_type == "plotly" or plot_type in PlotFormat.plotly:
+        return downsample_plotly_data(plot_data, max_points)
+    elif plot_type == PlotFormat.scatter:
+        return downsample_scatter_data(plot_data, max_points)
 
-async def generate_plot_data(bp, variable: str):
-    plot_config = bp.read_attribute_string(variable)
-    plot_config = json.loads(plot_config[0])
+    # Meshes and colormaps are sent as is
+    return plot_data
 
-    plot_type = plot_config["type"]
 
-    if plot_type in PlotFormat.plotly:
-        return await generate_plotly_data(plot_config, bp, variable)
+def generate_plot_response(
+    plot_data: Dict, accept: Optional[str] = None, geometry: bool = True
+) -> Response:
+    plot_type = plot_data["type"]
+    if plot_type == "plotly":
+        # Typed arrays are only sent to clients that ask for them
+        binary = PLOTLY_MSGPACK_MEDIA_TYPE in (accept or "")
+        return generate_plotly_response(plot_data, binary)
     elif plot_type == PlotFormat.mesh:
-        return await generate_mesh_data(plot_config, bp, variable)
+        return generate_mesh_response(plot_data, geometry)
     elif plot_type == PlotFormat.colormap:
-        return await generate_colormap_data(plot_config, bp, variable)
+        return generate_colormap_response(plot_data)
     elif plot_type == PlotFormat.scatter:
-        return await generate_scatter_data(plot_config, bp, variable)
+        return generate_scatter_response(plot_data)
 
     raise HTTPException(status_code=400, detail="Unsupported plot type.")
 
 
 @router.get("/{variable_id}/timesteps/meta")
-async def get_timesteps(variable_id: str, girder_token: str = Header(None)):
+async def get_timesteps(
+    variable_id: str,
+    girder_token: str = Header(None),
+    if_none_match: str = Header(None),
+):
     gc = get_girder_client(girder_token)
 
-    item = gc.getItem(variable_id)
+    item = await gc.get_item(variable_id)
     meta = {"steps": item["meta"]["timesteps"], "time": item["meta"]["time"]}
 
     if x_range := item["meta"].get("x_range", None):
@@ -141,19 +221,182 @@ async def get_timesteps(variable_id: str, girder_token: str = Header(None)):
     if color_range := item["meta"].get("color_range", None):
         meta["color_range"] = color_range
 
-    return meta
+    # Timesteps are added during a run, so this has to be revalidated
+    headers = cache_headers(content_etag(meta), immutable=False)
+    if not_modified(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(content=meta, headers=headers)
 
 
-def _check_for_static_image(gc, item_id: str, variable: str) -> FileResponse | bool:
-    for f in gc.listFile(item_id):
+async def _find_static_image(
+    gc, variable_id: str, timestep: int, variable: str
+) -> Optional[Dict]:
+    for f in await hierarchy.timestep_files(gc, variable_id, timestep):
         # FIXME: Temporary fix with badly named static image examples.
         # Images should be named {attribute_name}.{ext} going forward
         options = [Path(f["name"]).stem, Path(f["name"]).stem.replace(".", "_")]
         if any([variable in o for o in options]):
-            ext = Path(f["name"]).suffix.strip(".")
-            out = tempfile.NamedTemporaryFile(suffix=ext, delete=False)
-            gc.downloadFile(f["_id"], out.name)
-            return FileResponse(path=out.name, media_type=f"image/{ext}")
+            return f
+
+
+async def _check_for_static_image(
+    gc, variable_id: str, timestep: int, variable: str
+) -> FileResponse | bool:
+    if f := await _find_static_image(gc, variable_id, timestep, variable):
+        ext = Path(f["name"]).suffix.strip(".")
+        if (path := assetstore.path(f)) is not None:
+            return FileResponse(path=path, media_type=f"image/{ext}")
+        out = tempfile.NamedTemporaryFile(suffix=ext, delete=False)
+        await gc.download_file(f["_id"], out.name)
+        return FileResponse(path=out.name, media_type=f"image/{ext}")
+
+
+async def plot_source(
+    gc, variable_id: str, timestep: int, as_image: bool = False
+) -> Optional[Dict]:
+    """
+    The Girder file the plot of a timestep is built from, either the BP file
+    or a static image. Its id is known without downloading anything.
+    """
+    variable = (await hierarchy.variable(gc, variable_id))["name"]
+    if as_image and (
+        f := await _find_static_image(gc, variable_id, timestep, variable)
+    ):
+        return f
+    try:
+        return await hierarchy.bp_file(gc, variable_id, timestep)
+    except HTTPException:
+        return await _find_static_image(gc, variable_id, timestep, variable)
+
+
+async def _downsample(key: Tuple, plot_data: Dict, max_points: Optional[int]) -> Dict:
+    # The reduced data is cached separately for each resolution
+    if max_points is None:
+        return plot_data
+    if reduced := plot_cache.get((*key, max_points)):
+        return reduced
+
+    reduced = await executor.run(downsample_plot_data, plot_data, max_points)
+    plot_cache.set((*key, max_points), reduced)
+
+    return reduced
+
+
+async def _known_geometry_hash(
+    gc, variable_id: str, timestep: int, file_id: str, variable: str
+) -> Optional[str]:
+    if known_hash := plot_cache.get(("geometry", file_id, variable)):
+        return known_hash
+
+    item_meta = (await hierarchy.variable(gc, variable_id))["item"]["meta"]
+    return ingested_geometry_hash(item_meta, timestep)
+
+
+async def load_plot_data(
+    gc,
+    variable_id: str,
+    timestep: int,
+    as_image: bool = False,
+    max_points: Optional[int] = None,
+    geometry: bool = True,
+) -> Optional[Dict]:
+    """
+    With `geometry=False` a mesh may be returned without its nodes and
+    connectivity, if its geometry hash is already known.
+    """
+    variable = (await hierarchy.variable(gc, variable_id))["name"]
+    file_id = await hierarchy.bp_file_id(gc, variable_id, timestep)
+
+    key = (file_id, variable, as_image)
+    if max_points is not None and (plot_data := plot_cache.get((*key, max_points))):
+        return plot_data
+    if (plot_data := plot_cache.get(key)) is not None:
+        return await _downsample(key, plot_data, max_points)
+
+    known_hash = None
+    if not geometry and not as_image:
+        color_key = (*key, "color")
+        if (plot_data := plot_cache.get(color_key)) is not None:
+            return plot_data
+        known_hash = await _known_geometry_hash(
+            gc, variable_id, timestep, file_id, variable
+        )
+
+    bp_file_path = await download_bp_file(gc, variable_id, timestep)
+    try:
+        # Extract data from the BP file
+        plot_data = await executor.run(
+            read_plot_data, str(bp_file_path), variable, as_image, known_hash
+        )
+    except HTTPException:
+        raise
+    except Exception:
+        return None
+
+    if plot_data is None:
+        return None
+    if plot_data["type"] == PlotFormat.mesh and "nodes" not in plot_data:
+        plot_cache.set(color_key, plot_data)
+        return plot_data
+    if plot_data["type"] == PlotFormat.mesh:
+        # So later requests for this step don't have to read the geometry
+        plot_cache.set(("geometry", file_id, variable), plot_data["geometryHash"])
+    plot_cache.set(key, plot_data)
+
+    return await _downsample(key, plot_data, max_points)
+
+
+def _max_points(max_points: Optional[int], pixel_width: Optional[int]) -> Optional[int]:
+    if max_points is None and pixel_width is not None:
+        # A minimum and maximum per pixel is all that can be drawn
+        return 2 * pixel_width
+
+    return max_points
+
+
+prefetcher = Prefetcher(
+    Path(settings.CACHE_DIRECTORY) / "prefetch", settings.PREFETCH_DEPTH, load_plot_data
+)
+
+
+async def fetch_timestep_plot(
+    gc,
+    variable_id: str,
+    timestep: int,
+    as_image: bool = False,
+    max_points: Optional[int] = None,
+    geometry: bool = True,
+) -> Dict | FileResponse:
+    # Get the variable name (the item name)
+    variable = (await hierarchy.variable(gc, variable_id))["name"]
+
+    if as_image:
+        # Prefer a static image if one was provided
+        resp = await _check_for_static_image(gc, variable_id, timestep, variable)
+        if resp:
+            return resp
+
+    try:
+        plot_data = await load_plot_data(
+            gc, variable_id, timestep, as_image, max_points, geometry
+        )
+    except HTTPException as e:
+        if e.status_code == 503:
+            raise
+        # Unable to locate the BP file
+        plot_data = None
+
+    if plot_data is None:
+        # Look for static image instead
+        resp = await _check_for_static_image(gc, variable_id, timestep, variable)
+        if resp:
+            return resp
+        raise HTTPException(
+            status_code=404, detail="Unable to locate BP file or static image."
+        )
+
+    return plot_data
 
 
 # variable_id => Girder item id for item used to represent the variable.
@@ -162,49 +405,172 @@ async def get_timestep_plot(
     variable_id: str,
     timestep: int,
     girder_token: str = Header(None),
+    accept: str = Header(None),
+    if_none_match: str = Header(None),
     as_image: bool = False,
+    max_points: Optional[int] = Query(None, gt=2),
+    pixel_width: Optional[int] = Query(None, gt=0),
+    geometry: bool = True,
 ):
+    """
+    Returns the plot data for a timestep. With `max_points` (or `pixel_width`,
+    the width of the plot on screen) line plots are reduced to the minimum and
+    maximum of each series over buckets of samples, and scatter plots to one
+    point per cell of a grid, before they are sent.
+
+    Meshes always carry a `geometryHash`, with `geometry=false` the nodes and
+    connectivity are left out and should be fetched from the geometry endpoint
+    whenever the hash changes.
+    """
     gc = get_girder_client(girder_token)
-    group_folder_id = get_group_folder_id(gc, variable_id)
-    time_step_item = get_timestep_item(gc, group_folder_id, timestep)
-    # Get the variable name (the item name)
-    variable_item = gc.getItem(variable_id)
-    variable = variable_item["name"]
+    max_points = _max_points(max_points, pixel_width)
+
+    # Start loading the following timesteps if this is sequential playback
+    timesteps = await hierarchy.timesteps(gc, variable_id)
+    prefetcher.record(
+        gc,
+        variable_id,
+        timestep,
+        timesteps,
+        as_image=as_image,
+        max_points=max_points,
+        geometry=geometry,
+    )
 
-    # Get the BP file for the timestep
-    group_folder = gc.getFolder(group_folder_id)
-    group_name = group_folder["name"]
-    f"{group_name}.bp.tgz"
+    headers = {}
+    if source := await plot_source(gc, variable_id, timestep, as_image):
+        binary = PLOTLY_MSGPACK_MEDIA_TYPE in (accept or "")
+        etag = file_etag(source, variable_id, as_image, max_points, geometry, binary)
+        headers = cache_headers(etag, negotiated=True)
+        if not_modified(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        try:
-            bp_file_path = await download_bp_file(
-                gc, tmpdir, group_folder["_id"], group_name, timestep
-            )
-        except HTTPException:
-            resp = _check_for_static_image(gc, time_step_item["_id"], variable)
-            if resp:
-                return resp
+    plot_data = await fetch_timestep_plot(
+        gc, variable_id, timestep, as_image, max_points, geometry
+    )
+    if isinstance(plot_data, Response):
+        resp = plot_data
+    elif as_image:
+        if plot_data["type"] in PlotFormat.plotly:
+            plot_data = plotly_to_json(plot_data)
+        resp = JSONResponse(content=jsonable_encoder(plot_data))
+    else:
+        resp = generate_plot_response(plot_data, accept, geometry)
+    resp.headers.update(headers)
+
+    return resp
+
+
+@router.get("/{variable_id}/timesteps/{timestep}/geometry")
+async def get_timestep_geometry(
+    variable_id: str,
+    timestep: int,
+    girder_token: str = Header(None),
+    if_none_match: str = Header(None),
+):
+    """
+    Returns the nodes and connectivity of a mesh. The ETag is the geometry
+    hash, which is the same for every timestep that shares the mesh.
+    """
+    gc = get_girder_client(girder_token)
+
+    plot_data = await load_plot_data(gc, variable_id, timestep)
+    if plot_data is None:
+        raise HTTPException(status_code=404, detail="Unable to locate BP file.")
+    if plot_data["type"] != PlotFormat.mesh:
+        raise HTTPException(status_code=400, detail="Variable is not a mesh.")
+
+    geometry = mesh_geometry(plot_data)
+    headers = cache_headers(f'"{geometry["geometryHash"]}"')
+    if not_modified(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    return MsgpackResponse(content=geometry, headers=headers)
+
+
+async def _locate_plot(gc, variable_id: str, timestep: int) -> Dict:
+    variable = (await hierarchy.variable(gc, variable_id))["name"]
+    bp_file = await hierarchy.bp_file(gc, variable_id, timestep)
+    # Each plot of an indexed archive is downloaded on its own
+    archive = (bp_file["_id"], variable) if is_indexed(bp_file) else bp_file["_id"]
+
+    return {"variable": variable, "file_id": bp_file["_id"], "archive": archive}
+
+
+async def _read_archive_plots(gc, requests: List[Dict]) -> None:
+    try:
+        bp_file_path = await download_bp_file(
+            gc, requests[0]["variable_id"], requests[0]["timestep"]
+        )
+        plots = await executor.run(
+            read_plots_data,
+            str(bp_file_path),
+            [r["variable"] for r in requests],
+            False,
+        )
+    except HTTPException as e:
+        for r in requests:
+            r.update(status=e.status_code, detail=e.detail)
+        return
+
+    for r, plot_data in zip(requests, plots):
+        if plot_data is None:
+            r.update(status=404, detail="Unable to locate plot data in BP file.")
+        else:
+            plot_cache.set((r["file_id"], r["variable"], False), plot_data)
+            r.update(status=200, plot=plot_data)
+
+
+@router.post("/plots")
+async def get_timestep_plots(body: BatchPlotRequest, girder_token: str = Header(None)):
+    """
+    Returns the plot data for several (variable, timestep) pairs at once. The
+    requests are grouped by BP archive, so each archive is downloaded and opened
+    only once, or by plot for indexed archives, which are read one plot at a
+    time. Results are returned in request order, each with its own status,
+    and each plot has the same content as the single plot endpoint would return
+    with its "type" telling them apart. Plotly plots use the typed array format.
+    Plots that are only available as static images are reported as not found,
+    the client should fetch those individually. `max_points` is applied to
+    every plot as is `geometry`, as they are for the single plot endpoint.
+    """
+    gc = get_girder_client(girder_token)
+
+    requests = [
+        {"variable_id": p.variable_id, "timestep": p.timestep} for p in body.plots
+    ]
+    locations = await asyncio.gather(
+        *[_locate_plot(gc, r["variable_id"], r["timestep"]) for r in requests],
+        return_exceptions=True,
+    )
+
+    archives = {}
+    for r, location in zip(requests, locations):
+        if isinstance(location, HTTPException):
+            r.update(status=location.status_code, detail=location.detail)
+        elif isinstance(location, Exception):
+            raise location
+        else:
+            archive = location.pop("archive")
+            r.update(location)
+            key = (location["file_id"], location["variable"], False)
+            if plot_data := plot_cache.get(key):
+                r.update(status=200, plot=plot_data)
             else:
-                raise HTTPException(
-                    status_code=404, detail="Unable to locate BP file or static image."
-                )
-
-        try:
-            # Extract data from the BP file
-            with adios2.open(str(bp_file_path), "r") as bp:
-                plot_config = bp.read_attribute_string(variable)
-                if not plot_config or as_image:
-                    # Variable does not exist in BP file
-                    # Look for static image instead
-                    resp = _check_for_static_image(gc, time_step_item["_id"], variable)
-                    if resp:
-                        return resp
-                if as_image:
-                    return await generate_plot_data(bp, variable)
-                else:
-                    return await generate_plot_response(bp, variable)
-        except:
-            raise HTTPException(
-                status_code=404, detail="Unable to locate BP file or static image."
-            )
+                archives.setdefault(archive, []).append(r)
+
+    await asyncio.gather(*[_read_archive_plots(gc, a) for a in archives.values()])
+
+    async def _finish(r):
+        key = (r.pop("file_id", None), r.pop("variable", None), False)
+        if "plot" not in r:
+            return
+        r["plot"] = await _downsample(key, r["plot"], body.max_points)
+        if r["plot"]["type"] == "plotly":
+            r["plot"] = plotly_to_typed_arrays(r["plot"])
+        elif r["plot"]["type"] == PlotFormat.mesh and not body.geometry:
+            r["plot"] = mesh_without_geometry(r["plot"])
+
+    await asyncio.gather(*[_finish(r) for r in requests])
+
+    return MsgpackResponse(content=requests)
@@ -0,0 +1,84 @@
+import asyncio
+import mmap
+from pathlib import Path
+from typing import Dict
+from typing import Optional
+
+from app.core.config import settings
+
+
+class LocalAssetstore:
+    """
+    Reads Girder files in place from a filesystem assetstore that is mounted
+    locally, rather than downloading them over HTTP.
+
+    A file is resolved from its assetstore `path`, which Girder only returns to
+    site administrators, or else from its `sha512`, as the filesystem assetstore
+    stores files under their hash. Files that can't be resolved, or that don't
+    match the size Girder reports, such as files in another assetstore, are
+    left to be downloaded.
+    """
+
+    def __init__(self, root: Optional[str]) -> None:
+        self.root = Path(root).resolve() if root else None
+        self._local = 0
+        self._remote = 0
+
+    def path(self, file: Dict) -> Optional[Path]:
+        if self.root is None:
+            return None
+
+        candidates = []
+        if relpath := file.get("path"):
+            candidates.append(self.root / relpath)
+        if sha512 := file.get("sha512"):
+            candidates.append(self.root / sha512[0:2] / sha512[2:4] / sha512)
+
+        path = None
+        for candidate in candidates:
+            try:
+                # Don't follow a path out of the assetstore
+                if (
+                    candidate.resolve().is_relative_to(self.root)
+                    and candidate.stat().st_size == file["size"]
+                ):
+                    path = candidate
+                    break
+            except (OSError, KeyError):
+                continue
+
+        if path is None:
+            self._remote += 1
+        else:
+            self._local += 1
+
+        return path
+
+    @staticmethod
+    def read(
+        path: Path, start: Optional[int] = None, end: Optional[int] = None
+    ) -> bytes:
+        with open(path, "rb") as fp:
+            if fp.seek(0, 2) == 0:
+                # Empty files can't be mapped
+                return b""
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return data[start:end]
+
+    async def read_file(
+        self, gc, file: Dict, start: Optional[int] = None, end: Optional[int] = None
+    ) -> bytes:
+        if (path := self.path(file)) is not None:
+            return await asyncio.to_thread(self.read, path, start, end)
+
+        return await gc.read_file(file["_id"], start, end)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "enabled": self.root is not None,
+            "local": self._local,
+            "remote": self._remote,
+        }
+
+
+assetstore = LocalAssetstore(settings.GIRDER_ASSETSTORE_ROOT)
@@ -0,0 +1,189 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import diskcache
+from app.core.config import settings
+
+
+class BPFileCache:
+    """
+    Bounded on-disk cache of extracted BP archives keyed by Girder file id, or
+    by file id and plot for the BP files read from indexed archives.
+
+    The entries and the hit/miss counters are kept in a diskcache index so the
+    cache can be shared by all of the uvicorn workers. Entries are evicted in
+    least-recently-used order once the total size exceeds the size limit.
+
+    Entries used in the last `lease` seconds are never evicted, so the path
+    returned by `get` or `add` stays valid while a request is reading it, even
+    if the cache is over its limit in the meantime.
+    """
+
+    def __init__(self, directory: str, size_limit: int, lease: float = 300) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.size_limit = size_limit
+        self.lease = lease
+        self._index = diskcache.Cache(str(self.directory / "index"))
+
+    def _entry_path(self, file_id: str) -> Path:
+        return self.directory / file_id
+
+    def get(self, file_id: str) -> Optional[Path]:
+        entry = self._index.get(("entry", file_id))
+        path = self._entry_path(file_id)
+        if entry is None or not path.exists():
+            self._index.incr(("stat", "misses"))
+            return None
+
+        # Touch the entry so that eviction is done in LRU order
+        os.utime(path)
+        self._index.incr(("stat", "hits"))
+
+        return path / entry["name"]
+
+    def add(self, file_id: str, archive_path: Path) -> Path:
+        # Extract into a scratch directory first and then move it into place,
+        # the rename is atomic so other workers never see a partial entry.
+        scratch = tempfile.mkdtemp(prefix=".", dir=self.directory)
+        try:
+            with tarfile.open(archive_path) as tar:
+                # Get the name of the BP file
+                bp_filename = tar.getnames()[0]
+                tar.extractall(scratch, filter="data")
+        except Exception:
+            shutil.rmtree(scratch, ignore_errors=True)
+            raise
+
+        return self._place(file_id, scratch, bp_filename)
+
+    def add_members(
+        self, key: str, bp_filename: str, members: List[Tuple[str, bytes]]
+    ) -> Path:
+        """
+        Adds a BP file from its members, the paths and contents of its files,
+        such as those read from an indexed archive.
+        """
+        scratch = tempfile.mkdtemp(prefix=".", dir=self.directory)
+        for name, data in members:
+            path = Path(scratch) / name
+            if not path.resolve().is_relative_to(Path(scratch).resolve()):
+                shutil.rmtree(scratch, ignore_errors=True)
+                raise ValueError(f"Invalid member name: {name}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+
+        return self._place(key, scratch, bp_filename)
+
+    def _place(self, file_id: str, scratch: str, bp_filename: str) -> Path:
+        size = sum(f.stat().st_size for f in Path(scratch).rglob("*") if f.is_file())
+        path = self._entry_path(file_id)
+        # Eviction holds the same lock, so the entry can't be removed between
+        # moving it into place and indexing it.
+        with diskcache.Lock(self._index, ("lock", "evict")):
+            try:
+                os.rename(scratch, path)
+            except OSError:
+                # Another worker got there first
+                shutil.rmtree(scratch, ignore_errors=True)
+                os.utime(path)
+            self._index.set(("entry", file_id), {"name": bp_filename, "size": size})
+        self._evict(keep=file_id)
+
+        return path / bp_filename
+
+    def _evict(self, keep: str) -> None:
+        with diskcache.Lock(self._index, ("lock", "evict")):
+            entries = {}
+            for key in self._index:
+                if key[0] == "entry" and (entry := self._index.get(key)):
+                    entries[key[1]] = entry["size"]
+
+            total = sum(entries.values())
+            if total <= self.size_limit:
+                return
+
+            def _last_used(file_id):
+                try:
+                    return self._entry_path(file_id).stat().st_mtime
+                except FileNotFoundError:
+                    return 0
+
+            leased = time.time() - self.lease
+            for file_id in sorted(entries, key=_last_used):
+                if total <= self.size_limit:
+                    break
+                if file_id == keep or _last_used(file_id) > leased:
+                    continue
+                self._index.delete(("entry", file_id))
+                shutil.rmtree(self._entry_path(file_id), ignore_errors=True)
+                total -= entries[file_id]
+
+    def stats(self) -> Dict[str, int]:
+        entries = [self._index.get(key) for key in self._index if key[0] == "entry"]
+        entries = [e for e in entries if e is not None]
+        return {
+            "hits": self._index.get(("stat", "hits"), 0),
+            "misses": self._index.get(("stat", "misses"), 0),
+            "entries": len(entries),
+            "size": sum(e["size"] for e in entries),
+            "size_limit": self.size_limit,
+        }
+
+
+class ResultCache:
+    """
+    Bounded on-disk cache of computed results (plot data, rendered images)
+    shared by all of the uvicorn workers. Values are pickled, and entries are
+    evicted in least-recently-used order once the size limit is exceeded.
+    """
+
+    def __init__(self, directory: str, size_limit: int) -> None:
+        self.directory = Path(directory)
+        self.size_limit = size_limit
+        self._cache = diskcache.Cache(
+            str(self.directory),
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+        )
+        self._cache.stats(enable=True)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        return self._cache.get(key)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._cache.set(key, value)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._cache
+
+    def stats(self) -> Dict[str, int]:
+        hits, misses = self._cache.stats()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "entries": len(self._cache),
+            "size": self._cache.volume(),
+            "size_limit": self.size_limit,
+        }
+
+
+bp_cache = BPFileCache(
+    Path(settings.CACHE_DIRECTORY) / "bp", settings.BP_CACHE_SIZE_LIMIT
+)
+plot_cache = ResultCache(
+    Path(settings.CACHE_DIRECTORY) / "plots", settings.PLOT_CACHE_SIZE_LIMIT
+)
+image_cache = ResultCache(
+    Path(settings.CACHE_DIRECTORY) / "images", settings.IMAGE_CACHE_SIZE_LIMIT
+)
@@ -1,5 +1,9 @@
+import os
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import Literal
+from typing import Optional
 from typing import Union
 
 from pydantic import AnyHttpUrl
@@ -26,6 +30,54 @@ class Settings(BaseSettings):
 
     PROJECT_NAME: str
     GIRDER_API_URL: str = "http://localhost:8080/api/v1/"
+    # Maximum number of pooled connections to Girder per worker
+    GIRDER_CONNECTION_LIMIT: int = 100
+
+    # Root directory for the on-disk caches shared by all workers
+    CACHE_DIRECTORY: str = "/tmp/esimmon"
+    BP_CACHE_SIZE_LIMIT: int = 10 * 2**30  # 10g
+    PLOT_CACHE_SIZE_LIMIT: int = 2 * 2**30  # 2g
+    IMAGE_CACHE_SIZE_LIMIT: int = 2 * 2**30  # 2g
+    # Local mount of Girder's filesystem assetstore, files are then read in place
+    GIRDER_ASSETSTORE_ROOT: Optional[str] = None
+
+    # How long (in seconds) a variable's Girder hierarchy lookups are reused
+    HIERARCHY_INDEX_TTL: int = 300
+
+    # Pool used for parsing, rendering and encoding, either "thread" or "process"
+    EXECUTOR_TYPE: Literal["thread", "process"] = "thread"
+    EXECUTOR_WORKERS: int = os.cpu_count() or 4
+    # Number of tasks that may wait for a worker before requests are rejected
+    EXECUTOR_QUEUE_SIZE: int = 64
+
+    # Lifetime (in seconds) of cacheable responses, their content never changes
+    HTTP_CACHE_MAX_AGE: int = 365 * 24 * 60 * 60
+
+    # Number of gunicorn workers, which gunicorn reads from the same variable
+    WEB_CONCURRENCY: int = 1
+    # Offscreen render worker processes per gunicorn worker, each with its own
+    # VTK render window. By default the CPUs are shared between the workers.
+    RENDER_WORKERS: Optional[int] = None
+
+    @validator("RENDER_WORKERS", always=True)
+    def share_cpus(cls, v: Optional[int], values: Dict[str, Any]) -> int:
+        if v is not None:
+            return v
+        return max(1, (os.cpu_count() or 4) // values.get("WEB_CONCURRENCY", 1))
+
+    # Number of renders that may wait for a worker before requests are rejected
+    RENDER_QUEUE_SIZE: int = 64
+
+    # Number of timesteps to load ahead of sequential playback, 0 to disable
+    PREFETCH_DEPTH: int = 3
+
+    # Number of movies each worker generates at once
+    MOVIE_WORKERS: int = 1
+    # Number of movie jobs that may wait before submissions are rejected
+    MOVIE_QUEUE_SIZE: int = 64
+
+    # Number of timesteps downloaded at once when exporting raw data
+    RAW_DATA_DOWNLOADS: int = 8
 
     class Config:
         case_sensitive = True
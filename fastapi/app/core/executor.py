@@ -0,0 +1,180 @@
+import asyncio
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import Tuple
+
+from app.core.config import settings
+
+from fastapi import HTTPException
+
+# Set for batch work (exports, movies, time series) that would rather wait for
+# a worker than be turned away
+_batch: ContextVar[bool] = ContextVar("batch", default=False)
+
+
+@contextmanager
+def batch() -> Iterator[None]:
+    """
+    Within this context, executor tasks wait for an idle worker instead of
+    being rejected with a 503 when the executor is busy. They don't take up
+    the queue, which is left to interactive requests. As it sets a context
+    variable, use it inside a task of its own.
+    """
+    token = _batch.set(True)
+    try:
+        yield
+    finally:
+        _batch.reset(token)
+
+
+def _timed(func: Callable, *args) -> Tuple[Any, float, float]:
+    # Wall clock times, so they can be compared across processes
+    started = time.time()
+    result = func(*args)
+    return result, started, time.time()
+
+
+class BoundedExecutor:
+    """
+    Runs CPU-bound work (BP parsing, rendering, encoding) off the event loop on
+    either a thread or a process pool. At most `max_workers + queue_size` tasks
+    are accepted at once, further submissions are rejected with a 503 so a busy
+    worker sheds load instead of building an unbounded backlog.
+    """
+
+    def __init__(
+        self, kind: str, max_workers: int, queue_size: int, initializer=None
+    ) -> None:
+        self.kind = kind
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self._initializer = initializer
+        self._pool = None
+        self._pending = 0
+        self._waiters = deque()
+        self._completed = 0
+        self._rejected = 0
+        self._timed = 0
+        self._queue_time = 0.0
+        self._run_time = 0.0
+
+    @property
+    def pool(self) -> Executor:
+        # Created on first use so forked gunicorn workers each get their own pool
+        if self._pool is None:
+            if self.kind == "process":
+                # Workers are started from a clean server process, forking the
+                # event loop's process would copy its threads and locks too.
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    initializer=self._initializer,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+            else:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers, initializer=self._initializer
+                )
+
+        return self._pool
+
+    async def _idle_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending >= self.max_workers:
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Pass the worker that was freed for us on
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def _wake(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def run(self, func: Callable, *args) -> Any:
+        if _batch.get():
+            await self._idle_worker()
+        elif self._pending >= self.max_workers + self.queue_size:
+            self._rejected += 1
+            raise HTTPException(
+                status_code=503, detail="Server is busy, please try again later."
+            )
+
+        self._pending += 1
+        pool = self.pool
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. crashed in native code), start a fresh pool
+            # for the next request rather than failing all of them. Tasks that
+            # were on the same pool fail too, but mustn't shut down the pool
+            # that has already replaced it.
+            if self._pool is pool:
+                self.shutdown()
+            raise HTTPException(status_code=500, detail="Worker process failed.")
+        finally:
+            self._pending -= 1
+            self._completed += 1
+            self._wake()
+
+    async def run_timed(self, func: Callable, *args) -> Tuple[Any, Dict[str, float]]:
+        """
+        Like run, but also returns how long (in seconds) the task waited for a
+        worker and how long it then ran.
+        """
+        submitted = time.time()
+        result, started, finished = await self.run(_timed, func, *args)
+        timings = {"queue": max(0.0, started - submitted), "run": finished - started}
+        self._timed += 1
+        self._queue_time += timings["queue"]
+        self._run_time += timings["run"]
+
+        return result, timings
+
+    def stats(self) -> Dict[str, Any]:
+        running = min(self._pending, self.max_workers)
+        queued = self._pending - running
+        return {
+            "type": self.kind,
+            "workers": self.max_workers,
+            "running": running,
+            "queued": queued,
+            "queue_size": self.queue_size,
+            "waiting": len(self._waiters),
+            "saturation": self._pending / (self.max_workers + self.queue_size),
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "mean_queue_time": self._queue_time / self._timed if self._timed else 0.0,
+            "mean_run_time": self._run_time / self._timed if self._timed else 0.0,
+        }
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+executor = BoundedExecutor(
+    settings.EXECUTOR_TYPE, settings.EXECUTOR_WORKERS, settings.EXECUTOR_QUEUE_SIZE
+)
@@ -0,0 +1,192 @@
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import aiofiles
+import aiohttp
+import tenacity
+from app.core.config import settings
+
+from fastapi import HTTPException
+
+_session = None
+
+_RETRY = {
+    "retry": tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    ),
+    "wait": tenacity.wait_exponential(max=10),
+    "stop": tenacity.stop_after_attempt(10),
+}
+
+
+def get_session() -> aiohttp.ClientSession:
+    # One pooled session per worker, shared by all requests
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=settings.GIRDER_CONNECTION_LIMIT),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30),
+        )
+
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+class AsyncGirderClient(object):
+    """
+    Non-blocking Girder client. The HTTP session is shared, the token is not,
+    so each request gets its own client with its own credentials.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, api_url: str, token: str):
+        self._session = session
+        self._api_url = api_url.rstrip("/")
+        self.token = token
+
+    @property
+    def _headers(self) -> Dict[str, str]:
+        return {"Girder-Token": self.token}
+
+    @staticmethod
+    async def _raise_for_status(r: aiohttp.ClientResponse) -> None:
+        if r.status >= 400:
+            try:
+                detail = (await r.json()).get("message", r.reason)
+            except (aiohttp.ContentTypeError, ValueError):
+                detail = r.reason
+            raise HTTPException(status_code=r.status, detail=detail)
+
+    async def _send(self, method: str, path: str, params=None, **kwargs) -> Any:
+        if params is not None:
+            params = {k: str(v) for (k, v) in params.items() if v is not None}
+
+        headers = {**kwargs.pop("headers", {}), **self._headers}
+        async with self._session.request(
+            method,
+            f"{self._api_url}/{path}",
+            headers=headers,
+            params=params,
+            **kwargs,
+        ) as r:
+            await self._raise_for_status(r)
+            return await r.json()
+
+    @tenacity.retry(**_RETRY)
+    async def _request(self, method: str, path: str, params=None, **kwargs) -> Any:
+        return await self._send(method, path, params, **kwargs)
+
+    async def get(self, path: str, params=None) -> Any:
+        return await self._request("GET", path, params)
+
+    async def post(self, path: str, params=None, **kwargs) -> Any:
+        return await self._request("POST", path, params, **kwargs)
+
+    async def put(self, path: str, params=None, **kwargs) -> Any:
+        return await self._request("PUT", path, params, **kwargs)
+
+    async def delete(self, path: str, params=None) -> Any:
+        return await self._request("DELETE", path, params)
+
+    async def get_item(self, item_id: str) -> Dict:
+        return await self.get(f"item/{item_id}")
+
+    async def get_folder(self, folder_id: str) -> Dict:
+        return await self.get(f"folder/{folder_id}")
+
+    async def get_file(self, file_id: str) -> Dict:
+        return await self.get(f"file/{file_id}")
+
+    async def list_folder(self, parent_id: str, name: Optional[str] = None) -> List:
+        params = {
+            "parentId": parent_id,
+            "parentType": "folder",
+            "name": name,
+            "limit": 0,
+        }
+
+        return await self.get("folder", params=params)
+
+    async def list_item(self, folder_id: str, name: Optional[str] = None) -> List:
+        params = {"folderId": folder_id, "name": name, "limit": 0}
+
+        return await self.get("item", params=params)
+
+    async def list_file(self, item_id: str) -> List:
+        return await self.get(f"item/{item_id}/files", params={"limit": 0})
+
+    async def read_file(
+        self, file_id: str, start: Optional[int] = None, end: Optional[int] = None
+    ) -> bytes:
+        # Only the bytes from start up to end are fetched when either is given,
+        # without an end the range runs to the end of the file
+        headers = self._headers
+        ranged = start is not None or end is not None
+        if ranged:
+            first = start or 0
+            if end is not None and end <= first:
+                return b""
+            last = "" if end is None else end - 1
+            headers = {**headers, "Range": f"bytes={first}-{last}"}
+        async with self._session.get(
+            f"{self._api_url}/file/{file_id}/download", headers=headers
+        ) as r:
+            await self._raise_for_status(r)
+            data = await r.read()
+
+        # The range may be ignored, in which case the whole file is returned
+        if ranged and r.status != 206:
+            data = data[start:end]
+
+        return data
+
+    async def download_file(self, file_id: str, path: str) -> None:
+        async with self._session.get(
+            f"{self._api_url}/file/{file_id}/download", headers=self._headers
+        ) as r:
+            await self._raise_for_status(r)
+            async with aiofiles.open(path, "wb") as fp:
+                async for chunk in r.content.iter_chunked(2**20):
+                    await fp.write(chunk)
+
+    async def upload_file(
+        self,
+        parent_id: str,
+        stream: BinaryIO,
+        name: str,
+        size: int,
+        parent_type: str = "item",
+        mime_type: Optional[str] = None,
+    ) -> Dict:
+        params = {
+            "parentType": parent_type,
+            "parentId": parent_id,
+            "name": name,
+            "size": size,
+            "mimeType": mime_type,
+        }
+
+        # The whole file is sent with the initial request, which finalizes it
+        headers = {"Content-Length": str(size)}
+        if not stream.seekable():
+            # The stream is consumed by the request, so it can't be retried
+            return await self._send(
+                "POST", "file", params, headers=headers, data=stream
+            )
+
+        # Rewind the stream before each attempt, so the whole body is sent again
+        start = stream.tell()
+        async for attempt in tenacity.AsyncRetrying(**_RETRY):
+            with attempt:
+                stream.seek(start)
+                return await self._send(
+                    "POST", "file", params, headers=headers, data=stream
+                )
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import time
+import uuid
+from functools import partial
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+import diskcache
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Runs long jobs, such as generating movies, in the background of the worker
+    that accepted them. At most `max_workers` jobs run at once and
+    `queue_size` may wait, further submissions are rejected with a 503.
+
+    The job state is kept in a diskcache so that any of the uvicorn workers can
+    report progress or cancel a job. Submitting a job with the same key as one
+    that is still active returns the existing job instead of starting another,
+    unless it is submitted to run `after` that job, in which case it waits for
+    it to finish and takes its place.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_workers: int,
+        queue_size: int,
+        stale_after: float = 900,
+        expire: float = 86400,
+        poll_interval: float = 1,
+    ) -> None:
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        # An active job that hasn't reported in this long lost its worker
+        self.stale_after = stale_after
+        self.expire = expire
+        # How often a job checks whether the job it runs after has finished
+        self.poll_interval = poll_interval
+        self._state = diskcache.Cache(str(directory))
+        self._semaphore = None
+        self._tasks = {}
+
+    def _set(self, job: Dict[str, Any]) -> None:
+        job["updated"] = time.time()
+        self._state.set(("job", job["id"]), job, expire=self.expire)
+
+    def _update(self, job_id: str, **values) -> Dict[str, Any]:
+        with self._state.transact():
+            job = self._state.get(("job", job_id))
+            if job is None or job["status"] == CANCELLED:
+                raise JobCancelled()
+            job.update(values)
+            self._set(job)
+
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._state.get(("job", job_id))
+        if (
+            job is not None
+            and job["status"] in ACTIVE
+            and time.time() - job["updated"] > self.stale_after
+        ):
+            job["status"] = FAILED
+            job["error"] = "The job stopped responding."
+            self._set(job)
+
+        return job
+
+    def active(self, key: str) -> Optional[Dict[str, Any]]:
+        job_id = self._state.get(("active", key))
+        job = self.get(job_id) if job_id is not None else None
+
+        return job if job is not None and job["status"] in ACTIVE else None
+
+    def submit(
+        self,
+        key: str,
+        func: Callable[[Callable[[int, int], None]], Awaitable],
+        after: Optional[str] = None,
+        **details,
+    ) -> Dict[str, Any]:
+        """
+        Queues `func`, which is passed a callback to report its progress with
+        as `progress(completed, total)`. With `after`, the id of the active job
+        for the key, the new job only starts once that one has finished.
+        """
+        with self._state.transact():
+            job = self.active(key)
+            if job is not None and job["id"] != after:
+                return job
+            after = job["id"] if job is not None else None
+
+            if len(self._tasks) >= self.max_workers + self.queue_size:
+                raise HTTPException(
+                    status_code=503, detail="Server is busy, please try again later."
+                )
+
+            job = {
+                "id": uuid.uuid4().hex,
+                "key": key,
+                "status": QUEUED,
+                "completed": 0,
+                "total": None,
+                "error": None,
+                "after": after,
+                "created": time.time(),
+                **details,
+            }
+            self._set(job)
+            self._state.set(("active", key), job["id"], expire=self.expire)
+
+        task = asyncio.create_task(self._run(job["id"], func, after))
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["id"], None))
+
+        return job
+
+    def _stopped(self, job: Dict[str, Any]) -> bool:
+        if job["status"] in ACTIVE:
+            return False
+        # A cancelled job keeps running until its next progress report or
+        # heartbeat, unless the worker running it is gone
+        return (
+            job["status"] != CANCELLED
+            or "stopped" in job
+            or time.time() - job["updated"] > self.stale_after
+        )
+
+    async def wait(
+        self, job_id: str, report: Optional[Callable[[], None]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Waits for a job to stop running, including a cancelled job that is
+        still winding down. The job may be running in another worker, so its
+        state is polled, calling `report` each time.
+        """
+        while (job := self.get(job_id)) is not None and not self._stopped(job):
+            await asyncio.sleep(self.poll_interval)
+            if report is not None:
+                report()
+
+        return job
+
+    async def _heartbeat(self, job_id: str, task: asyncio.Task) -> None:
+        # Stages that don't report progress, such as encoding or uploading,
+        # mustn't get the job taken as stale. Cancelling the job from another
+        # worker also stops it here.
+        while True:
+            await asyncio.sleep(self.stale_after / 3)
+            try:
+                self._update(job_id)
+            except JobCancelled:
+                task.cancel()
+                return
+
+    async def _run(
+        self, job_id: str, func: Callable, after: Optional[str] = None
+    ) -> None:
+        # Created lazily so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+
+        def progress(completed: int, total: int) -> None:
+            self._update(job_id, completed=completed, total=total)
+
+        try:
+            if after is not None:
+                await self.wait(after, partial(self._update, job_id))
+            # Keep reporting in while waiting, so the job isn't taken as stale
+            while True:
+                try:
+                    await asyncio.wait_for(
+                        self._semaphore.acquire(), timeout=self.stale_after / 2
+                    )
+                    break
+                except asyncio.TimeoutError:
+                    self._update(job_id)
+            heartbeat = asyncio.create_task(
+                self._heartbeat(job_id, asyncio.current_task())
+            )
+            try:
+                self._update(job_id, status=RUNNING, started=time.time())
+                await func(progress)
+                self._update(job_id, status=COMPLETE, finished=time.time())
+            finally:
+                heartbeat.cancel()
+                self._semaphore.release()
+        except JobCancelled:
+            pass
+        except asyncio.CancelledError:
+            # The worker is shutting down, unless the job was cancelled
+            self._finish(job_id, CANCELLED)
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self._finish(
+                job_id, FAILED, e.detail if isinstance(e, HTTPException) else str(e)
+            )
+        finally:
+            # Recorded even for cancelled jobs, for those waiting on them
+            with self._state.transact():
+                job = self._state.get(("job", job_id))
+                if job is not None:
+                    job["stopped"] = time.time()
+                    self._set(job)
+
+    def _finish(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        try:
+            self._update(job_id, status=status, error=error, finished=time.time())
+        except JobCancelled:
+            pass
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._state.transact():
+            job = self.get(job_id)
+            if job is None or job["status"] not in ACTIVE:
+                return job
+            job["status"] = CANCELLED
+            job["finished"] = time.time()
+            self._set(job)
+
+        # Jobs running in another worker stop at their next progress report or
+        # heartbeat
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+
+        return job
+
+    def stats(self) -> Dict[str, Any]:
+        running = min(len(self._tasks), self.max_workers)
+        return {
+            "workers": self.max_workers,
+            "running": running,
+            "queued": len(self._tasks) - running,
+            "queue_size": self.queue_size,
+        }
+
+    def shutdown(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+
+import diskcache
+from app.core.executor import executor
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Loads the next `depth` timesteps of a variable in the background once it
+    is being accessed sequentially, as it is during playback.
+
+    The access state is kept in a diskcache so that it is shared by all of the
+    uvicorn workers. Any non-sequential access bumps the generation of the
+    variable, which stops the prefetch in whichever worker is running it.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        depth: int,
+        load: Callable[..., Awaitable],
+    ) -> None:
+        self.depth = depth
+        self._load = load
+        self._state = diskcache.Cache(str(directory))
+        self._tasks = {}
+
+    @staticmethod
+    def _key(gc, variable_id: str, options: Dict) -> str:
+        # Don't store tokens in the clear
+        token = hashlib.sha256(gc.token.encode()).hexdigest()
+        return f"{token}:{variable_id}:{sorted(options.items())}"
+
+    def record(
+        self,
+        gc,
+        variable_id: str,
+        timestep: int,
+        timesteps: List[int],
+        **options,
+    ) -> None:
+        # The options are passed on to the load function, playback with
+        # different options is tracked separately.
+        if self.depth <= 0 or timestep not in timesteps:
+            return
+
+        key = self._key(gc, variable_id, options)
+        timesteps = sorted(timesteps)
+        index = timesteps.index(timestep)
+        with self._state.transact():
+            state = self._state.get(key, {"index": None, "generation": 0})
+            if state["index"] == index:
+                # Repeated request for the same step, nothing has changed
+                return
+            sequential = state["index"] is not None and index == state["index"] + 1
+            if not sequential:
+                state["generation"] += 1
+            state["index"] = index
+            self._state.set(key, state, expire=3600)
+
+        task = self._tasks.get(key)
+        if not sequential:
+            if task is not None:
+                task.cancel()
+            return
+
+        if task is None or task.done():
+            task = asyncio.create_task(
+                self._prefetch(gc, key, variable_id, timesteps, options, state)
+            )
+            self._tasks[key] = task
+            task.add_done_callback(self._forget(key))
+
+    def _forget(self, key: str) -> Callable[[asyncio.Task], None]:
+        def _done(task: asyncio.Task) -> None:
+            # A newer prefetch may have been started for the key since
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+
+        return _done
+
+    async def _prefetch(
+        self,
+        gc,
+        key: str,
+        variable_id: str,
+        timesteps: List[int],
+        options: Dict,
+        started: Dict,
+    ) -> None:
+        cursor = started["index"]
+        while True:
+            state = self._state.get(key)
+            if state is None or state["generation"] != started["generation"]:
+                # The access pattern is no longer sequential
+                return
+            cursor = max(cursor, state["index"]) + 1
+            if cursor >= len(timesteps) or cursor > state["index"] + self.depth:
+                return
+            if executor.stats()["queued"] > 0:
+                # Don't compete with requests that are waiting for a worker
+                return
+            try:
+                await self._load(gc, variable_id, timesteps[cursor], **options)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.debug(
+                    "Unable to prefetch timestep %s of %s",
+                    timesteps[cursor],
+                    variable_id,
+                    exc_info=True,
+                )
@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from app.core.config import settings
+
+
+class ScratchSpace:
+    """
+    Working directories for large intermediate outputs, such as raw data
+    exports, kept under the cache directory rather than the system temporary
+    directory or the working directory of the process. Directories left behind
+    by a worker that died are removed once they are older than `max_age`.
+    """
+
+    def __init__(self, directory: str, max_age: float = 86400) -> None:
+        self.directory = Path(directory)
+        self.max_age = max_age
+
+    def _cleanup(self) -> None:
+        cutoff = time.time() - self.max_age
+        for path in self.directory.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                # Removed by another worker
+                pass
+
+    @contextmanager
+    def directory_for(self, prefix: str = "") -> Iterator[Path]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._cleanup()
+        path = Path(tempfile.mkdtemp(prefix=prefix, dir=self.directory))
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+scratch = ScratchSpace(Path(settings.CACHE_DIRECTORY) / "scratch")
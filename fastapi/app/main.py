@@ -1,5 +1,9 @@
 from app.api.api_v1.api import api_router
+from app.api.api_v1.endpoints.images import render_pool
+from app.api.api_v1.endpoints.movie import movie_jobs
 from app.core.config import settings
+from app.core.executor import executor
+from app.core.girder import close_session
 from starlette.middleware.cors import CORSMiddleware
 
 from fastapi import FastAPI
@@ -20,3 +24,11 @@ if settings.CORS_ORIGINS:
     )
 
 app.include_router(api_router, prefix=settings.API_V1_STR)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_session()
+    executor.shutdown()
+    render_pool.shutdown()
+    movie_jobs.shutdown()
@@ -0,0 +1,16 @@
+from typing import Optional
+
+from pydantic import BaseModel
+from pydantic import conint
+from pydantic import conlist
+
+
+class PlotRequest(BaseModel):
+    variable_id: str
+    timestep: int
+
+
+class BatchPlotRequest(BaseModel):
+    plots: conlist(PlotRequest, min_items=1, max_items=256)
+    max_points: Optional[conint(gt=2)] = None
+    geometry: bool = True
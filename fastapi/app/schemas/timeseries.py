@@ -0,0 +1,18 @@
+from enum import Enum
+
+
+class Field(str, Enum):
+    x = "x"
+    y = "y"
+    color = "color"
+
+
+class Reduction(str, Enum):
+    min = "min"
+    max = "max"
+    mean = "mean"
+    l2 = "l2"
+    # The value at a given index
+    value = "value"
+    # The y values sampled at a given x
+    sample = "sample"
@@ -0,0 +1,115 @@
+"""
+Times building the VTK geometry of mesh and colormap plots, and rendering them
+when an offscreen render window is available, for a range of mesh sizes.
+
+    python scripts/benchmark_mesh_image.py --cells 1000 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+for name, value in [
+    ("SERVER_NAME", "benchmark"),
+    ("SERVER_HOST", "http://localhost"),
+    ("PROJECT_NAME", "benchmark"),
+]:
+    os.environ.setdefault(name, value)
+
+from app.api.api_v1.endpoints.images import PlotDetails  # noqa: E402
+from app.api.api_v1.endpoints.images import _grid_geometry  # noqa: E402
+from app.api.api_v1.endpoints.images import _vtk_cells  # noqa: E402
+from app.api.api_v1.endpoints.images import _vtk_points  # noqa: E402
+from app.api.api_v1.endpoints.images import create_mesh_image  # noqa: E402
+from vtkmodules.vtkCommonCore import vtkIdList  # noqa: E402
+from vtkmodules.vtkCommonCore import vtkPoints  # noqa: E402
+from vtkmodules.vtkCommonDataModel import vtkCellArray  # noqa: E402
+
+
+def loop_geometry(nodes, connectivity):
+    # The per-point and per-cell construction that was used before
+    points = vtkPoints()
+    for i, (x, y) in enumerate(nodes):
+        points.InsertPoint(i, (x, y, 0.0))
+    cells = vtkCellArray()
+    for cell in connectivity:
+        ids = vtkIdList()
+        for i in cell:
+            ids.InsertNextId(int(i))
+        cells.InsertNextCell(ids)
+    return points, cells
+
+
+def bulk_geometry(nodes, connectivity):
+    return _vtk_points(nodes), _vtk_cells(connectivity)
+
+
+def mesh_plot(cells: int):
+    side = max(2, int(np.sqrt(cells / 2)) + 1)
+    x, y = np.meshgrid(np.linspace(0, 1, side), np.linspace(0, 1, side))
+    nodes = np.column_stack([x.ravel(), y.ravel()])
+    # Split each quad of the grid into two triangles
+    corners = (np.arange(side - 1)[:, None] * side + np.arange(side - 1)).ravel()
+    connectivity = np.concatenate(
+        [
+            corners[:, None] + np.array([0, 1, side]),
+            corners[:, None] + np.array([1, side + 1, side]),
+        ]
+    ).astype(np.int32)
+    return {
+        "type": "mesh-colormap",
+        "nodes": nodes,
+        "connectivity": connectivity,
+        "color": np.sin(nodes[:, 0] * 10) * np.cos(nodes[:, 1] * 10),
+        "xLabel": "x",
+        "yLabel": "y",
+        "colorLabel": "color",
+        "title": "benchmark",
+    }
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--cells", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6]
+    )
+    parser.add_argument(
+        "--loop-limit",
+        type=int,
+        default=10**5,
+        help="Largest mesh to build with Python loops, for comparison",
+    )
+    parser.add_argument("--render", action="store_true", help="Also render images")
+    args = parser.parse_args()
+
+    header = f"{'cells':>10} {'grid':>8} {'bulk':>8} {'loop':>8}"
+    if args.render:
+        header += f" {'render':>8}"
+    print(header + "  (seconds)")
+
+    for cells in args.cells:
+        plot = mesh_plot(cells)
+        side = int(np.sqrt(cells)) + 1
+        grid = timed(_grid_geometry, np.arange(side), np.arange(side))
+        bulk = timed(bulk_geometry, plot["nodes"], plot["connectivity"])
+        loop = float("nan")
+        if len(plot["connectivity"]) <= args.loop_limit:
+            loop = timed(loop_geometry, plot["nodes"], plot["connectivity"])
+        row = f"{len(plot['connectivity']):>10} {grid:>8.3f} {bulk:>8.3f} {loop:>8.3f}"
+        if args.render:
+            row += f" {timed(create_mesh_image, plot, 'png', PlotDetails()):>8.3f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# The settings are read when the app modules are imported
+for name, value in [
+    ("SERVER_NAME", "test"),
+    ("SERVER_HOST", "http://localhost"),
+    ("PROJECT_NAME", "test"),
+    ("CACHE_DIRECTORY", tempfile.mkdtemp(prefix="esimmon-test")),
+]:
+    os.environ.setdefault(name, value)
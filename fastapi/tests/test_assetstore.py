@@ -0,0 +1,70 @@
+import asyncio
+
+from app.core.assetstore import LocalAssetstore
+
+
+def _assetstore(tmp_path):
+    root = tmp_path / "assetstore"
+    (root / "ab" / "cd").mkdir(parents=True)
+    (root / "ab" / "cd" / "abcdef").write_bytes(b"0123456789")
+    (root / "file.bin").write_bytes(b"0123456789")
+    (tmp_path / "outside.bin").write_bytes(b"0123456789")
+
+    return LocalAssetstore(str(root))
+
+
+def test_path(tmp_path):
+    assetstore = _assetstore(tmp_path)
+    root = assetstore.root
+    assert assetstore.path({"path": "file.bin", "size": 10}) == root / "file.bin"
+    # The filesystem assetstore stores files under their hash
+    assert (
+        assetstore.path({"sha512": "abcdef", "size": 10})
+        == root / "ab" / "cd" / "abcdef"
+    )
+    assert assetstore.stats() == {"enabled": True, "local": 2, "remote": 0}
+
+
+def test_unresolved(tmp_path):
+    assetstore = _assetstore(tmp_path)
+    # Missing, the wrong size, or without a size
+    assert assetstore.path({"path": "missing.bin", "size": 10}) is None
+    assert assetstore.path({"path": "file.bin", "size": 5}) is None
+    assert assetstore.path({"path": "file.bin"}) is None
+    # Paths that lead out of the assetstore
+    assert assetstore.path({"path": "../outside.bin", "size": 10}) is None
+    assert assetstore.path({"path": str(tmp_path / "outside.bin"), "size": 10}) is None
+    (assetstore.root / "link.bin").symlink_to(tmp_path / "outside.bin")
+    assert assetstore.path({"path": "link.bin", "size": 10}) is None
+    assert assetstore.stats()["remote"] == 6
+
+
+def test_disabled():
+    assetstore = LocalAssetstore(None)
+    assert assetstore.path({"path": "file.bin", "size": 10}) is None
+    assert not assetstore.stats()["enabled"]
+
+
+def test_read(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"0123456789")
+    assert LocalAssetstore.read(path) == b"0123456789"
+    assert LocalAssetstore.read(path, 2, 5) == b"234"
+    assert LocalAssetstore.read(path, 8) == b"89"
+    (tmp_path / "empty.bin").write_bytes(b"")
+    assert LocalAssetstore.read(tmp_path / "empty.bin") == b""
+
+
+class FakeGirderClient:
+    async def read_file(self, file_id, start=None, end=None):
+        return f"{file_id}:{start}:{end}".encode()
+
+
+def test_read_file(tmp_path):
+    assetstore = _assetstore(tmp_path)
+    gc = FakeGirderClient()
+    local = {"_id": "a", "path": "file.bin", "size": 10}
+    remote = {"_id": "b", "path": "missing.bin", "size": 10}
+    assert asyncio.run(assetstore.read_file(gc, local, 1, 3)) == b"12"
+    # Downloaded instead
+    assert asyncio.run(assetstore.read_file(gc, remote, 1, 3)) == b"b:1:3"
@@ -0,0 +1,115 @@
+import os
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from app.core.cache import BPFileCache
+
+
+def _archive(path, name, size):
+    data = path / name
+    data.mkdir(parents=True)
+    (data / "data.0").write_bytes(b"x" * size)
+    archive = path / f"{name}.tgz"
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(data, arcname=name)
+
+    return archive
+
+
+def _age(cache, file_id, seconds):
+    last_used = time.time() - seconds
+    os.utime(cache.directory / file_id, (last_used, last_used))
+
+
+def test_add_and_get(tmp_path):
+    cache = BPFileCache(tmp_path / "cache", size_limit=1000)
+    assert cache.get("a") is None
+
+    path = cache.add("a", _archive(tmp_path, "group.bp", 10))
+    assert path == tmp_path / "cache" / "a" / "group.bp"
+    assert (path / "data.0").read_bytes() == b"x" * 10
+    assert cache.get("a") == path
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["size"] == 10
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = BPFileCache(tmp_path / "cache", size_limit=250, lease=0)
+    for file_id in ["a", "b"]:
+        cache.add(file_id, _archive(tmp_path / file_id, "group.bp", 100))
+    _age(cache, "a", 20)
+    _age(cache, "b", 30)
+
+    # b was used less recently than a, so it is evicted first
+    cache.add("c", _archive(tmp_path / "c", "group.bp", 100))
+    assert cache.get("b") is None
+    assert not (cache.directory / "b").exists()
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.stats()["entries"] == 2
+
+
+def test_leased_entries_are_not_evicted(tmp_path):
+    cache = BPFileCache(tmp_path / "cache", size_limit=150, lease=60)
+    path = cache.add("a", _archive(tmp_path / "a", "group.bp", 100))
+    cache.add("b", _archive(tmp_path / "b", "group.bp", 100))
+
+    # a is still being read, so the cache stays over its limit for now
+    assert (path / "data.0").exists()
+    assert cache.stats()["entries"] == 2
+
+    _age(cache, "a", 120)
+    cache.add("c", _archive(tmp_path / "c", "group.bp", 10))
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_concurrent_adds(tmp_path):
+    cache = BPFileCache(tmp_path / "cache", size_limit=500, lease=0)
+    archives = [_archive(tmp_path / str(i), "group.bp", 100) for i in range(20)]
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: cache.add(str(i % 10), archives[i]), range(20)))
+
+    stats = cache.stats()
+    assert stats["size"] <= 500
+    entries = [p.name for p in cache.directory.iterdir() if p.name != "index"]
+    # Only indexed entries are left on disk, no partial extractions
+    assert sorted(entries) == sorted(
+        f for f in map(str, range(10)) if cache.get(f) is not None
+    )
+
+
+def test_add_members(tmp_path):
+    cache = BPFileCache(tmp_path / "cache", size_limit=1000)
+    path = cache.add_members(
+        "a.p0.bp", "p0.bp", [("p0.bp/data.0", b"data"), ("p0.bp/md.0", b"md")]
+    )
+    assert (path / "data.0").read_bytes() == b"data"
+    assert cache.get("a.p0.bp") == path
+
+
+def test_add_members_rejects_escaping_paths(tmp_path):
+    cache = BPFileCache(tmp_path / "cache", size_limit=1000)
+    with pytest.raises(ValueError):
+        cache.add_members("a", "p0.bp", [("../../escaped", b"data")])
+    assert not (tmp_path / "escaped").exists()
+    # Nothing is left behind in the cache directory
+    assert [p.name for p in cache.directory.iterdir()] == ["index"]
+
+
+def test_add_rejects_escaping_archives(tmp_path):
+    archive = tmp_path / "bad.tgz"
+    with tarfile.open(archive, "w:gz") as tar:
+        info = tarfile.TarInfo("../escaped")
+        tar.addfile(info)
+
+    cache = BPFileCache(tmp_path / "cache", size_limit=1000)
+    with pytest.raises(tarfile.TarError):
+        cache.add("a", archive)
+    assert not (tmp_path / "escaped").exists()
+    # Nothing is left behind in the cache directory
+    assert [p.name for p in cache.directory.iterdir()] == ["index"]
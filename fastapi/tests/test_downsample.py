@@ -0,0 +1,80 @@
+import numpy as np
+from app.api.api_v1.endpoints.downsample import grid_indices
+from app.api.api_v1.endpoints.downsample import minmax_indices
+from app.api.api_v1.endpoints.plotly import downsample_plotly_data
+
+
+def test_short_series_are_kept():
+    np.testing.assert_array_equal(minmax_indices([np.arange(10)], 10), np.arange(10))
+
+
+def test_minmax_keeps_extremes_and_end_points():
+    y = np.zeros(1000)
+    y[123] = 5
+    y[777] = -5
+    indices = minmax_indices([y], 20)
+
+    assert len(indices) <= 20
+    assert {0, 123, 777, 999} <= set(indices)
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_minmax_bucket_indices():
+    y = np.array([3, 1, 2, 9, 0, 4, 8, 7, 5, 6], dtype=float)
+    # Four points: the two end points and the min and max of a single bucket
+    np.testing.assert_array_equal(minmax_indices([y], 4), [0, 3, 4, 9])
+    # Two buckets of five
+    np.testing.assert_array_equal(minmax_indices([y], 6), [0, 3, 4, 5, 6, 9])
+
+
+def test_minmax_union_of_series():
+    n = 1000
+    a = np.zeros(n)
+    a[100] = 1
+    b = np.zeros(n)
+    b[900] = 1
+    indices = minmax_indices([a, b], 10)
+
+    assert {100, 900} <= set(indices)
+    assert len(indices) <= 20
+
+
+def test_downsample_plotly_shares_x():
+    x = np.linspace(0, 1, 1000)
+    plot = {
+        "data": [
+            {"type": "scatter", "x": x, "y": np.sin(x * 20)},
+            {"type": "scatter", "x": x, "y": np.cos(x * 20)},
+        ]
+    }
+    reduced = downsample_plotly_data(plot, 50)
+    a, b = reduced["data"]
+
+    assert a["x"] is b["x"]
+    assert len(a["x"]) <= 100
+    assert np.max(a["y"]) == np.max(np.sin(x * 20))
+    assert np.min(b["y"]) == np.min(np.cos(x * 20))
+
+
+def test_bars_are_not_downsampled():
+    plot = {"data": [{"type": "bar", "x": np.arange(100), "y": np.arange(100)}]}
+    assert downsample_plotly_data(plot, 10) is plot
+
+
+def test_grid_indices():
+    x = np.repeat(np.arange(10.0), 100)
+    y = np.tile(np.arange(100.0), 10)
+    x[0] = np.nan
+    indices = grid_indices(x, y, 25)
+
+    # One point per occupied cell of a 5 by 5 grid, skipping non-finite points
+    assert len(indices) == 25
+    assert 0 not in indices
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_grid_indices_without_finite_points():
+    x = np.full(100, np.nan)
+    indices = grid_indices(x, np.arange(100.0), 25)
+    assert len(indices) == 0
+    assert indices.dtype.kind == "i"
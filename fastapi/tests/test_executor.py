@@ -0,0 +1,172 @@
+import asyncio
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from app.core.executor import BoundedExecutor
+from app.core.executor import batch
+
+from fastapi import HTTPException
+
+
+def test_run():
+    executor = BoundedExecutor("thread", max_workers=2, queue_size=2)
+    try:
+        assert asyncio.run(executor.run(pow, 2, 10)) == 1024
+        assert executor.stats()["completed"] == 1
+    finally:
+        executor.shutdown()
+
+
+def test_rejects_when_full():
+    executor = BoundedExecutor("thread", max_workers=1, queue_size=1)
+    release = threading.Event()
+
+    async def main():
+        tasks = [asyncio.create_task(executor.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert executor.stats()["running"] == 1
+        assert executor.stats()["queued"] == 1
+        assert executor.stats()["saturation"] == 1.0
+
+        # One worker busy and one task queued, the next one is turned away
+        with pytest.raises(HTTPException) as e:
+            await executor.run(release.wait)
+        assert e.value.status_code == 503
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+        # There is room again once the tasks have completed
+        assert await executor.run(pow, 2, 2) == 4
+
+    try:
+        asyncio.run(main())
+        assert executor.stats()["rejected"] == 1
+        assert executor.stats()["completed"] == 3
+    finally:
+        executor.shutdown()
+
+
+def test_run_timed():
+    executor = BoundedExecutor("thread", max_workers=1, queue_size=1)
+    try:
+        result, timings = asyncio.run(executor.run_timed(pow, 3, 2))
+        assert result == 9
+        assert timings["queue"] >= 0
+        assert timings["run"] >= 0
+        assert executor.stats()["mean_run_time"] == timings["run"]
+    finally:
+        executor.shutdown()
+
+
+def _crash():
+    os._exit(1)
+
+
+def test_replaces_broken_pool():
+    executor = BoundedExecutor("process", max_workers=1, queue_size=2)
+
+    async def main():
+        broken = executor.pool
+        with pytest.raises(HTTPException) as e:
+            await executor.run(_crash)
+        assert e.value.status_code == 500
+
+        # The next task gets a fresh pool
+        assert await executor.run(pow, 2, 3) == 8
+        assert executor.pool is not broken
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+
+def test_late_failure_keeps_replacement():
+    executor = BoundedExecutor("thread", max_workers=1, queue_size=1)
+    release = threading.Event()
+
+    def fail():
+        release.wait()
+        raise BrokenProcessPool()
+
+    async def main():
+        task = asyncio.create_task(executor.run(fail))
+        await asyncio.sleep(0)
+
+        # The pool was replaced before the task on the old one failed
+        broken = executor._pool
+        executor._pool = None
+        replacement = executor.pool
+        release.set()
+        with pytest.raises(HTTPException):
+            await task
+        broken.shutdown()
+
+        assert executor.pool is replacement
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+
+def test_batch_waits_for_idle_worker():
+    executor = BoundedExecutor("thread", max_workers=1, queue_size=1)
+    release = threading.Event()
+
+    async def run_batch(func, *args):
+        with batch():
+            return await executor.run(func, *args)
+
+    async def main():
+        busy = asyncio.create_task(executor.run(release.wait))
+        waiting = [asyncio.create_task(run_batch(pow, 2, i)) for i in range(3)]
+        await asyncio.sleep(0)
+
+        # Batch tasks wait for the worker and leave the queue to other requests
+        assert executor.stats()["waiting"] == 3
+        queued = asyncio.create_task(executor.run(pow, 3, 2))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException):
+            await executor.run(pow, 3, 3)
+
+        release.set()
+        await busy
+        assert await queued == 9
+        assert await asyncio.gather(*waiting) == [1, 2, 4]
+        assert executor.stats()["waiting"] == 0
+
+    try:
+        asyncio.run(main())
+        assert executor.stats()["rejected"] == 1
+    finally:
+        executor.shutdown()
+
+
+def test_cancelled_batch_task_passes_worker_on():
+    executor = BoundedExecutor("thread", max_workers=1, queue_size=0)
+
+    async def run_batch(func, *args):
+        with batch():
+            return await executor.run(func, *args)
+
+    async def main():
+        # As if a task was running
+        executor._pending = 1
+        first = asyncio.create_task(run_batch(pow, 2, 1))
+        second = asyncio.create_task(run_batch(pow, 2, 2))
+        await asyncio.sleep(0)
+
+        # The first task is woken up, but cancelled before it runs
+        executor._pending = 0
+        executor._wake()
+        first.cancel()
+        assert await asyncio.wait_for(second, 1) == 4
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
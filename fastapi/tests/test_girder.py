@@ -0,0 +1,103 @@
+import asyncio
+import io
+
+import aiohttp
+import pytest
+import tenacity
+from app.core import girder
+from app.core.girder import AsyncGirderClient
+
+
+class FakeResponse:
+    status = 200
+
+    async def json(self):
+        return {"_id": "file"}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, failures):
+        self.failures = failures
+        self.bodies = []
+
+    def request(self, method, url, data=None, **kwargs):
+        self.bodies.append(data.read())
+        if len(self.bodies) <= self.failures:
+            raise aiohttp.ServerDisconnectedError()
+        return FakeResponse()
+
+
+class Unseekable(io.BytesIO):
+    def seekable(self):
+        return False
+
+
+@pytest.fixture(autouse=True)
+def no_wait(monkeypatch):
+    monkeypatch.setitem(girder._RETRY, "wait", tenacity.wait_none())
+
+
+def _upload(session, stream):
+    gc = AsyncGirderClient(session, "http://girder/api/v1", "token")
+    return asyncio.run(gc.upload_file("item", stream, "movie.mp4", 4))
+
+
+def test_upload_retries_with_the_whole_body():
+    session = FakeSession(failures=2)
+    assert _upload(session, io.BytesIO(b"data")) == {"_id": "file"}
+    assert session.bodies == [b"data", b"data", b"data"]
+
+
+def test_unseekable_upload_is_not_retried():
+    session = FakeSession(failures=1)
+    with pytest.raises(aiohttp.ServerDisconnectedError):
+        _upload(session, Unseekable(b"data"))
+    assert session.bodies == [b"data"]
+
+
+class RangeResponse(FakeResponse):
+    def __init__(self, data, status):
+        self.data = data
+        self.status = status
+
+    async def read(self):
+        return self.data
+
+
+class RangeSession:
+    def __init__(self, data, honor_range=True):
+        self.data = data
+        self.honor_range = honor_range
+        self.ranges = []
+
+    def get(self, url, headers=None):
+        self.ranges.append(headers.get("Range"))
+        if not self.honor_range or "Range" not in headers:
+            return RangeResponse(self.data, 200)
+        first, last = headers["Range"].removeprefix("bytes=").split("-")
+        last = int(last) + 1 if last else None
+        return RangeResponse(self.data[int(first) : last], 206)
+
+
+@pytest.mark.parametrize("honor_range", [True, False])
+def test_read_file_ranges(honor_range):
+    session = RangeSession(b"0123456789", honor_range)
+    gc = AsyncGirderClient(session, "http://girder/api/v1", "token")
+
+    async def main():
+        return [
+            await gc.read_file("file"),
+            await gc.read_file("file", 2, 5),
+            await gc.read_file("file", 7),
+            await gc.read_file("file", end=3),
+            await gc.read_file("file", 4, 4),
+        ]
+
+    assert asyncio.run(main()) == [b"0123456789", b"234", b"789", b"012", b""]
+    assert session.ranges == [None, "bytes=2-4", "bytes=7-", "bytes=0-2"]
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+from app.api.api_v1.endpoints import images
+from app.core import executor
+
+
+def test_render_frames_in_order(monkeypatch):
+    async def render(gc, variable_id, step, format, plot_details):
+        # Later timesteps finish first
+        await asyncio.sleep(0.01 * (5 - step))
+        assert executor._batch.get()
+        return f"{step}".encode()
+
+    monkeypatch.setattr(images, "render_timestep_image", render)
+
+    async def main():
+        rendered = images.render_frames(None, "id", list(range(5)), "png", None)
+        return [frame async for frame in rendered]
+
+    assert asyncio.run(main()) == [(s, f"{s}".encode()) for s in range(5)]
+
+
+def test_failed_frame_fails_batch(monkeypatch):
+    async def render(gc, variable_id, step, format, plot_details):
+        if step == 2:
+            raise RuntimeError("render failed")
+        return b""
+
+    monkeypatch.setattr(images, "render_timestep_image", render)
+
+    async def main():
+        frames = []
+        with pytest.raises(RuntimeError):
+            async for step, _ in images.render_frames(
+                None, "id", list(range(5)), "png", None
+            ):
+                frames.append(step)
+        return frames
+
+    assert asyncio.run(main()) == [0, 1]
@@ -0,0 +1,215 @@
+import asyncio
+import time
+
+import pytest
+from app.core.jobs import CANCELLED
+from app.core.jobs import COMPLETE
+from app.core.jobs import FAILED
+from app.core.jobs import RUNNING
+from app.core.jobs import JobQueue
+
+from fastapi import HTTPException
+
+
+def _queue(tmp_path, **kwargs):
+    return JobQueue(
+        tmp_path / "jobs",
+        **{"max_workers": 1, "queue_size": 1, "poll_interval": 0.01, **kwargs},
+    )
+
+
+async def _until_done(jobs, job_id):
+    while jobs.get(job_id)["status"] not in (COMPLETE, FAILED, CANCELLED):
+        await asyncio.sleep(0.01)
+
+    return jobs.get(job_id)
+
+
+def test_progress_and_dedupe(tmp_path):
+    jobs = _queue(tmp_path)
+
+    async def work(progress):
+        for i in range(3):
+            progress(i + 1, 3)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        job = jobs.submit("key", work, name="a")
+        # The same key while the job is active returns it
+        assert jobs.submit("key", work)["id"] == job["id"]
+
+        job = await _until_done(jobs, job["id"])
+        assert job["status"] == COMPLETE
+        assert (job["completed"], job["total"], job["name"]) == (3, 3, "a")
+        assert jobs.active("key") is None
+
+    asyncio.run(main())
+
+
+def test_rejects_when_full(tmp_path):
+    jobs = _queue(tmp_path)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def work(progress):
+            await release.wait()
+
+        first = jobs.submit("a", work)
+        second = jobs.submit("b", work)
+        with pytest.raises(HTTPException) as e:
+            jobs.submit("c", work)
+        assert e.value.status_code == 503
+        assert jobs.stats()["running"] == 1
+        assert jobs.stats()["queued"] == 1
+
+        release.set()
+        for job in [first, second]:
+            assert (await _until_done(jobs, job["id"]))["status"] == COMPLETE
+
+    asyncio.run(main())
+
+
+def test_cancel(tmp_path):
+    jobs = _queue(tmp_path)
+
+    async def work(progress):
+        await asyncio.sleep(10)
+
+    async def main():
+        job = jobs.submit("key", work)
+        await asyncio.sleep(0.01)
+        assert jobs.cancel(job["id"])["status"] == CANCELLED
+        assert (await _until_done(jobs, job["id"]))["status"] == CANCELLED
+        assert jobs.active("key") is None
+
+    asyncio.run(main())
+
+
+def test_failure(tmp_path):
+    jobs = _queue(tmp_path)
+
+    async def work(progress):
+        raise HTTPException(status_code=400, detail="bad request")
+
+    async def main():
+        job = await _until_done(jobs, jobs.submit("key", work)["id"])
+        assert job["status"] == FAILED
+        assert job["error"] == "bad request"
+
+    asyncio.run(main())
+
+
+def test_runs_after_active_job(tmp_path):
+    jobs = _queue(tmp_path, max_workers=2)
+    order = []
+
+    def work(name):
+        async def run(progress):
+            order.append(f"{name} started")
+            await asyncio.sleep(0.05)
+            order.append(f"{name} finished")
+
+        return run
+
+    async def main():
+        first = jobs.submit("key", work("first"))
+        # Even with a free worker, the second job waits for the first
+        second = jobs.submit("key", work("second"), after=first["id"])
+        assert second["id"] != first["id"]
+        assert jobs.active("key")["id"] == second["id"]
+
+        # The active job is no longer the one it would run after
+        assert jobs.submit("key", work("third"), after=first["id"]) == second
+
+        await _until_done(jobs, second["id"])
+        assert order == [
+            "first started",
+            "first finished",
+            "second started",
+            "second finished",
+        ]
+
+    asyncio.run(main())
+
+
+def test_stale_job(tmp_path):
+    jobs = _queue(tmp_path, stale_after=60)
+
+    async def work(progress):
+        await asyncio.sleep(10)
+
+    async def main():
+        job = jobs.submit("key", work)
+        # As if the worker running it had been killed
+        jobs._tasks.pop(job["id"]).cancel()
+        jobs._state.set(("job", job["id"]), {**job, "updated": time.time() - 120})
+
+        job = jobs.get(job["id"])
+        assert job["status"] == FAILED
+        assert jobs.active("key") is None
+
+    asyncio.run(main())
+
+
+def test_wait_for_cancelled_job(tmp_path):
+    jobs = _queue(tmp_path)
+    events = []
+
+    async def work(progress):
+        try:
+            await asyncio.sleep(10)
+        finally:
+            # Winding down, e.g. finishing an upload
+            await asyncio.sleep(0.05)
+            events.append("stopped")
+
+    async def main():
+        job = jobs.submit("key", work)
+        await asyncio.sleep(0.01)
+        jobs.cancel(job["id"])
+        job = await jobs.wait(job["id"])
+        assert events == ["stopped"]
+        assert job["status"] == CANCELLED
+
+    asyncio.run(main())
+
+
+def test_heartbeat(tmp_path):
+    jobs = _queue(tmp_path, stale_after=0.1)
+
+    async def work(progress):
+        # Longer than a job may go without reporting progress
+        await asyncio.sleep(0.3)
+
+    async def main():
+        job = jobs.submit("key", work)
+        await asyncio.sleep(0.2)
+        assert jobs.get(job["id"])["status"] == RUNNING
+        assert (await _until_done(jobs, job["id"]))["status"] == COMPLETE
+
+    asyncio.run(main())
+
+
+def test_cancelled_from_another_worker(tmp_path):
+    jobs = _queue(tmp_path, stale_after=0.1)
+    events = []
+
+    async def work(progress):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+
+    async def main():
+        job = jobs.submit("key", work)
+        await asyncio.sleep(0.01)
+        # As another worker would, without access to the task
+        other = JobQueue(tmp_path / "jobs", max_workers=1, queue_size=1)
+        other.cancel(job["id"])
+        job = await asyncio.wait_for(jobs.wait(job["id"]), 1)
+        assert job["status"] == CANCELLED
+        assert events == ["cancelled"]
+
+    asyncio.run(main())
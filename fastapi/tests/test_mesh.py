@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from app.api.api_v1.endpoints.mesh import generate_mesh_data
+from app.api.api_v1.endpoints.mesh import geometry_hash
+from app.api.api_v1.endpoints.mesh import ingested_geometry_hash
+
+CONFIG = {
+    "nodes": "nodes",
+    "connectivity": "connectivity",
+    "color": "color",
+    "xlabel": "x",
+    "ylabel": "y",
+    "title": "mesh",
+}
+
+
+class FakeBP:
+    def __init__(self):
+        self.variables = {
+            "nodes": np.arange(8, dtype="f8").reshape(4, 2),
+            "connectivity": np.array([[0, 1, 2], [1, 2, 3]], dtype="i4"),
+            "color": np.linspace(0, 1, 4),
+        }
+        self.reads = []
+
+    def read(self, name):
+        self.reads.append(name)
+        return self.variables[name]
+
+
+def test_mesh_hashes_geometry():
+    bp = FakeBP()
+    mesh = generate_mesh_data(CONFIG, bp, "color")
+    assert sorted(bp.reads) == ["color", "connectivity", "nodes"]
+    assert mesh["geometryHash"] == geometry_hash(
+        bp.variables["nodes"], bp.variables["connectivity"]
+    )
+
+
+def test_known_hash_reads_only_color():
+    bp = FakeBP()
+    mesh = generate_mesh_data(CONFIG, bp, "color", known_hash="abc")
+    assert bp.reads == ["color"]
+    assert mesh["geometryHash"] == "abc"
+    assert "nodes" not in mesh and "connectivity" not in mesh
+
+
+def test_ingested_geometry_hash():
+    meta = {"geometry": [["a", 1, 5], ["b", 6, 6]]}
+    assert ingested_geometry_hash(meta, 1) == "a"
+    assert ingested_geometry_hash(meta, 6) == "b"
+    assert ingested_geometry_hash(meta, 7) is None
+    assert ingested_geometry_hash({}, 1) is None
+
+
+# Ingest records the geometry hash of the timesteps, which has to be the same
+# digest the service computes
+GEOMETRY_HASH = "fb5145ce7bb73f9a2e341d3a47a06819"
+
+
+def test_geometry_hash_is_pinned():
+    bp = FakeBP()
+    assert (
+        geometry_hash(bp.variables["nodes"], bp.variables["connectivity"])
+        == GEOMETRY_HASH
+    )
+
+
+def test_ingest_geometry_hash_matches():
+    watch = pytest.importorskip("esimmon.cli.watch")
+    bp = FakeBP()
+    assert (
+        watch.geometry_hash(bp.variables["nodes"], bp.variables["connectivity"])
+        == GEOMETRY_HASH
+    )
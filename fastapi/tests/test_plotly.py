@@ -0,0 +1,61 @@
+import msgpack
+import numpy as np
+from app.api.api_v1.endpoints.plotly import PLOTLY_MSGPACK_MEDIA_TYPE
+from app.api.api_v1.endpoints.plotly import generate_plotly_response
+from app.api.api_v1.endpoints.plotly import plotly_to_json
+from app.api.api_v1.endpoints.plotly import plotly_to_typed_arrays
+
+
+def _plot():
+    x = np.linspace(0, 1, 5)
+    return {
+        "data": [
+            {"type": "scatter", "name": "a", "x": x, "y": np.arange(5, dtype="i4")},
+            {"type": "scatter", "name": "b", "x": x, "y": x**2},
+        ],
+        "layout": {"title": "plot"},
+        "type": "plotly",
+    }
+
+
+def _decode(array):
+    return np.frombuffer(array["data"], dtype=array["dtype"]).reshape(array["shape"])
+
+
+def test_typed_arrays_share_x():
+    plot = plotly_to_typed_arrays(_plot())
+    assert [t["x"] for t in plot["data"]] == [0, 0]
+    assert [t["y"] for t in plot["data"]] == [1, 2]
+    assert len(plot["arrays"]) == 3
+    assert plot["layout"] == {"title": "plot"}
+
+    np.testing.assert_array_equal(_decode(plot["arrays"][0]), np.linspace(0, 1, 5))
+    assert plot["arrays"][1]["dtype"] == "<i4"
+    np.testing.assert_array_equal(_decode(plot["arrays"][1]), np.arange(5))
+
+
+def test_typed_arrays_are_little_endian_and_numeric():
+    plot = _plot()
+    plot["data"][0]["y"] = np.arange(5, dtype=">f8")
+    plot["data"][1]["y"] = np.arange(5, dtype="i8")
+    arrays = plotly_to_typed_arrays(plot)["arrays"]
+
+    # There is no JavaScript typed array for 64 bit integers
+    assert [a["dtype"] for a in arrays] == ["<f8", "<f8", "<f8"]
+    np.testing.assert_array_equal(_decode(arrays[1]), np.arange(5))
+
+
+def test_msgpack_response_round_trip():
+    response = generate_plotly_response(_plot(), binary=True)
+    assert response.media_type == PLOTLY_MSGPACK_MEDIA_TYPE
+
+    plot = msgpack.unpackb(response.body)
+    x = _decode(plot["arrays"][plot["data"][1]["x"]])
+    y = _decode(plot["arrays"][plot["data"][1]["y"]])
+    np.testing.assert_array_equal(y, x**2)
+
+
+def test_json():
+    plot = plotly_to_json(_plot())
+    assert plot["data"][0]["y"] == [0, 1, 2, 3, 4]
+    assert plot["data"][1]["x"] == [0.0, 0.25, 0.5, 0.75, 1.0]
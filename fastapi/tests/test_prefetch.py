@@ -0,0 +1,48 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.core.prefetch import Prefetcher
+
+
+def test_prefetches_sequential_playback(tmp_path):
+    loaded = []
+
+    async def load(gc, variable_id, timestep, **options):
+        loaded.append((variable_id, timestep, options))
+
+    async def main():
+        prefetcher = Prefetcher(tmp_path, depth=2, load=load)
+        gc = SimpleNamespace(token="token")
+        timesteps = [1, 2, 3, 4, 5]
+        prefetcher.record(gc, "v", 1, timesteps, as_image=False)
+        prefetcher.record(gc, "v", 2, timesteps, as_image=False)
+        await asyncio.gather(*prefetcher._tasks.values())
+        await asyncio.sleep(0)
+        assert prefetcher._tasks == {}
+
+    asyncio.run(main())
+    assert loaded == [("v", 3, {"as_image": False}), ("v", 4, {"as_image": False})]
+
+
+def test_finished_task_keeps_a_newer_one(tmp_path):
+    async def load(gc, variable_id, timestep):
+        await asyncio.sleep(1)
+
+    async def main():
+        prefetcher = Prefetcher(tmp_path, depth=2, load=load)
+        gc = SimpleNamespace(token="token")
+        timesteps = [1, 2, 3, 4, 5]
+        prefetcher.record(gc, "v", 1, timesteps)
+        prefetcher.record(gc, "v", 2, timesteps)
+        ((key, first),) = prefetcher._tasks.items()
+
+        # A prefetch started again while the cancelled one is finishing up
+        first.cancel()
+        newer = asyncio.create_task(asyncio.sleep(1))
+        prefetcher._tasks[key] = newer
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert prefetcher._tasks[key] is newer
+        newer.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,36 @@
+import os
+import time
+
+import pytest
+from app.core.scratch import ScratchSpace
+
+
+def test_directory_for(tmp_path):
+    scratch = ScratchSpace(tmp_path / "scratch")
+    with scratch.directory_for("export") as path:
+        assert path.parent == tmp_path / "scratch"
+        assert path.name.startswith("export")
+        (path / "data").write_bytes(b"data")
+    assert not path.exists()
+
+
+def test_removed_on_error(tmp_path):
+    scratch = ScratchSpace(tmp_path / "scratch")
+    with pytest.raises(RuntimeError):
+        with scratch.directory_for() as path:
+            raise RuntimeError()
+    assert not path.exists()
+
+
+def test_old_directories_are_removed(tmp_path):
+    scratch = ScratchSpace(tmp_path / "scratch", max_age=60)
+    old = tmp_path / "scratch" / "old"
+    recent = tmp_path / "scratch" / "recent"
+    for path in [old, recent]:
+        path.mkdir(parents=True)
+    # Left behind by a worker that died
+    os.utime(old, (time.time() - 120, time.time() - 120))
+
+    with scratch.directory_for():
+        assert not old.exists()
+        assert recent.exists()
@@ -0,0 +1,82 @@
+import asyncio
+import io
+import uuid
+
+import numpy as np
+import pytest
+from app.api.api_v1.endpoints.stats import load_stats
+
+from fastapi import HTTPException
+
+STATS_DTYPE = np.dtype(
+    [
+        ("timestep", "<i8"),
+        ("array", "S64"),
+        ("min", "<f8"),
+        ("max", "<f8"),
+        ("mean", "<f8"),
+        ("nan_count", "<i8"),
+        ("histogram", "<u4", (32,)),
+    ]
+)
+
+
+def _stats(*rows):
+    buffer = io.BytesIO()
+    records = [(step, b"color", 0, value, 0, 0, np.zeros(32)) for step, value in rows]
+    np.save(buffer, np.array(records, dtype=STATS_DTYPE))
+
+    return buffer.getvalue()
+
+
+class FakeGirderClient:
+    def __init__(self, files):
+        # Ids that no other test has cached stats for
+        self.files = {}
+        for name, data in files.items():
+            self.add(name, data)
+        self.reads = 0
+
+    def add(self, name, data):
+        file = {"_id": uuid.uuid4().hex, "name": name, "size": len(data)}
+        self.files[file["_id"]] = (file, data)
+
+    async def list_file(self, item_id):
+        return [file for file, _ in self.files.values()]
+
+    async def read_file(self, file_id, start=None, end=None):
+        self.reads += 1
+        return self.files[file_id][1][start:end]
+
+
+def _load(gc):
+    return asyncio.run(load_stats(gc, uuid.uuid4().hex))
+
+
+def test_stats_file():
+    gc = FakeGirderClient({"stats.npy": _stats((1, 10), (2, 20)), "other.npy": b""})
+    stats = _load(gc)
+    assert stats["timestep"].tolist() == [1, 2]
+    assert stats["max"].tolist() == [10, 20]
+
+
+def test_cached_until_rewritten():
+    gc = FakeGirderClient({"stats.npy": _stats((1, 10))})
+    variable_id = uuid.uuid4().hex
+    asyncio.run(load_stats(gc, variable_id))
+    asyncio.run(load_stats(gc, variable_id))
+    assert gc.reads == 1
+
+    # Ingest rewrites the file as timesteps are added
+    file, _ = next(iter(gc.files.values()))
+    data = _stats((1, 10), (2, 20))
+    gc.files[file["_id"]] = ({**file, "size": len(data)}, data)
+    stats = asyncio.run(load_stats(gc, variable_id))
+    assert stats["timestep"].tolist() == [1, 2]
+    assert gc.reads == 2
+
+
+def test_no_stats():
+    with pytest.raises(HTTPException) as e:
+        _load(FakeGirderClient({"other.npy": b""}))
+    assert e.value.status_code == 404
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import uuid
+
+import adios2 as adios
+import numpy as np
+import pytest
+from app.api.api_v1.endpoints import timeseries
+from app.api.api_v1.endpoints.timeseries import reduce_timestep
+
+from fastapi import HTTPException
+
+SPEC = ("color", 0, "max", None, None)
+
+
+def _bp_file(path, values, name="plot"):
+    with adios.open(str(path), "w", engine_type="BP4") as fh:
+        fh.write("c", values, list(values.shape), [0], list(values.shape))
+        fh.write_attribute(name, json.dumps({"type": "mesh", "color": "c"}))
+
+    return path
+
+
+def test_reduce_timestep(tmp_path):
+    path = _bp_file(tmp_path / "a.bp", np.array([1.0, np.nan, 3.0]))
+
+    assert reduce_timestep(str(path), "plot", SPEC) == 3.0
+    with pytest.raises(KeyError):
+        reduce_timestep(str(path), "other", SPEC)
+
+
+def test_reduce_timestep_missing_array(tmp_path):
+    path = tmp_path / "a.bp"
+    with adios.open(str(path), "w", engine_type="BP4") as fh:
+        fh.write("d", np.zeros(2), [2], [0], [2])
+        fh.write_attribute("plot", json.dumps({"type": "mesh", "color": "c"}))
+
+    with pytest.raises(KeyError):
+        reduce_timestep(str(path), "plot", SPEC)
+
+
+class FakeExecutor:
+    max_workers = 2
+
+    async def run(self, func, *args):
+        return func(*args)
+
+
+def test_reduced_again_when_ingested_again(tmp_path, monkeypatch):
+    variable_id = uuid.uuid4().hex
+    files = {
+        1: ("a", _bp_file(tmp_path / "1.bp", np.array([1.0]))),
+        2: ("b", _bp_file(tmp_path / "2.bp", np.array([2.0]))),
+    }
+    downloads = []
+
+    async def bp_file_id(gc, variable_id, timestep):
+        return files[timestep][0]
+
+    async def download_bp_file(gc, variable_id, timestep):
+        downloads.append(timestep)
+        return files[timestep][1]
+
+    monkeypatch.setattr(timeseries.hierarchy, "bp_file_id", bp_file_id)
+    monkeypatch.setattr(timeseries, "download_bp_file", download_bp_file)
+    monkeypatch.setattr(timeseries, "executor", FakeExecutor())
+
+    def load():
+        return asyncio.run(
+            timeseries._timeseries(None, variable_id, "plot", [1, 2], SPEC)
+        )
+
+    assert load()["values"].tolist() == [1.0, 2.0]
+    assert load()["values"].tolist() == [1.0, 2.0]
+    assert downloads == [1, 2]
+
+    # Only the step whose file changed is read again
+    files[2] = ("c", _bp_file(tmp_path / "3.bp", np.array([5.0])))
+    assert load()["values"].tolist() == [1.0, 5.0]
+    assert downloads == [1, 2, 2]
+
+
+def test_missing_variable(tmp_path, monkeypatch):
+    path = _bp_file(tmp_path / "1.bp", np.array([1.0]), name="other")
+
+    async def bp_file_id(gc, variable_id, timestep):
+        return "a"
+
+    async def download_bp_file(gc, variable_id, timestep):
+        return path
+
+    monkeypatch.setattr(timeseries.hierarchy, "bp_file_id", bp_file_id)
+    monkeypatch.setattr(timeseries, "download_bp_file", download_bp_file)
+    monkeypatch.setattr(timeseries, "executor", FakeExecutor())
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(timeseries._timeseries(None, uuid.uuid4().hex, "plot", [1], SPEC))
+    assert e.value.status_code == 404
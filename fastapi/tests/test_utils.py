@@ -0,0 +1,135 @@
+import asyncio
+import io
+import os
+import zipfile
+
+from app.api.api_v1.endpoints.utils import ZIP_CHUNK_SIZE
+from app.api.api_v1.endpoints.utils import cache_headers
+from app.api.api_v1.endpoints.utils import content_etag
+from app.api.api_v1.endpoints.utils import file_etag
+from app.api.api_v1.endpoints.utils import not_modified
+from app.api.api_v1.endpoints.utils import ordered_tasks
+from app.api.api_v1.endpoints.utils import select_timesteps
+from app.api.api_v1.endpoints.utils import stream_zip
+
+
+def test_file_etag():
+    file = {"_id": "a", "sha512": "abc"}
+    assert file_etag(file, 1) == file_etag(dict(file), 1)
+    assert file_etag(file, 1) != file_etag(file, 2)
+    assert file_etag(file, 1) != file_etag({**file, "_id": "b"}, 1)
+
+
+def test_content_etag():
+    assert content_etag({"a": 1}) == content_etag({"a": 1})
+    assert content_etag({"a": 1}) != content_etag({"a": 2})
+
+
+def test_not_modified():
+    etag = '"abc"'
+    assert not not_modified(None, etag)
+    assert not_modified(etag, etag)
+    assert not_modified(f'"xyz", W/{etag}', etag)
+    assert not_modified("*", etag)
+    assert not not_modified('"xyz"', etag)
+
+
+def test_cache_headers():
+    headers = cache_headers('"abc"')
+    assert headers["ETag"] == '"abc"'
+    assert "immutable" in headers["Cache-Control"]
+    assert headers["Vary"] == "Girder-Token"
+
+    assert cache_headers('"abc"', immutable=False)["Cache-Control"] == (
+        "public, no-cache"
+    )
+    assert cache_headers('"abc"', negotiated=True)["Vary"] == "Girder-Token, Accept"
+
+
+def test_stream_zip(tmp_path):
+    path = tmp_path / "large.bin"
+    path.write_bytes(os.urandom(3 * ZIP_CHUNK_SIZE // 2))
+
+    async def parts():
+        yield b"first "
+        yield b"second"
+
+    async def entries():
+        yield "a.txt", b"hello" * 100
+        yield "b.png", b"\x89PNG"
+        yield "large.bin", path
+        yield "parts.txt", parts()
+
+    async def main():
+        return [chunk async for chunk in stream_zip(entries())]
+
+    chunks = asyncio.run(main())
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zip_obj:
+        assert zip_obj.testzip() is None
+        assert zip_obj.namelist() == ["a.txt", "b.png", "large.bin", "parts.txt"]
+        assert zip_obj.read("a.txt") == b"hello" * 100
+        assert zip_obj.getinfo("a.txt").compress_type == zipfile.ZIP_DEFLATED
+        # Already compressed formats are stored as they are
+        assert zip_obj.getinfo("b.png").compress_type == zipfile.ZIP_STORED
+        assert zip_obj.read("large.bin") == path.read_bytes()
+        assert zip_obj.read("parts.txt") == b"first second"
+
+
+def test_ordered_tasks():
+    running = 0
+    most = 0
+
+    async def work(item):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        # Later items finish first
+        await asyncio.sleep(0.01 * (5 - item))
+        running -= 1
+        return item * 2
+
+    async def main():
+        results = []
+        async for item, task in ordered_tasks(range(5), work, 2):
+            results.append((item, await task))
+        return results
+
+    assert asyncio.run(main()) == [(i, i * 2) for i in range(5)]
+    assert most == 2
+
+
+def test_ordered_tasks_cancels_pending():
+    started = []
+    cancelled = []
+
+    async def work(item):
+        started.append(item)
+        try:
+            await asyncio.sleep(10 if item else 0)
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+
+    async def main():
+        tasks = ordered_tasks(range(10), work, 3)
+        async for item, task in tasks:
+            await task
+            break
+        await tasks.aclose()
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert started == [0, 1, 2]
+    assert sorted(cancelled) == [1, 2]
+
+
+def test_select_timesteps():
+    timesteps = [5, 1, 3, 2, 4]
+    assert select_timesteps(timesteps) == [1, 2, 3, 4, 5]
+    # Both ends are included
+    assert select_timesteps(timesteps, 2, 4) == [2, 3, 4]
+    assert select_timesteps(timesteps, stop=2) == [1, 2]
+    assert select_timesteps(timesteps, start=4) == [4, 5]
+    assert select_timesteps(timesteps, stride=2) == [1, 3, 5]
+    assert select_timesteps(timesteps, 2, stride=2) == [2, 4]
+    assert select_timesteps(timesteps, 6) == []
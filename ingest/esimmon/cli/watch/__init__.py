@@ -1,5 +1,6 @@
 import abc
 import asyncio
+import hashlib
 import json
 import logging
 import mimetypes
@@ -29,7 +30,6 @@ class AsyncGirderClient(object):
         self._fastapi_url = fastapi_url
         self._folder_create_semaphore = asyncio.Semaphore()
         self._item_create_semaphore = asyncio.Semaphore()
-        self._movie_create_semaphore = asyncio.Semaphore()
         self._session = session
 
     async def authenticate(self, api_key):
@@ -207,6 +207,24 @@ class AsyncGirderClient(object):
 
         return upload
 
+    async def list_file(self, item_id):
+        return await self.get(f"item/{item_id}/files", params={"limit": 0})
+
+    async def download_file(self, file_id):
+        async with self._ratelimit_semaphore:
+            async with self._session.get(
+                f"{self._api_url}/file/{file_id}/download", headers=self._headers
+            ) as r:
+                r.raise_for_status()
+                return await r.read()
+
+    async def update_file_contents(self, file_id, bits, size):
+        upload = await self.put(f"file/{file_id}/contents", params={"size": size})
+
+        headers = {"Content-Length": str(size)}
+        params = {"uploadId": upload["_id"], "offset": 0}
+        return await self.post("file/chunk", params=params, headers=headers, data=bits)
+
     async def set_metadata(self, resource_type, _id, meta, semaphore=None):
         # The metadata put operation is not atomic!
         if semaphore is not None:
@@ -252,14 +270,28 @@ class AsyncGirderClient(object):
 
         return await self.get("folder", params=params)
 
-    async def create_movie(self, item, exts):
-        # We need this sempahore to prevent two movies for the same item form
-        # being created.
-        async with self._movie_create_semaphore:
-            await self.put(
-                f"variables/{item['_id']}/timesteps/movie?formats={json.dumps(exts)}",
-                useFastApi=True,
-            )
+    async def create_movie(self, item, exts, poll_interval=5):
+        # Movies are generated by a background job, the service returns the
+        # job that is already running if the movies for the item are queued.
+        job = await self.put(
+            f"variables/{item['_id']}/timesteps/movie?formats={json.dumps(exts)}",
+            useFastApi=True,
+        )
+        path = f"variables/{item['_id']}/timesteps/movie/jobs/{job['id']}"
+        while job["status"] in ["queued", "running"]:
+            await asyncio.sleep(poll_interval)
+            job = await self.get(path, useFastApi=True)
+
+        if job["status"] != "complete":
+            raise Exception(f"Movie job {job['status']}: {job['error']}")
+
+    async def create_movie_segment(self, item, last):
+        # Encodes the frames of the movie up to the last timestep in the
+        # background, the job isn't waited on.
+        await self.put(
+            f"variables/{item['_id']}/timesteps/movie/segments?last={last}",
+            useFastApi=True,
+        )
 
 
 class UploadSource(abc.ABC):
@@ -400,12 +432,192 @@ class FileSystemUploadSource(UploadSource):
             return await fp.read()
 
 
-async def update_range_metadata(gc, image_tarball, bp_path, variable_items, semaphore):
-    def _update_range(old_range, new_data):
-        data_is_dict = isinstance(new_data, dict)
-        v0 = float(new_data["Min"]) if data_is_dict else np.min(new_data)
-        v1 = float(new_data["Max"]) if data_is_dict else np.max(new_data)
-        return [min(old_range[0], v0), max(old_range[1], v1)]
+# Per timestep statistics of each plotted array are kept in a sidecar file on
+# the variable item, one record per timestep and array. Timesteps are ingested
+# concurrently, so it is rewritten under the metadata semaphore.
+STATS_FILE_NAME = "stats.npy"
+STATS_BINS = 32
+STATS_DTYPE = np.dtype(
+    [
+        ("timestep", "<i8"),
+        ("array", "S64"),
+        ("min", "<f8"),
+        ("max", "<f8"),
+        ("mean", "<f8"),
+        ("nan_count", "<i8"),
+        # Evenly spaced bins from min to max
+        ("histogram", "<u4", (STATS_BINS,)),
+    ]
+)
+
+
+def array_stats(timestep, name, data):
+    data = np.asarray(data, dtype=np.float64).ravel()
+    finite = data[np.isfinite(data)]
+    nan_count = np.count_nonzero(np.isnan(data))
+    if finite.size:
+        lo, hi, mean = finite.min(), finite.max(), finite.mean()
+        histogram, _ = np.histogram(finite, bins=STATS_BINS, range=(lo, hi))
+    else:
+        lo = hi = mean = np.nan
+        histogram = np.zeros(STATS_BINS)
+
+    return (timestep, name.encode()[:64], lo, hi, mean, nan_count, histogram)
+
+
+async def save_timestep_stats(gc, item_id, timestep, records):
+    stats = np.array(records, dtype=STATS_DTYPE)
+    files = [f for f in await gc.list_file(item_id) if f["name"] == STATS_FILE_NAME]
+    if files:
+        existing = np.load(
+            BytesIO(await gc.download_file(files[0]["_id"])), allow_pickle=False
+        )
+        # Ingesting a timestep again replaces its stats
+        existing = existing[existing["timestep"] != timestep]
+        stats = np.concatenate([existing, stats])
+        stats = stats[np.argsort(stats["timestep"], kind="stable")]
+
+    buffer = BytesIO()
+    np.save(buffer, stats)
+    bits = buffer.getvalue()
+    if files:
+        await gc.update_file_contents(files[0]["_id"], bits, len(bits))
+    else:
+        await gc.upload_file({"_id": item_id}, STATS_FILE_NAME, bits, len(bits))
+
+
+BP_LAYOUTS = ["tgz", "indexed"]
+
+
+def split_bp_plots(bp_path, output_dir):
+    """
+    Writes each plot of a group's BP file, its configuration attribute and the
+    arrays it references, to a BP file of its own. Returns the BP file names
+    keyed by plot.
+    """
+    plots = {}
+    with adios2.open(str(bp_path), "r") as fh:
+        vars = fh.available_variables()
+        attrs = fh.available_attributes()
+        for attr in sorted(attrs):
+            if attrs[attr]["Type"] != "string":
+                continue
+            plot_config = fh.read_attribute_string(attr)
+            try:
+                config = json.loads(plot_config[0])
+            except (IndexError, ValueError):
+                continue
+            if not isinstance(config, dict):
+                continue
+
+            names = []
+            for value in config.values():
+                for name in value if isinstance(value, list) else [value]:
+                    if (
+                        isinstance(name, str)
+                        and vars.get(name, {}).get("Type") not in (None, "string")
+                        and name not in names
+                    ):
+                        names.append(name)
+
+            plot_path = Path(output_dir) / f"p{len(plots)}.bp"
+            with adios2.open(str(plot_path), "w", engine_type="BP4") as out:
+                out.write_attribute(attr, plot_config[0])
+                for name in names:
+                    data = np.asarray(fh.read(name))
+                    shape = list(data.shape)
+                    out.write(name, data, shape, [0] * len(shape), shape)
+            plots[attr] = plot_path.name
+
+    return plots
+
+
+def pack_indexed_bp(image_tarball, bp_members, bp_path):
+    """
+    Packs the plots of a group's BP file into an uncompressed tarball, along
+    with an index of the byte range of each plot's BP file, so a single plot
+    can be read with a range request instead of downloading the whole group.
+    """
+    with tempfile.TemporaryDirectory() as tempdir:
+        image_tarball.extractall(tempdir, members=bp_members)
+        output_dir = Path(tempdir) / "plots"
+        output_dir.mkdir()
+        plots = split_bp_plots(Path(tempdir) / bp_path, output_dir)
+
+        buffer = BytesIO()
+        with tarfile.open(mode="w", fileobj=buffer) as tar:
+            for path in sorted(set(plots.values())):
+                tar.add(output_dir / path, arcname=path)
+
+    # The data offsets are only known once the members have been written
+    buffer.seek(0)
+    with tarfile.open(mode="r", fileobj=buffer) as tar:
+        members = [m for m in tar.getmembers() if m.isfile()]
+
+    index = {}
+    for plot, path in plots.items():
+        files = [m for m in members if m.name.startswith(f"{path}/")]
+        # The files of a plot are contiguous, so one range covers them
+        start = min(m.offset_data for m in files)
+        end = max(m.offset_data + m.size for m in files)
+        index[plot] = {
+            "path": path,
+            "offset": start,
+            "size": end - start,
+            "members": [[m.name, m.offset_data, m.size] for m in files],
+        }
+
+    return buffer.getvalue(), json.dumps({"plots": index}).encode()
+
+
+def geometry_hash(nodes, connectivity):
+    # Must match the geometry hash the FastAPI service sends with meshes, both
+    # are pinned to the same digest by its tests (tests/test_mesh.py)
+    h = hashlib.blake2b(digest_size=16)
+    for values in [nodes, connectivity]:
+        values = np.ascontiguousarray(values)
+        h.update(f"{values.dtype.str}{values.shape}".encode())
+        h.update(values.data)
+
+    return h.hexdigest()
+
+
+def add_geometry_hash(runs, timestep, hash):
+    """
+    Records the geometry hash of a mesh at a timestep in the runs of
+    timesteps, as [hash, first, last], that share the same geometry.
+    """
+    updated = []
+    for run_hash, first, last in runs:
+        if run_hash != hash and first <= timestep <= last:
+            # The timestep was ingested again with a different mesh
+            for a, b in [(first, timestep - 1), (timestep + 1, last)]:
+                if a <= b:
+                    updated.append([run_hash, a, b])
+        else:
+            updated.append([run_hash, first, last])
+
+    for run in updated:
+        if run[0] == hash and run[1] - 1 <= timestep <= run[2] + 1:
+            run[1] = min(run[1], timestep)
+            run[2] = max(run[2], timestep)
+            break
+    else:
+        updated.append([hash, timestep, timestep])
+
+    return updated
+
+
+async def update_range_metadata(
+    gc, image_tarball, bp_path, variable_items, semaphore, timestep
+):
+    def _range(data):
+        if isinstance(data, dict):
+            return [float(data["Min"]), float(data["Max"])]
+        return [float(np.min(data)), float(np.max(data))]
+
+    def _update_range(old_range, new_range):
+        return [min(old_range[0], new_range[0]), max(old_range[1], new_range[1])]
 
     with tempfile.TemporaryDirectory() as tempdir:
         image_tarball.extractall(tempdir)
@@ -416,47 +628,51 @@ async def update_range_metadata(gc, image_tarball, bp_path, variable_items, sema
                     # Current variable isn't in this file
                     continue
 
-                # get existing item metadata
-                item_meta = await gc.get_metadata("item", id)
-                new_meta = {}
-
                 # get variable names for current item
                 attrs = json.loads(attrs[0])
                 vars = fh.available_variables()
 
+                # The arrays are read before taking the semaphore, so the
+                # timesteps are only serialized while the metadata is merged
+                ranges = {}
+                stats = []
                 for attr in ["x", "y", "color"]:
                     if names := attrs.get(attr, None):
                         names = [names] if not isinstance(names, list) else names
-                        new_meta[f"{attr}_range"] = item_meta.get(
-                            f"{attr}_range", [INFINITY, -INFINITY]
-                        )
                         for name in names:
-                            new_meta[f"{attr}_range"] = _update_range(
-                                new_meta[f"{attr}_range"], vars[name]
+                            ranges.setdefault(f"{attr}_range", []).append(
+                                _range(vars[name])
                             )
+                            stats.append(array_stats(timestep, name, fh.read(name)))
 
+                geometry = None
                 if xy_attrs := attrs.get("nodes", None):
-                    new_meta["x_range"] = item_meta.get(
-                        "x_range", [INFINITY, -INFINITY]
-                    )
-                    new_meta["y_range"] = item_meta.get(
-                        "y_range", [INFINITY, -INFINITY]
-                    )
-                    if (
-                        attrs.get("type", None) == "mesh-colormap"
-                        and any(np.isinf(new_meta["x_range"]))
-                        or any(np.isinf(new_meta["y_range"]))
-                    ):
-                        nodes = fh.read(xy_attrs)
-                        new_meta["x_range"] = _update_range(
-                            new_meta["x_range"], nodes[:, 0]
-                        )
-                        new_meta["y_range"] = _update_range(
-                            new_meta["y_range"], nodes[:, 1]
+                    nodes = fh.read(xy_attrs)
+                    ranges.setdefault("x_range", []).append(_range(nodes[:, 0]))
+                    ranges.setdefault("y_range", []).append(_range(nodes[:, 1]))
+
+                    # So the service can send the color of a timestep without
+                    # reading its mesh
+                    if connectivity := attrs.get("connectivity", None):
+                        geometry = geometry_hash(nodes, fh.read(connectivity))
+
+                # The metadata and stats are merged with those of the other
+                # timesteps, so they are read and updated under the semaphore
+                async with semaphore:
+                    item_meta = await gc.get_metadata("item", id)
+                    new_meta = {}
+                    for key, values in ranges.items():
+                        new_meta[key] = item_meta.get(key, [INFINITY, -INFINITY])
+                        for value in values:
+                            new_meta[key] = _update_range(new_meta[key], value)
+                    if geometry is not None:
+                        new_meta["geometry"] = add_geometry_hash(
+                            item_meta.get("geometry", []), timestep, geometry
                         )
 
-                # update item metadata
-                await gc.set_metadata("item", id, new_meta, semaphore)
+                    await gc.set_metadata("item", id, new_meta)
+                    if stats:
+                        await save_timestep_stats(gc, id, timestep, stats)
 
 
 async def ensure_folders(gc, parent, folders):
@@ -536,8 +752,7 @@ async def create_variable_item(
     return item["_id"]
 
 
-async def create_movies(folder, gc):
-    log = logging.getLogger("esimmon")
+async def list_variable_items(folder, gc):
     ignored_folders = ["timesteps", "movies"]
     folders = await gc.list_folder(folder["_id"])
     folders = [f for f in folders if f["name"] not in ignored_folders]
@@ -546,14 +761,34 @@ async def create_movies(folder, gc):
         items_list = await gc.list_item(f)
         items.extend(items_list)
 
-    for item in items:
+    return items
+
+
+async def create_movies(folder, gc):
+    log = logging.getLogger("esimmon")
+    items = await list_variable_items(folder, gc)
+
+    async def create(item):
         current = f"item {item['name']} in run {folder['name']}"
         log.info(f"Creating movies for {current}")
         try:
             await gc.create_movie(item, ["mp4", "mpg"])
         except Exception as e:
             log.warning(f"Unable to create movies for {current}: {e}")
-            continue
+
+    # The service queues the jobs, so submit them all and wait for them together
+    await asyncio.gather(*[create(item) for item in items])
+
+
+async def create_movie_segments(folder, gc, last):
+    log = logging.getLogger("esimmon")
+    for item in await list_variable_items(folder, gc):
+        try:
+            await gc.create_movie_segment(item, last)
+        except Exception as e:
+            log.warning(
+                f"Unable to queue movie segment for item {item['name']} in run {folder['name']}: {e}"
+            )
 
 
 async def upload_timestep_bp_archive_or_image(
@@ -612,6 +847,7 @@ async def fetch_images(
     timestep,
     metadata_semaphore,
     check_exists=False,
+    bp_layout="tgz",
 ):
     log = logging.getLogger("esimmon")
     log.info(
@@ -721,18 +957,35 @@ async def fetch_images(
                     ]
                     name = ""
                     for m in bp_members:
-                        f = images_tgz.extractfile(m)
-                        timestep_bp_tgz.addfile(m, f)
+                        if bp_layout == "tgz":
+                            f = images_tgz.extractfile(m)
+                            timestep_bp_tgz.addfile(m, f)
                         if Path(m.name).suffix == ".bp":
                             name = m.name
 
                 await update_range_metadata(
-                    gc, images_tgz, name, variable_items, metadata_semaphore
+                    gc, images_tgz, name, variable_items, metadata_semaphore, timestep
                 )
 
                 upload_filename = Path(bp).name.split(".")[0]
-                upload_filename = f"{upload_filename}.bp.tgz"
-                bytes = timestep_bp_bytes.getvalue()
+                if bp_layout == "indexed":
+                    bytes, index = pack_indexed_bp(images_tgz, bp_members, name)
+                    # Upload the index first, so it is there once the archive is
+                    await upload_timestep_bp_archive_or_image(
+                        gc,
+                        folder,
+                        shot_name,
+                        run_name,
+                        f"{timestep:04}",
+                        f"{upload_filename}.bp.index.json",
+                        index,
+                        len(index),
+                        check_exists=False,
+                    )
+                    upload_filename = f"{upload_filename}.bp.tar"
+                else:
+                    upload_filename = f"{upload_filename}.bp.tgz"
+                    bytes = timestep_bp_bytes.getvalue()
                 tasks.append(
                     asyncio.create_task(
                         upload_timestep_bp_archive_or_image(
@@ -789,6 +1042,8 @@ async def watch_run(
     username,
     machine,
     run_poll_interval,
+    movie_segment_size,
+    bp_layout,
 ):
     log = logging.getLogger("esimmon")
     log.info(f"Starting to watch run {run_name} shot {shot_name}.")
@@ -796,6 +1051,7 @@ async def watch_run(
     metadata_semaphore = asyncio.Semaphore()
     scheduler = asyncio.create_task(fetch_images_scheduler(fetch_images_queue))
     last_timestep = None
+    last_segment = 0
     metadata = {"username": username, "machine": machine}
     run_folder = await ensure_folders(gc, folder, [shot_name, run_name])
     await gc.set_metadata("folder", run_folder["_id"], metadata, metadata_semaphore)
@@ -814,6 +1070,15 @@ async def watch_run(
                 )
                 last_timestep = 0
 
+        # Encode the movie frames of the timesteps ingested so far as we go, so
+        # generating the movies once the run is complete is quick.
+        current_timestep = metadata.get("currentTimestep") or 0
+        if movie_segment_size > 0 and (
+            current_timestep - last_segment >= movie_segment_size
+        ):
+            await create_movie_segments(run_folder, gc, current_timestep)
+            last_segment = current_timestep
+
         # Now see where the simulation upload has got to
         run_path = "shots/%s/%s/time.json" % (shot_name, run_name)
         time = await fetch_run_time(source, upload_url, shot_name, run_name)
@@ -854,6 +1119,7 @@ async def watch_run(
                     last_timestep + 1,
                     metadata_semaphore,
                     check_exists=True,
+                    bp_layout=bp_layout,
                 )
             )
 
@@ -869,6 +1135,7 @@ async def watch_run(
                         run_name,
                         t,
                         metadata_semaphore,
+                        bp_layout=bp_layout,
                     )
                 )
         # We successfully processed the last timestep so just schedule the processing
@@ -888,6 +1155,7 @@ async def watch_run(
                     # the existence of the files, as the fetching of this
                     # timestep may have failed before.
                     last_timestep == 0,
+                    bp_layout,
                 )
             )
 
@@ -910,6 +1178,8 @@ async def watch_shots_index(
     api_key,
     shot_poll_interval,
     run_poll_internval,
+    movie_segment_size,
+    bp_layout,
 ):
     log = logging.getLogger("esimmon")
     runs = set()
@@ -954,6 +1224,8 @@ async def watch_shots_index(
                         username,
                         machine,
                         run_poll_internval,
+                        movie_segment_size,
+                        bp_layout,
                     )
                 )
                 runs.add(run_key)
@@ -972,6 +1244,8 @@ async def watch(
     shot_poll_interval,
     run_poll_internval,
     fastapi_url,
+    movie_segment_size,
+    bp_layout,
 ):
     # Select the appropriate source class based on the URL
     if upload_url.startswith("http"):
@@ -996,6 +1270,8 @@ async def watch(
                 api_key,
                 shot_poll_interval,
                 run_poll_internval,
+                movie_segment_size,
+                bp_layout,
             )
 
 
@@ -1039,6 +1315,20 @@ async def watch(
     default=None,
     help="RESTful API URL (e.g https://girder.example.com/api/v1)",
 )
+@click.option(
+    "-m",
+    "--movie-segment-size",
+    default=25,
+    type=int,
+    help="number of timesteps per movie segment encoded during a run, 0 to disable",
+)
+@click.option(
+    "-l",
+    "--bp-layout",
+    default="tgz",
+    type=click.Choice(BP_LAYOUTS),
+    help="how the BP files are stored, indexed allows a single plot to be read",
+)
 def main(
     folder_id,
     upload_url,
@@ -1047,6 +1337,8 @@ def main(
     shot_poll_interval,
     run_poll_interval,
     fastapi_url,
+    movie_segment_size,
+    bp_layout,
 ):
     # gc = GC(api_url=api_url, api_key=api_key)
     if upload_url.startswith("http") and upload_url[-1] == "/":
@@ -1071,5 +1363,7 @@ def main(
             shot_poll_interval,
             run_poll_interval,
             fastapi_url,
+            movie_segment_size,
+            bp_layout,
         )
     )